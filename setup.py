@@ -0,0 +1,34 @@
+# The package is configured in pyproject.toml. This only adds compiling the
+# stylesheet to the build, so that the server need not compile it at runtime.
+from pathlib import Path
+from shutil import which
+import subprocess
+
+from setuptools import setup
+from setuptools.command.build_py import build_py
+
+STYLESHEET = Path("src/fiio_shuffle/static/style.sass")
+
+
+class build_py_with_sass(build_py):
+    def run(self):
+        super().run()
+        dest = Path(self.build_lib) / "fiio_shuffle/static/style.css"
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        # Dart Sass, as used by flask_assets, or else libsass if it is installed
+        sass = which("sass")
+        try:
+            if sass is not None:
+                subprocess.run([sass, "--no-source-map", STYLESHEET, dest], check=True)
+                return
+            import sass
+
+            dest.write_text(sass.compile(filename=str(STYLESHEET)))
+        except (ImportError, OSError, subprocess.CalledProcessError) as e:
+            self.warn(
+                f"Could not compile {STYLESHEET} ({e}); the server will compile it"
+                " when it first needs it instead"
+            )
+
+
+setup(cmdclass={"build_py": build_py_with_sass})
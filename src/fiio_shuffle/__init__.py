@@ -1,5 +1,14 @@
 import logging
-from .server import server
+
+
+def __getattr__(name):
+    # The server is only imported when asked for, e.g. by uwsgi, so that the other
+    # tasks need not pay for importing Flask and setting up the database
+    if name == "server":
+        from .server import server
+
+        return server
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def main():
@@ -13,8 +22,36 @@ def main():
     logging.basicConfig(level=log_level)
 
     if args.task == "server":
+        from .server import server
+
         server.run(host=args.host, port=args.port, debug=args.debug)
     elif args.task == "client":
         from .client import run_client
 
-        run_client(args.root, args.url)
+        run_client(
+            args.root,
+            args.url,
+            full=args.full,
+            watch=args.watch or args.watch_covers,
+            watch_covers=args.watch_covers,
+        )
+    elif args.task == "gc":
+        from .covers import collect_garbage
+        from .db import get_db
+
+        collect_garbage(get_db(), batch_size=args.batch_size)
+    elif args.task == "thumbnails":
+        from .covers import make_all_variants
+        from .db import get_db
+
+        make_all_variants(get_db())
+    elif args.task == "export":
+        from .db import get_db
+        from .snapshot import export_snapshot
+
+        export_snapshot(get_db(), args.archive)
+    elif args.task == "import":
+        from .db import get_db
+        from .snapshot import import_snapshot
+
+        import_snapshot(get_db(), args.archive)
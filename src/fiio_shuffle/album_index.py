@@ -0,0 +1,216 @@
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from random import choice, randint, shuffle
+from threading import Lock
+from uuid import UUID
+
+from sqlalchemy import select
+
+from .generation import generation
+from .models import Album, AlbumInPlaylist
+
+# Most unions of playlists, and decks, kept at once. /album takes any set of
+# playlists, so without a bound a client could make the server keep arbitrarily
+# many.
+MAX_UNIONS = 64
+MAX_DECKS = 64
+
+
+def _contains(ids, album_id):
+    # ids is sorted
+    i = bisect_left(ids, album_id)
+    return i < len(ids) and ids[i] == album_id
+
+
+def _added(old, new):
+    # The elements of the sorted array new that are not in the sorted array old
+    out = []
+    i = 0
+    for album_id in new:
+        while i < len(old) and old[i] < album_id:
+            i += 1
+        if i == len(old) or old[i] != album_id:
+            out.append(album_id)
+    return out
+
+
+class _LRU:
+    # A mapping that forgets its least recently used entries beyond maxsize
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return list(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class Deck:
+    """A shuffled order of albums, dealt one at a time without repeats.
+
+    members is the sorted array of ids the deck was last brought up to date with.
+    Albums added since are swapped into random positions among those not yet dealt,
+    unless they are still in the order from before they were removed, and albums
+    removed since are skipped when they come up, so the deck need not be
+    reshuffled when the library changes. Once every album has been dealt the deck
+    is reshuffled.
+    """
+
+    def __init__(self, members):
+        self.members = members
+        self.pos = 0
+        self._shuffle()
+
+    def _shuffle(self):
+        order = list(self.members)
+        shuffle(order)
+        # Do not deal the last album of the old order first in the new one
+        if len(order) > 1 and self.pos > 0 and order[0] == self.order[self.pos - 1]:
+            i = randint(1, len(order) - 1)
+            order[0], order[i] = order[i], order[0]
+        self.order = array("q", order)
+        self.pos = 0
+
+    def update(self, members):
+        added = _added(self.members, members)
+        if len(added) > 0:
+            # An album removed and added again since it was shuffled in is already
+            # in the order, dealt or not, and is not to come up twice in a round
+            in_order = set(self.order)
+            added = [album_id for album_id in added if album_id not in in_order]
+        for album_id in added:
+            # Append and swap with a random undealt album, rather than inserting
+            self.order.append(album_id)
+            i = randint(self.pos, len(self.order) - 1)
+            self.order[i], self.order[-1] = self.order[-1], self.order[i]
+        self.members = members
+
+    def deal(self):
+        for _ in range(2):
+            while self.pos < len(self.order):
+                album_id = self.order[self.pos]
+                self.pos += 1
+                if _contains(self.members, album_id):
+                    return album_id
+            self._shuffle()
+        return None
+
+
+class AlbumIndex:
+    """In-memory index of which albums are in which playlists.
+
+    Picking a random album is then a matter of picking a random element of an array,
+    instead of having the database sort every candidate by random(). The index is
+    built lazily from albums_in_playlists, of the albums with covers, and rebuilt once the library has changed,
+    in this process or another, i.e. once the generation has moved on.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._generation = None
+        self._all = array("q")
+        self._by_playlist = {}
+        # Unions of several playlists, keyed by the frozenset of their UUIDs
+        self._unions = _LRU(MAX_UNIONS)
+        # Decks for the sets of playlists drawn from most recently, keyed like
+        # _unions. They outlive rebuilds of the index, unless none of their
+        # playlists are left.
+        self._decks = _LRU(MAX_DECKS)
+
+    def _build_if_stale(self, session):
+        # Read the generation first, so that a change committed during the build
+        # makes for another build next time
+        current = generation.current()
+        if self._generation != current:
+            self._build(session)
+            self._generation = current
+
+    def _build(self, session):
+        by_playlist = {}
+        # Albums are shown by their covers, so those without one yet are left out
+        q = (
+            select(AlbumInPlaylist.c.playlist_uuid, AlbumInPlaylist.c.album_id)
+            .join(Album, Album.id == AlbumInPlaylist.c.album_id)
+            .where(Album.cover_id.is_not(None))
+        )
+        for playlist_uuid, album_id in session.execute(q):
+            by_playlist.setdefault(playlist_uuid, set()).add(album_id)
+        every = set().union(*by_playlist.values())
+        self._all = array("q", sorted(every))
+        self._by_playlist = {
+            uuid: array("q", sorted(ids)) for uuid, ids in by_playlist.items()
+        }
+        self._unions.clear()
+        for uuids in self._decks.keys():
+            if len(uuids) != 0 and not any(u in self._by_playlist for u in uuids):
+                del self._decks[uuids]
+
+    def _ids(self, uuids):
+        if len(uuids) == 0:
+            return self._all
+        if len(uuids) == 1:
+            (uuid,) = uuids
+            return self._by_playlist.get(uuid, array("q"))
+        union = self._unions.get(uuids)
+        if union is not None:
+            return union
+        ids = set()
+        for uuid in uuids:
+            ids.update(self._by_playlist.get(uuid, ()))
+        union = array("q", sorted(ids))
+        self._unions[uuids] = union
+        return union
+
+    def album_ids(self, playlists, session):
+        """Return the ids of all albums in any of the given playlists, or in any
+        playlist at all if none are given."""
+        uuids = frozenset(UUID(str(pl)) for pl in playlists)
+        with self._lock:
+            self._build_if_stale(session)
+            return self._ids(uuids)
+
+    def deal(self, playlists, session):
+        """Like pick, but does not repeat an album until every album in the
+        playlists has been dealt."""
+        uuids = frozenset(UUID(str(pl)) for pl in playlists)
+        with self._lock:
+            self._build_if_stale(session)
+            ids = self._ids(uuids)
+            if len(ids) == 0:
+                return None
+            deck = self._decks.get(uuids)
+            if deck is None:
+                deck = self._decks[uuids] = Deck(ids)
+            elif deck.members is not ids:
+                deck.update(ids)
+            return deck.deal()
+
+    def pick(self, playlists, session):
+        ids = self.album_ids(playlists, session)
+        if len(ids) == 0:
+            return None
+        return choice(ids)
+
+
+album_index = AlbumIndex()
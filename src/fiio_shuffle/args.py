@@ -33,3 +33,64 @@ client_parser = subparsers.add_parser(
 )
 client_parser.add_argument("url", metavar="URL", help="Endpoint to submit to")
 client_parser.add_argument("root", metavar="ROOT", help="Filesystem root to use")
+client_parser.add_argument(
+    "--full",
+    action="store_true",
+    help="""Submit all playlists, not just the ones that changed since the last
+    run. Use this if the server has lost data.""",
+)
+client_parser.add_argument(
+    "--watch",
+    action="store_true",
+    help="""Keep running after submitting, and submit playlists as they change.
+    Needs Linux's inotify.""",
+)
+client_parser.add_argument(
+    "--watch-covers",
+    action="store_true",
+    help="""With --watch, also watch the directories of albums for covers that are
+    added, changed or removed""",
+)
+
+gc_parser = subparsers.add_parser(
+    "gc",
+    help="Remove covers that are no longer used",
+    description="""Remove covers that no album refers to, and cover files that no
+    cover refers to. Covers stored in the last hour are left alone, and it works in
+    small batches, so it can run while the server is running.""",
+)
+gc_parser.add_argument(
+    "--batch-size",
+    default=100,
+    type=int,
+    help="Number of covers to remove per transaction. Default: 100",
+)
+
+thumbnails_parser = subparsers.add_parser(
+    "thumbnails",
+    help="Generate resized variants of covers that lack them",
+    description="""Generate resized variants of all covers that do not have them yet,
+    e.g. covers uploaded before variants were introduced. Requires Pillow.""",
+)
+
+export_parser = subparsers.add_parser(
+    "export",
+    help="Write a snapshot of the database and covers",
+    description="""Write the database, copied with SQLite's online backup, and all
+    covers to a tar archive, for importing into another server. Safe to run while
+    the server is running.""",
+)
+export_parser.add_argument(
+    "archive", metavar="ARCHIVE", help="File to write to, or - for standard output"
+)
+
+import_parser = subparsers.add_parser(
+    "import",
+    help="Import a snapshot written by export",
+    description="""Copy the covers in a snapshot into place, skipping those already
+    present, and merge its database into this server's in one transaction. If it
+    is interrupted, run it again to carry on.""",
+)
+import_parser.add_argument(
+    "archive", metavar="ARCHIVE", help="File to read from, or - for standard input"
+)
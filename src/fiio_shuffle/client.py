@@ -1,42 +1,120 @@
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 from itertools import batched
 from json import dumps
 from logging import error
+from mimetypes import guess_extension
+from os import listdir
 from pathlib import Path
+from queue import Queue
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from struct import error as StructError
 from sys import exit
-from uuid import uuid4
+from threading import Lock, Thread
+from time import monotonic, process_time
 import logging
 
-import dbpl
-from requests import post, get
 from requests.exceptions import ConnectionError, HTTPError, Timeout, TooManyRedirects
 
 from .config import config
+from .manifest import Manifest, PlaylistIds
+from .multipart import MultipartBody
+from .musicbrainz import CoverFetcher
+from .normalise import CoverNormaliser
+from .playlist import PlaylistReader, Track
+from .sync import EMPTY_DIGEST, add_entries
+from .transport import Transport
 from .utils import get_cache_dir
+from .wire import encode
 
 UUID_KEY = "fiio_shuffle_uuid"
 
+COVER_NAMES = [
+    base + ext
+    for ext in [".jpg", ".png"]
+    for base in ["cover", "Cover", "folder", "Folder", "front", "Front"]
+]
+
+# Extensions the server can serve covers with as they are
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
+
+_magic = None
+_magic_lock = Lock()
+
+# Tags needed to find an album's key and cover
+ALBUM_META_KEYS = ["album artist", "artist", "album", "year", "date"]
+
+ScannedPlaylist = namedtuple(
+    "ScannedPlaylist", ["file", "title", "uuid", "albums", "snapshot"]
+)
+
 AlbumEntry = namedtuple(
     "Album", ["artist", "title", "year", "cover_uri", "timestamp", "playlist_uuid"]
 )
 
 
-def _find_playlists(root_dir):
+def _find_playlists(root_dir, manifest):
+    # The playlists that changed since the last run, with snapshots to record in
+    # the manifest once they have been submitted
     pls = []
     for f in root_dir.iterdir():
         if not (f.is_file() and f.suffix == ".dbpl"):
             continue
-        pl = dbpl.Playlist(f)
-        if "title" not in pl.meta:
-            logging.warn(f"Playlist {f} does not have a title in its meta, skipping")
+        if manifest.playlist_unchanged(f):
+            logging.info(f"Playlist {f} is unchanged since the last run, skipping")
             continue
-        if UUID_KEY not in pl.meta.keys():
-            pl.meta[UUID_KEY] = str(uuid4())
-            pl.save()
-        pls.append(pl)
+        pls.append((f, manifest.snapshot(f)))
     return pls
 
 
+def _read_playlist(f):
+    # Runs in a worker process. Only the first track of each album is kept, so
+    # that neither this process nor the parent ever holds the whole playlist.
+    reader = PlaylistReader(f)
+    albums = {}
+    try:
+        for track in reader.tracks():
+            try:
+                key = _key(track)
+            except KeyError as e:
+                logging.warn(f"{track.uri} does not contain key {e}, skipping")
+                continue
+            except ValueError as e:
+                logging.warn(f"{track.uri}: could not determine key: {e}")
+                continue
+            if key not in albums:
+                meta = {k: track.meta[k] for k in ALBUM_META_KEYS if k in track.meta}
+                albums[key] = Track(uri=track.uri, meta=meta)
+    except (ValueError, StructError, UnicodeDecodeError) as e:
+        logging.warn(f"Could not read playlist {f}: {e}, skipping")
+        return None, []
+    return reader.meta, list(albums.items())
+
+
+def read_playlists(pls, ids):
+    # Parse the playlists in parallel, one per process
+    with ProcessPoolExecutor(config.get("parse_processes")) as pool:
+        files = [f for f, _ in pls]
+        for (f, snapshot), (meta, albums) in zip(pls, pool.map(_read_playlist, files)):
+            if meta is None:
+                continue
+            if "title" not in meta:
+                logging.warn(
+                    f"Playlist {f} does not have a title in its meta, skipping"
+                )
+                continue
+            # Playlists written by earlier versions carry their UUID in their meta
+            uuid = ids.get(f, meta.get(UUID_KEY))
+            yield ScannedPlaylist(
+                file=f,
+                title=meta["title"],
+                uuid=uuid,
+                albums=albums,
+                snapshot=snapshot,
+            )
+
+
 def _key(track):
     meta = track.meta
     artist = meta.get("album artist", None) or meta["artist"]
@@ -58,19 +136,38 @@ def _cached_cover_uri(track):
     return cache_uri
 
 
-def _find_cover(track):
-    exts = [".jpg", ".png"]
-    bases = ["cover", "Cover", "folder", "Folder", "front", "Front"]
-    cover_names = [b + e for e in exts for b in bases]
-    from magic import Magic
+def _get_magic():
+    # Loading libmagic's database is slow, so share one detector between threads.
+    # python-magic serialises calls to it.
+    global _magic
+    with _magic_lock:
+        if _magic is None:
+            from magic import Magic
 
-    magic = Magic(mime=True)
-    for name in cover_names:
-        candidate = Path(track.uri).parent / name
+            _magic = Magic(mime=True)
+    return _magic
+
+
+@lru_cache(maxsize=1024)
+def list_dir(directory):
+    # Tracks of the same album share a directory, so list it only once instead of
+    # probing every candidate cover name
+    try:
+        return frozenset(listdir(directory))
+    except OSError:
+        return frozenset()
+
+
+def _find_local_cover(track):
+    directory = Path(track.uri).parent
+    names = list_dir(directory)
+    for name in COVER_NAMES:
+        if name not in names:
+            continue
         # magic doesn't follow symlinks, so we have to resolve them ourselves
-        candidate = candidate.resolve()
+        candidate = (directory / name).resolve()
         try:
-            mime = magic.from_file(candidate)
+            mime = _get_magic().from_file(candidate)
             if mime.startswith("image/"):
                 return candidate
         except IOError:
@@ -80,107 +177,64 @@ def _find_cover(track):
     if cache_uri.exists():
         return cache_uri
 
-    from_mb = _get_cover_musicbrainz(track)
-    if from_mb is not None:
-        return from_mb
-
     return None
 
 
-def _get_cover_musicbrainz(track):
-    try:
-        meta = track.meta
-        artist = meta.get("album artist", None) or meta["artist"]
-        title = meta["album"]
-    except KeyError:
-        return None
-
-    log_prefix = f"{artist} - {title}"
-
-    logging.info(f"{log_prefix}: Downloading cover from MusicBrainz")
-    mb_id_url = f'http://musicbrainz.org/ws/2/release-group/?query=artist:"{artist}" AND release:"{title}"'
-    try:
-        resp = get(mb_id_url)
-        resp.raise_for_status()
-    except (HTTPError, ConnectionError) as e:
-        logging.warn(
-            f"{log_prefix}: Could not get relase group id from MusicBrainz: {e}"
-        )
-        return None
-
-    import xml.etree.ElementTree as ET
-
-    ns = {"m": "http://musicbrainz.org/ns/mmd-2.0#"}
-    root = ET.fromstring(resp.text)
-    release_group = root.find(".//m:release-group", ns)
-    if release_group is None:
-        logging.warn(f"{log_prefix}: Release group not found on MusicBrainz")
-        return None
-    release_group_id = release_group.attrib["id"]
+def _record_cover(manifest, key, cover_uri):
+    timestamp = int(cover_uri.stat().st_mtime)
+    manifest.record_cover(key, cover_uri, timestamp)
+    return cover_uri, timestamp
 
-    mb_art_url = f"http://coverartarchive.org/release-group/{release_group_id}/"
 
-    try:
-        resp = get(mb_art_url)
-        resp.raise_for_status()
-        data = resp.json()
-        uri = data["images"][0]["image"]
-    except (ConnectionError, HTTPError, KeyError, IndexError) as e:
-        logging.warn(f"{log_prefix}: Could not get cover from Cover Art Archive: {e}")
-        return None
-
-    try:
-        resp = get(uri)
-        resp.raise_for_status()
+def _find_albums_in_playlist(pl, manifest, fetcher):
+    logging.info(f"{pl.title}: Finding albums")
 
-        cache_uri = _cached_cover_uri(track)
-        from os import makedirs
-
-        makedirs(cache_uri.parent, exist_ok=True)
-        with cache_uri.open("wb") as f:
-            for chunk in resp.iter_content(chunk_size=8192):
-                f.write(chunk)
-    except (HTTPError, IOError, ConnectionError) as e:
-        logging.warn(
-            f"{log_prefix}: Could not download cover from Cover Art Archive ({uri}): {e}"
-        )
-        return None
-    return cache_uri
-
-
-def _find_albums_in_playlist(pl):
-    logging.info(f"{pl.meta['title']}: Finding albums")
-    albums = {}
-    uuid = pl.meta[UUID_KEY]
-
-    skip = set()
-    for track in pl.tracks:
-        try:
-            key = _key(track)
-            if key in albums or key in skip:
-                continue
-            cover_uri = _find_cover(track)
+    covers = {}
+    to_find = []
+    for key, track in pl.albums:
+        cached = manifest.cover(key)
+        if cached is not None:
+            covers[key] = cached
+        else:
+            to_find.append((key, track))
+
+    # Albums without a cover on disk are looked up on MusicBrainz in the background
+    # while the pool keeps looking on disk for the others
+    downloads = []
+    with ThreadPoolExecutor(config["cover_threads"]) as pool:
+        found = pool.map(_find_local_cover, [track for _, track in to_find])
+        for (key, track), cover_uri in zip(to_find, found):
             if cover_uri is None:
-                skip.add(key)
+                artist, title, _ = key
+                dest = _cached_cover_uri(track)
+                downloads.append((key, fetcher.submit(artist, title, dest)))
                 continue
-
-            artist, title, year = key
-            entry = AlbumEntry(
-                artist=artist,
-                title=title,
-                year=year,
-                cover_uri=cover_uri,
-                timestamp=int(cover_uri.stat().st_mtime),
-                playlist_uuid=uuid,
-            )
-        except KeyError as e:
-            logging.warn(f"{track.uri} does not contain key {e}, skipping")
+            covers[key] = _record_cover(manifest, key, cover_uri)
+    for key, download in downloads:
+        cover_uri = download.result()
+        if cover_uri is not None:
+            covers[key] = _record_cover(manifest, key, cover_uri)
+
+    logging.info(f"{pl.title}: found {len(covers)} albums.")
+    for key, _ in pl.albums:
+        if key not in covers:
             continue
-        except ValueError as e:
-            logging.warn(f"{track.uri}: could not determine key: {e}")
-        albums[key] = entry
-    logging.info(f"{pl.meta['title']}: found {len(albums)} albums.")
-    yield from albums.items()
+        cover_uri, timestamp = covers[key]
+        artist, title, year = key
+        entry = AlbumEntry(
+            artist=artist,
+            title=title,
+            year=year,
+            cover_uri=cover_uri,
+            timestamp=timestamp,
+            playlist_uuid=pl.uuid,
+        )
+        yield key, entry
+
+
+def album_entry(album):
+    # What the digests of playlists are made of
+    return (album.artist, album.title, album.year, album.timestamp)
 
 
 def _construct_offer(data):
@@ -192,59 +246,150 @@ def _construct_offer(data):
     return out
 
 
+def _post_encoded(transport, path, payload, capabilities):
+    # Send payload as compactly as the server allows, see wire.py
+    start = process_time()
+    body, headers = encode(payload, capabilities)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        elapsed = (process_time() - start) * 1000
+        plain = len(dumps(payload).encode())
+        logging.debug(
+            f"{path}: {len(body)} bytes instead of {plain} as plain JSON"
+            f" ({headers}), encoded in {elapsed:.2f} ms"
+        )
+    return transport.post(path, data=body, headers=headers)
+
+
 def _make_key(a):
     return (a["artist"], a["title"], a["year"])
 
 
-def _offer_and_upload(url, candidates):
+def _log_upload(a, result):
+    if result["success"]:
+        logging.info(f"Uploaded {a['artist']} - {a['title']} ({a['year']})")
+    else:
+        logging.warn(
+            f"Could not upload {a['artist']} - {a['title']} ({a['year']}): {result['message']}"
+        )
+    return result["success"]
+
+
+def _cover_filename(path):
+    # The server takes the extension of a cover from its file name. Covers fetched
+    # from MusicBrainz are cached without one, so those are told by their contents.
+    ext = path.suffix.lower()
+    if ext not in IMAGE_EXTENSIONS:
+        ext = guess_extension(_get_magic().from_file(str(path))) or ""
+    return "cover" + ext
+
+
+def _upload(transport, a, o):
+    metadata = {"auth_key": config["auth_key"], "data": a}
+    with o.cover_uri.open("rb") as cover:
+        files = [
+            ("metadata", ("metadata.json", dumps(metadata))),
+            ("cover", (_cover_filename(o.cover_uri), cover)),
+        ]
+        try:
+            r = transport.post("/upload", files=files)
+            r.raise_for_status()
+        except (ConnectionError, Timeout, TooManyRedirects, HTTPError) as e:
+            error(e)
+            return False
+    return _log_upload(a, r.json())
+
+
+def _upload_batch(transport, uploads):
+    metadata = {"auth_key": config["auth_key"], "data": [a for a, _ in uploads]}
+    parts = [("metadata", "metadata.json", dumps(metadata).encode())]
+    parts += [("cover", _cover_filename(o.cover_uri), o.cover_uri) for _, o in uploads]
+    try:
+        body = MultipartBody(parts)
+        r = transport.post(
+            "/upload/batch",
+            data=body,
+            headers={"Content-Type": body.content_type},
+        )
+        r.raise_for_status()
+    except (ConnectionError, Timeout, TooManyRedirects, HTTPError, IOError) as e:
+        error(e)
+        return False
+    j = r.json()
+    if not j["success"]:
+        error(f"Unsuccessful batch upload: {j.get('message', 'No message provided.')}")
+        return False
+    results = [_log_upload(a, result) for (a, _), result in zip(uploads, j["results"])]
+    return all(results)
+
+
+def offer_and_upload(transport, candidates, capabilities=frozenset(), normaliser=None):
+    # Returns whether the offer succeeded and every accepted cover was uploaded
     offer = _construct_offer(candidates)
     logging.info(f"Offering {len(candidates)} candidates")
     try:
-        resp = post(url + "/offer", json=offer)
+        resp = _post_encoded(transport, "/offer", offer, capabilities)
         resp.raise_for_status()
     except (ConnectionError, Timeout, TooManyRedirects) as e:
         error(e.args)
-        return
+        return False
     except HTTPError as e:
         error(e)
-        return
+        return False
     json = resp.json()
     if not json.get("success", False):
         message = json.get("message", "No message provided.")
         error(f"Unsuccessful offer: {message}.")
-        return
+        return False
     albums = json.get("albums", [])
     logging.info(f"{len(albums)} albums accepted.")
     candidates = {k: v for k, v in candidates}
-    for a in albums:
-        try:
-            o = candidates[_make_key(a)]
-        except KeyError:
-            continue
-        metadata = {"auth_key": config["auth_key"], "data": a}
-        files = [
-            ("metadata", ("metadata.json", dumps(metadata))),
-            ("cover", ("cover.jpg", o.cover_uri.open("rb"))),
-        ]
-        try:
-            r = post(url + "/upload", files=files)
-            r.raise_for_status()
-        except (ConnectionError, Timeout, TooManyRedirects, HTTPError) as e:
-            error(e)
-        else:
-            j = r.json()
-            if j["success"]:
-                logging.info(f"Uploaded {a['artist']} - {a['title']} ({a['year']})")
-            else:
-                logging.warn(
-                    f"Could not upload {a['artist']} - {a['title']} ({a['year']}): {j['message']}"
-                )
+    uploads = [
+        (a, candidates[_make_key(a)]) for a in albums if _make_key(a) in candidates
+    ]
+    if len(uploads) == 0:
+        return True
+    if normaliser is not None:
+        covers = normaliser.normalise([o.cover_uri for _, o in uploads])
+        uploads = [(a, o._replace(cover_uri=c)) for (a, o), c in zip(uploads, covers)]
+    if "upload_batch" in capabilities:
+        return _upload_batch(transport, uploads)
+    results = [_upload(transport, a, o) for a, o in uploads]
+    return all(results)
+
+
+def withdraw(transport, candidates, capabilities=frozenset()):
+    # Take albums out of their playlists on the server. Returns whether it worked.
+    data = _construct_offer(candidates)
+    logging.info(f"Withdrawing {len(candidates)} albums")
+    try:
+        resp = _post_encoded(transport, "/withdraw", data, capabilities)
+        resp.raise_for_status()
+        json = resp.json()
+    except (ConnectionError, Timeout, TooManyRedirects, HTTPError, ValueError) as e:
+        error(e)
+        return False
+    if not json.get("success", False):
+        message = json.get("message", "No message provided.")
+        error(f"Unsuccessful withdrawal: {message}.")
+        return False
+    return True
 
 
-def _submit_playlists(url, pls):
+def _get_capabilities(transport):
+    # Servers that predate /capabilities answer 404, i.e. support nothing optional
+    try:
+        resp = transport.get("/capabilities")
+        resp.raise_for_status()
+        return frozenset(resp.json().get("capabilities", []))
+    except (ConnectionError, Timeout, TooManyRedirects, HTTPError, ValueError) as e:
+        logging.info(f"Could not get server capabilities, assuming none: {e}")
+        return frozenset()
+
+
+def _submit_playlists(transport, pls, capabilities=frozenset()):
     data = {"auth_key": config["auth_key"], "playlists": pls}
     try:
-        resp = post(url + "/playlists", json=data)
+        resp = _post_encoded(transport, "/playlists", data, capabilities)
         resp.raise_for_status()
         return resp.json()
     except (ConnectionError, Timeout, TooManyRedirects) as e:
@@ -255,18 +400,187 @@ def _submit_playlists(url, pls):
         return
 
 
-def run_client(root, url):
+def differing(transport, digests, capabilities):
+    # The UUIDs of the playlists in digests, a list of (playlist, digest) pairs,
+    # for which the server has other albums than those the digest is of. If it
+    # cannot tell, it is as if they all differed.
+    playlists = [{"uuid": pl.uuid, "digest": digest} for pl, digest in digests]
+    data = {"auth_key": config["auth_key"], "playlists": playlists}
+    everything = set(pl.uuid for pl, _ in digests)
+    try:
+        resp = _post_encoded(transport, "/sync", data, capabilities)
+        resp.raise_for_status()
+        json = resp.json()
+    except (ConnectionError, Timeout, TooManyRedirects, HTTPError, ValueError) as e:
+        logging.info(f"Could not compare playlists with the server, offering them: {e}")
+        return everything
+    if not json.get("success", False):
+        message = json.get("message", "No message provided.")
+        logging.info(f"Could not compare playlists with the server: {message}")
+        return everything
+    return everything & set(json.get("playlists", []))
+
+
+def _log_resource_usage(start):
+    # ru_maxrss is in kilobytes on Linux. The children are the parsing processes.
+    own = getrusage(RUSAGE_SELF).ru_maxrss
+    children = getrusage(RUSAGE_CHILDREN).ru_maxrss
+    logging.info(
+        f"Finished in {monotonic() - start:.2f} s. Peak memory: {own / 1024:.1f} MiB,"
+        f" {children / 1024:.1f} MiB in playlist parsers."
+    )
+
+
+def _scan(pls, find_albums, out):
+    # Producer half of the pipeline: finds albums and puts batches of them on the
+    # queue. Each playlist is followed by a marker with the digest of its albums,
+    # and the scan by a marker for its end.
+    try:
+        for pl in pls:
+            digest = EMPTY_DIGEST
+            for candidate_batch in batched(find_albums(pl), config["batch_size"]):
+                entries = [album_entry(a) for _, a in candidate_batch]
+                digest = add_entries(digest, entries)
+                out.put(("batch", candidate_batch))
+            out.put(("playlist", (pl, digest)))
+    except BaseException as e:
+        out.put(("error", e))
+        raise
+    out.put(("done", None))
+
+
+def _scanned(pls, find_albums):
+    # Scan for albums in a separate thread, so that the disk is kept busy while we
+    # wait for the server, and yield what it finds. The queue is bounded so that
+    # the scan cannot run arbitrarily far ahead.
+    queue = Queue(maxsize=config["pipeline_depth"])
+    scanner = Thread(target=_scan, args=(pls, find_albums, queue), daemon=True)
+    scanner.start()
+    while True:
+        kind, item = queue.get()
+        if kind == "error":
+            raise item
+        if kind == "done":
+            break
+        yield kind, item
+    scanner.join()
+
+
+def offer_playlists(
+    transport, pls, find_albums, manifest, capabilities, normaliser=None
+):
+    pl_submissions = [{"title": pl.title, "uuid": pl.uuid} for pl in pls]
+    if _submit_playlists(transport, pl_submissions, capabilities) is None:
+        return
+    logging.info(f"Submitted {len(pl_submissions)} playlists")
+
+    results = []
+    for kind, item in _scanned(pls, find_albums):
+        if kind == "batch":
+            results.append(offer_and_upload(transport, item, capabilities, normaliser))
+        else:
+            # Only skip the playlist next time if all of it made it to the server
+            pl, _ = item
+            if all(results):
+                manifest.record_playlist(pl.file, pl.snapshot)
+            results = []
+
+
+def _sync_playlists(
+    transport, pls, find_albums, manifest, capabilities, normaliser=None
+):
+    # Like offer_playlists, but only for the playlists that differ from what the
+    # server has. Every playlist is scanned, and its batches held back, before the
+    # digests are compared in a single request.
+    scanned = []
+    pending = []
+    for kind, item in _scanned(pls, find_albums):
+        if kind == "batch":
+            pending.append(item)
+            continue
+        pl, digest = item
+        scanned.append((pl, digest, pending))
+        pending = []
+    differ = differing(
+        transport, [(pl, digest) for pl, digest, _ in scanned], capabilities
+    )
+
+    for pl, _, batches in scanned:
+        if pl.uuid not in differ:
+            logging.info(f"{pl.title}: already up to date on the server, skipping")
+            manifest.record_playlist(pl.file, pl.snapshot)
+            continue
+        submission = [{"title": pl.title, "uuid": pl.uuid}]
+        if _submit_playlists(transport, submission, capabilities) is None:
+            continue
+        results = [
+            offer_and_upload(transport, batch, capabilities, normaliser)
+            for batch in batches
+        ]
+        if all(results):
+            manifest.record_playlist(pl.file, pl.snapshot)
+
+
+def submit(transport, pls, find_albums, manifest, capabilities, normaliser=None):
+    # Offer the playlists, or if the server can tell, only those that differ
+    if len(pls) == 0:
+        return
+    if "sync" in capabilities:
+        _sync_playlists(transport, pls, find_albums, manifest, capabilities, normaliser)
+    else:
+        offer_playlists(transport, pls, find_albums, manifest, capabilities, normaliser)
+
+
+def _load_manifest(url, root_dir, full):
+    # A full run submits every playlist in root_dir and searches for every cover
+    # again, but leaves what runs on other roots recorded
+    manifest = Manifest(url).load()
+    if full:
+        manifest.forget_playlists(root_dir)
+        manifest.forget_covers()
+    manifest.forget_missing_playlists(root_dir)
+    return manifest
+
+
+def run_client(root, url, full=False, watch=False, watch_covers=False):
+    start = monotonic()
     root_dir = Path(root)
     if not root_dir.exists():
         exit(f"Root directory {root} does not exist!")
-    pls = _find_playlists(root_dir)
-    pl_submissions = [
-        {"title": pl.meta["title"], "uuid": pl.meta[UUID_KEY]} for pl in pls
-    ]
-    _submit_playlists(url, pl_submissions)
-    logging.info(f"Submitted {len(pl_submissions)} playlists")
-    for pl in pls:
-        for candidate_batch in batched(
-            _find_albums_in_playlist(pl), config["batch_size"]
+    watcher = None
+    if watch:
+        from .watch import Watcher
+
+        # Watch before the first scan, so that no change made during it is missed
+        try:
+            watcher = Watcher(root_dir, covers=watch_covers)
+        except OSError as e:
+            exit(f"Cannot watch {root}: {e}")
+    manifest = _load_manifest(url, root_dir, full)
+    ids = PlaylistIds().load()
+    with Transport(url, config.get("transport", {})) as transport:
+        capabilities = _get_capabilities(transport)
+        changed = _find_playlists(root_dir, manifest)
+        if len(changed) == 0:
+            logging.info("No playlists have changed since the last run")
+            if watcher is None:
+                manifest.save()
+                return
+        with (
+            CoverFetcher(config.get("musicbrainz", {})) as fetcher,
+            CoverNormaliser(config.get("normalise_covers", {})) as normaliser,
         ):
-            _offer_and_upload(url, candidate_batch)
+            find_albums = partial(
+                _find_albums_in_playlist, manifest=manifest, fetcher=fetcher
+            )
+            if watcher is not None:
+                find_albums = watcher.remembering(find_albums)
+            if len(changed) > 0:
+                pls = list(read_playlists(changed, ids))
+                ids.save()
+                submit(transport, pls, find_albums, manifest, capabilities, normaliser)
+            manifest.save()
+            normaliser.log_savings()
+            _log_resource_usage(start)
+            if watcher is not None:
+                watcher.run(transport, manifest, ids, capabilities, normaliser)
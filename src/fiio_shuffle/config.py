@@ -4,22 +4,36 @@ from logging import error, warning
 from os import umask
 from secrets import token_hex
 from sys import exit
+from threading import Lock
 
 from .utils import deep_update, get_config_dir
 
 
 class Config:
+    # The configuration is read on first use rather than on import, so that merely
+    # importing a module that uses it costs nothing
     def __init__(self):
+        self._config = None
+        self._lock = Lock()
+
+    def _get(self):
+        if self._config is None:
+            with self._lock:
+                if self._config is None:
+                    self._config = self._load()
+        return self._config
+
+    def _load(self):
         config_file = get_config_dir() / "config.json"
 
         # Load default configuration
         with files("fiio_shuffle").joinpath("config.json").open() as f:
-            self._config = load(f)
+            conf = load(f)
 
         try:
             with config_file.open() as f:
                 cfg = load(f)
-                self._config = deep_update(self._config, cfg)
+                conf = deep_update(conf, cfg)
         except (IOError, FileNotFoundError) as e:
             warning(
                 f"Could not read config from {config_file}: {e}; falling back on default."
@@ -28,13 +42,13 @@ class Config:
             error(f"Malformed JSON in {config_file}: {e}")
             exit()
 
-        if "auth_key" not in self._config.keys():
+        if "auth_key" not in conf.keys():
             warning(
                 f"No authentication key in {config_file}. Generating one for you..."
             )
             token = token_hex()
             warning(f"Your authentication key is: {token}. Saving to {config_file}...")
-            self._config["auth_key"] = token
+            conf["auth_key"] = token
             d = config_file.parent
             if not d.exists():
                 from os import makedirs
@@ -46,14 +60,15 @@ class Config:
                     exit()
             um = umask(0o177)
             with config_file.open("w") as f:
-                dump(self._config, f, indent=4)
+                dump(conf, f, indent=4)
             umask(um)
+        return conf
 
     def __getitem__(self, key):
-        return self._config[key]
+        return self._get()[key]
 
     def get(self, key, default=None):
-        return self._config.get(key, default)
+        return self._get().get(key, default)
 
 
 config = Config()
@@ -1,16 +1,24 @@
 from datetime import datetime
+from functools import partial
+from os import utime
 from pathlib import Path
-from uuid import UUID, uuid4
+from uuid import UUID
 
 import magic
-from sqlalchemy import func, select, delete
+from sqlalchemy import bindparam, delete, select, true, tuple_, update
 from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
 
+from .album_index import album_index
+from .covers import SNIFF_SIZE, CoverSpool, cover_path, make_variants, store_cover
 from .db import with_db
-from .models import Album, AlbumInPlaylist, Cover, Offer, Playlist
-from .utils import JSONResponse, JSONResponseError, get_data_dir
+from .generation import generation
+from .metrics import ALBUMS_ACCEPTED, ALBUMS_OFFERED, COVERS_UPLOADED, STAGE_DURATION
+from .models import Album, AlbumInPlaylist, Cover, Offer, Playlist, PlaylistDigest
+from .sync import EMPTY_DIGEST, add_entries, remove_entries
+from .utils import JSONResponse, JSONResponseError
 
 
 @with_db
@@ -20,20 +28,30 @@ def get_all_playlists(db, session):
 
 
 @with_db
-def get_random_album(playlists, db, session):
-    n_albums = session.query(func.count(Album.id)).scalar()
-    if n_albums == 0:
+def get_random_album(playlists, db, session, shuffle="deck"):
+    # "deck" goes through every album in turn before repeating one, "random" picks
+    # independently every time
+    if shuffle == "random":
+        album_id = album_index.pick(playlists, session)
+    else:
+        album_id = album_index.deal(playlists, session)
+    if album_id is None:
         return None
 
-    uuids = [UUID(pl) for pl in playlists]
+    return session.get(Album, album_id, options=[joinedload(Album.cover)])
 
-    q = select(Album).options(joinedload(Album.cover)).join(Album.playlists)
-    if len(uuids) != 0:
-        q = q.filter(Playlist.uuid.in_(uuids))
-    q = q.group_by(Album.id).order_by(func.random()).limit(1)
-    album = session.execute(q).scalar()
 
-    return album
+@with_db
+def get_random_albums(playlists, count, db, session, shuffle="deck"):
+    # Like get_random_album, but for the next count albums, fetched in one query
+    if shuffle == "random":
+        album_ids = [album_index.pick(playlists, session) for _ in range(count)]
+    else:
+        album_ids = [album_index.deal(playlists, session) for _ in range(count)]
+    album_ids = [album_id for album_id in album_ids if album_id is not None]
+    q = select(Album).options(joinedload(Album.cover)).where(Album.id.in_(album_ids))
+    albums = {album.id: album for album in session.execute(q).scalars()}
+    return [albums[album_id] for album_id in album_ids if album_id in albums]
 
 
 @with_db
@@ -43,28 +61,34 @@ def process_offers(request, db, session):
     # The database engine will optimise for us!
     try:
         temp_albs = [
-            Offer(
-                artist=a["artist"],
-                title=a["title"],
-                year=a["year"],
-                timestamp=datetime.fromtimestamp(a["timestamp"]),
-                playlist_uuid=UUID(a["playlist_uuid"]),
-            )
+            {
+                "artist": a["artist"],
+                "title": a["title"],
+                "year": a["year"],
+                "timestamp": datetime.fromtimestamp(a["timestamp"]),
+                "playlist_uuid": UUID(a["playlist_uuid"]),
+            }
             for a in request["albums"]
         ]
-    except KeyError as e:
+    except (KeyError, TypeError, ValueError) as e:
         return JSONResponseError(f"Invalid data: {e}")
 
-    session.bulk_save_objects(temp_albs)
+    # The offers table lives as long as the pooled connection, so clear out whatever
+    # an earlier request left behind.
+    session.execute(delete(Offer))
+    if len(temp_albs) == 0:
+        session.commit()
+        return JSONResponse({"albums": []}, True)
+    session.execute(insert(Offer), temp_albs)
+
+    same_album = (
+        (Album.artist == Offer.artist)
+        & (Album.title == Offer.title)
+        & (Album.year == Offer.year)
+    )
     q = (
-        select(Offer.artist, Offer.title, Offer.year, Album.id)
-        .join(
-            Album,
-            (Album.artist == Offer.artist)
-            & (Album.title == Offer.title)
-            & (Album.year == Offer.year),
-            isouter=True,
-        )
+        select(Offer.artist, Offer.title, Offer.year, Offer.playlist_uuid)
+        .join(Album, same_album, isouter=True)
         .join(Cover, Album.cover_id == Cover.id, isouter=True)
         .where(
             (Album.id == None)  # noqa: E711
@@ -72,40 +96,63 @@ def process_offers(request, db, session):
             | (Offer.timestamp > Cover.added)
         )
     )
-    create_albums = [
-        {
-            "artist": a["artist"],
-            "title": a["title"],
-            "year": a["year"],
-            "added": datetime.fromtimestamp(a["timestamp"]),
-        }
-        for a in request["albums"]
-    ]
-    stmt = insert(Album).values(create_albums).on_conflict_do_nothing()
+
+    # SQLite needs a WHERE clause to tell the ON of an upsert from the ON of a join
+    # when inserting from a SELECT, hence the where(true()) below.
+    # https://www.sqlite.org/lang_upsert.html#parsing_ambiguity
+    stmt = (
+        insert(Album)
+        .from_select(
+            ["artist", "title", "year", "added"],
+            select(Offer.artist, Offer.title, Offer.year, Offer.timestamp).where(
+                true()
+            ),
+        )
+        .on_conflict_do_nothing()
+    )
     session.execute(stmt)
 
-    albs = (
-        select(Album, Playlist)
-        .join(
-            Offer,
-            (Album.artist == Offer.artist)
-            & (Album.title == Offer.title)
-            & (Album.year == Offer.year),
+    stmt = (
+        insert(AlbumInPlaylist)
+        .from_select(
+            ["album_id", "playlist_uuid"],
+            select(Album.id, Playlist.uuid)
+            .join(Offer, same_album)
+            .join(Playlist, Playlist.uuid == Offer.playlist_uuid)
+            .where(true()),
         )
-        .join(Playlist, (Playlist.uuid == Offer.playlist_uuid))
+        .on_conflict_do_nothing()
     )
-    for a in session.execute(albs):
-        if a.Playlist not in a.Album.playlists:
-            a[0].playlists.append(a.Playlist)
-    out = [
-        {
-            "artist": a.artist,
-            "title": a.title,
-            "year": a.year,
-        }
-        for a in session.execute(q)
-    ]
+    session.execute(stmt)
+
+    # Albums the client need not upload are now known to the server as they are to
+    # the client, so they count towards the playlist digests. Accepted albums count
+    # once their covers are uploaded, so that a failed upload shows up as a
+    # difference the next time the client syncs.
+    accepted = {tuple(row) for row in session.execute(q)}
+    out = []
+    settled = {}
+    for a, temp in zip(request["albums"], temp_albs):
+        key = (temp["artist"], temp["title"], temp["year"], temp["playlist_uuid"])
+        if key in accepted:
+            out.append(
+                {
+                    "artist": a["artist"],
+                    "title": a["title"],
+                    "year": a["year"],
+                    "timestamp": a["timestamp"],
+                    "playlist_uuid": a["playlist_uuid"],
+                }
+            )
+        else:
+            settled.setdefault(temp["playlist_uuid"], []).append(
+                (a["artist"], a["title"], a["year"], a["timestamp"])
+            )
+    _count_in_digests(settled, session)
     session.commit()
+    generation.bump()
+    ALBUMS_OFFERED.inc(amount=len(temp_albs))
+    ALBUMS_ACCEPTED.inc(amount=len(out))
 
     return JSONResponse({"albums": out}, True)
 
@@ -125,12 +172,153 @@ def process_playlists(request, db, session):
     uuids = [pl["uuid"] for pl in pls]
     stmt = delete(AlbumInPlaylist).where(AlbumInPlaylist.c.playlist_uuid.in_(uuids))
     session.execute(stmt)
+    # The client offers every album in the playlist again after this
+    stmt = (
+        insert(PlaylistDigest)
+        .values([{"playlist_uuid": u, "digest": EMPTY_DIGEST} for u in uuids])
+        .on_conflict_do_update(
+            index_elements=[PlaylistDigest.playlist_uuid],
+            set_={"digest": EMPTY_DIGEST},
+        )
+    )
+    session.execute(stmt)
+
+    session.commit()
+    generation.bump()
 
+    return JSONResponse({}, True)
+
+
+@with_db
+def compare_digests(request, db, session):
+    # Tells the client which of its playlists differ from what the server has, so
+    # that it need only offer those
+    try:
+        theirs = [
+            (pl["uuid"], UUID(pl["uuid"]), pl["digest"]) for pl in request["playlists"]
+        ]
+    except (KeyError, TypeError, ValueError) as e:
+        return JSONResponseError(f"Invalid data: {e}")
+    q = select(PlaylistDigest.playlist_uuid, PlaylistDigest.digest).where(
+        PlaylistDigest.playlist_uuid.in_([uuid for _, uuid, _ in theirs])
+    )
+    ours = {uuid: digest for uuid, digest in session.execute(q)}
+    differing = [sent for sent, uuid, digest in theirs if ours.get(uuid) != digest]
+    return JSONResponse({"playlists": differing}, True)
+
+
+@with_db
+def withdraw_albums(request, db, session):
+    # Takes albums out of playlists without resubmitting the playlists, for clients
+    # that send only what changed. The albums themselves, and their covers, stay.
+    withdrawn = {}
+    try:
+        for a in request["albums"]:
+            key = (a["artist"], a["title"], int(a["year"]))
+            withdrawn.setdefault(UUID(a["playlist_uuid"]), []).append(key)
+    except (KeyError, TypeError, ValueError) as e:
+        return JSONResponseError(f"Invalid data: {e}")
+
+    # Members count towards the digest as they were counted, whatever timestamp
+    # the client sends now, and albums that are already gone are not counted out
+    # again
+    deltas = {}
+    for uuid, keys in withdrawn.items():
+        members = session.execute(_members(uuid, keys)).all()
+        stmt = delete(AlbumInPlaylist).where(
+            (AlbumInPlaylist.c.playlist_uuid == uuid)
+            & AlbumInPlaylist.c.album_id.in_([album_id for album_id, *_ in members])
+        )
+        session.execute(stmt)
+        deltas[uuid] = (
+            [],
+            [
+                (artist, title, year, counted)
+                for _, artist, title, year, counted in members
+                if counted is not None
+            ],
+        )
+    _update_digests(deltas, session)
     session.commit()
+    generation.bump()
 
     return JSONResponse({}, True)
 
 
+def _members(uuid, keys):
+    # The albums of the playlist uuid with the given (artist, title, year) keys, and
+    # the timestamps they count towards its digest with
+    return (
+        select(
+            Album.id,
+            Album.artist,
+            Album.title,
+            Album.year,
+            AlbumInPlaylist.c.digest_timestamp,
+        )
+        .join(AlbumInPlaylist, AlbumInPlaylist.c.album_id == Album.id)
+        .where(
+            (AlbumInPlaylist.c.playlist_uuid == uuid)
+            & tuple_(Album.artist, Album.title, Album.year).in_(keys)
+        )
+    )
+
+
+def _count_in_digests(entries, session):
+    # entries maps playlist UUIDs to lists of (artist, title, year, timestamp) that
+    # the server now has as the client does. The digest of a playlist is the sum
+    # over its members of the entries recorded on their rows, so an entry that is
+    # sent again changes nothing, one with a new timestamp replaces the old, and
+    # one for an album that is not in the playlist is left out.
+    deltas = {}
+    counted = []
+    for uuid, sent in entries.items():
+        timestamps = {
+            (artist, title, int(year)): int(timestamp)
+            for artist, title, year, timestamp in sent
+        }
+        added, removed = [], []
+        members = session.execute(_members(uuid, list(timestamps)))
+        for album_id, artist, title, year, old in members:
+            timestamp = timestamps[(artist, title, year)]
+            if old == timestamp:
+                continue
+            if old is not None:
+                removed.append((artist, title, year, old))
+            added.append((artist, title, year, timestamp))
+            counted.append(
+                {"member": album_id, "playlist": uuid, "timestamp": timestamp}
+            )
+        deltas[uuid] = (added, removed)
+    if len(counted) > 0:
+        stmt = (
+            update(AlbumInPlaylist)
+            .where(
+                (AlbumInPlaylist.c.album_id == bindparam("member"))
+                & (AlbumInPlaylist.c.playlist_uuid == bindparam("playlist"))
+            )
+            .values(digest_timestamp=bindparam("timestamp"))
+        )
+        session.execute(stmt, counted)
+    _update_digests(deltas, session)
+
+
+def _update_digests(deltas, session):
+    # deltas maps playlist UUIDs to the entries to add to and remove from their
+    # digests, as (added, removed) pairs
+    deltas = {uuid: d for uuid, d in deltas.items() if d != ([], [])}
+    if len(deltas) == 0:
+        return
+    q = select(PlaylistDigest).where(PlaylistDigest.playlist_uuid.in_(deltas))
+    digests = {d.playlist_uuid: d for d in session.execute(q).scalars()}
+    for uuid, (added, removed) in deltas.items():
+        digest = digests.get(uuid)
+        if digest is None:
+            digest = PlaylistDigest(playlist_uuid=uuid, digest=EMPTY_DIGEST)
+            session.add(digest)
+        digest.digest = add_entries(remove_entries(digest.digest, removed), added)
+
+
 def _album_from_data(data, session):
     now = datetime.now()
     q = select(Album).where(
@@ -139,42 +327,163 @@ def _album_from_data(data, session):
         & (Album.year == data["year"])
     )
     album = session.execute(q).scalar()
-    return album or Album(added=now, **data)
+    return album or Album(
+        added=now, artist=data["artist"], title=data["title"], year=data["year"]
+    )
 
 
-@with_db
-def upload_cover(cover_file, metadata, db, session):
-    # Validate the cover before running any DB queries
-    metadata = metadata["data"]
-    try:
-        buf = cover_file.read(2048)
+def _check_cover(cover_file):
+    stream = getattr(cover_file, "stream", None)
+    if isinstance(stream, CoverSpool):
+        buf = stream.head
+    else:
+        buf = cover_file.read(SNIFF_SIZE)
         cover_file.seek(0)
+    with STAGE_DURATION.time("check_cover"):
         mime_type = magic.from_buffer(buf, mime=True)
-        if not mime_type.startswith("image/"):
-            raise ValueError(mime_type)
-    except KeyError:
-        return JSONResponseError("No cover file provided")
-    except ValueError:
-        return JSONResponseError(f"Cover is not an image, but of MIME type {mime_type}")
+    if not mime_type.startswith("image/"):
+        raise ValueError(f"Cover is not an image, but of MIME type {mime_type}")
 
+
+def _store_cover(cover_file, data):
+    # Checks data and writes the file, before anything touches the session, so that
+    # a failed write leaves nothing behind to be committed
     try:
-        album = _album_from_data(metadata, session)
-    except (KeyError, TypeError) as e:
-        return JSONResponseError(f"Invalid data: {e}.")
-    if album is None:
-        return JSONResponseError("")
+        key = (data["artist"], data["title"], data["year"])
+        # Clients that sync by digest send back what they offered
+        entry = None
+        if "timestamp" in data and "playlist_uuid" in data:
+            entry = (UUID(data["playlist_uuid"]), (*key, data["timestamp"]))
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid data: {e}.")
 
     ext = Path(cover_file.filename).suffix
+    with STAGE_DURATION.time("store_cover"):
+        cover_uuid, path, created = store_cover(cover_file, ext)
+    return cover_uuid, ext, path, created, entry
+
+
+def _record_cover(stored, data, session):
+    # Points the album at a stored cover. The caller commits, and is told whether
+    # the file is new so that it can clean up if the commit fails.
+    cover_uuid, ext, path, created, entry = stored
+    album = _album_from_data(data, session)
     now = datetime.now()
-    cover = Cover(added=now, uuid=uuid4(), extension=ext)
-    session.add(cover)
+    q = select(Cover).where(Cover.uuid == cover_uuid).limit(1)
+    cover = session.execute(q).scalar()
+    if cover is not None and cover.extension != ext:
+        # Identical bytes are already stored under another extension. Touch that
+        # file, as storing ours did ours, so that the garbage collector sees it is
+        # in use again; if the collector has just removed it, keep ours instead.
+        try:
+            utime(cover_path(cover))
+        except FileNotFoundError:
+            cover = None
+        else:
+            if created:
+                path.unlink()
+                created = False
+            path = cover_path(cover)
+    if cover is None:
+        cover = Cover(added=now, uuid=cover_uuid, extension=ext)
+        session.add(cover)
+    else:
+        cover.added = now
     album.cover = cover
     session.add(album)
+    if entry is not None:
+        playlist_uuid, entry = entry
+        _count_in_digests({playlist_uuid: [entry]}, session)
+    return path, created
+
+
+def _commit_covers(session, record):
+    # Runs record, which adds covers to the session, and commits. The garbage
+    # collector may delete a cover that record found before the commit updates it;
+    # record is then run once more, and finds it gone. Once stored again, a cover
+    # is safe from the collector for its grace period.
+    for attempt in range(2):
+        try:
+            result = record()
+            with STAGE_DURATION.time("commit"):
+                session.commit()
+            return result
+        except StaleDataError:
+            session.rollback()
+            if attempt == 1:
+                raise
+
+
+def _make_variants(paths):
+    # Resizing takes a while, so it is left until the response has been sent
+    for path in paths:
+        with STAGE_DURATION.time("make_variants"):
+            make_variants(path)
+
+
+@with_db
+def upload_cover(cover_file, metadata, db, session):
+    # Validate the cover before running any DB queries
+    metadata = metadata["data"]
     try:
-        cover_file.save((get_data_dir() / "covers" / str(cover.uuid)).with_suffix(ext))
-        session.commit()
+        _check_cover(cover_file)
+        stored = _store_cover(cover_file, metadata)
+        path, _ = _commit_covers(
+            session, lambda: _record_cover(stored, metadata, session)
+        )
+        generation.bump()
+    except ValueError as e:
+        return JSONResponseError(str(e))
     except (FileNotFoundError, IOError) as e:
         return JSONResponseError(f"Could not save cover file: {e}")
     except IntegrityError as e:
         return JSONResponseError(str(e))
-    return JSONResponse({"success": True})
+    COVERS_UPLOADED.inc()
+    response = JSONResponse({"success": True})
+    response.call_on_close(partial(_make_variants, [path]))
+    return response
+
+
+@with_db
+def upload_covers(cover_files, metadata, db, session):
+    # Like upload_cover, but for many covers in one transaction. Each cover is
+    # validated and saved on its own, and gets its own entry in the results.
+    try:
+        items = metadata["data"]
+    except KeyError as e:
+        return JSONResponseError(f"Invalid data: {e}")
+    if len(items) != len(cover_files):
+        return JSONResponseError(
+            f"Got metadata for {len(items)} covers, but {len(cover_files)} covers"
+        )
+
+    results = []
+    stored = []
+    for data, cover_file in zip(items, cover_files):
+        try:
+            _check_cover(cover_file)
+            stored.append((_store_cover(cover_file, data), data))
+        except ValueError as e:
+            results.append({"success": False, "message": str(e)})
+        except (FileNotFoundError, IOError) as e:
+            results.append(
+                {"success": False, "message": f"Could not save cover file: {e}"}
+            )
+        else:
+            results.append({"success": True})
+
+    def record():
+        return [_record_cover(s, data, session) for s, data in stored]
+
+    try:
+        recorded = _commit_covers(session, record)
+    except IntegrityError as e:
+        for (_, _, path, created, _), _ in stored:
+            if created:
+                path.unlink(missing_ok=True)
+        return JSONResponseError(str(e))
+    generation.bump()
+    COVERS_UPLOADED.inc(amount=len(recorded))
+    response = JSONResponse({"results": results})
+    response.call_on_close(partial(_make_variants, [path for path, _ in recorded]))
+    return response
@@ -0,0 +1,385 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+from hashlib import sha256
+from io import BytesIO
+from logging import info, warning
+from os import link, makedirs, replace, scandir
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkstemp
+from time import sleep, time
+from uuid import UUID
+
+from sqlalchemy import delete, exists, select
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from .config import config
+from .metrics import COVER_BYTES_WRITTEN
+from .models import Album, Cover
+from .utils import get_data_dir
+
+CHUNK_SIZE = 64 * 1024
+# Uploads are kept in memory up to this size, see CoverSpool
+SPOOL_MEMORY_SIZE = 64 * 1024
+# Enough of a file to tell its type
+SNIFF_SIZE = 2048
+# Files are written to the covers directory before the transaction that refers to
+# them commits, so the garbage collector leaves covers and files that were stored
+# more recently than this alone.
+GRACE_PERIOD = 60 * 60
+GRACE = timedelta(seconds=GRACE_PERIOD)
+# Formats that variants can be made in, by the names they may be configured with
+VARIANT_FORMATS = {
+    "webp": ("WEBP", ".webp"),
+    "jpeg": ("JPEG", ".jpg"),
+    "jpg": ("JPEG", ".jpg"),
+    "png": ("PNG", ".png"),
+}
+
+
+def get_covers_dir():
+    return get_data_dir() / "covers"
+
+
+def cover_path(cover):
+    return get_covers_dir() / (str(cover.uuid) + cover.extension)
+
+
+def get_variants_dir(uuid):
+    return get_covers_dir() / str(uuid)
+
+
+def cover_variants(cover):
+    """List the resized variants of a cover as (width, filename) pairs, smallest
+    first. Covers whose variants have not been generated have none."""
+    try:
+        names = [e.name for e in scandir(get_variants_dir(cover.uuid))]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    variants = []
+    for name in names:
+        width, _, _ = name.partition(".")
+        if width.isdigit():
+            variants.append((int(width), name))
+    return sorted(variants)
+
+
+def variant_urls(cover):
+    return [
+        {"width": width, "url": f"covers/{cover.uuid}/{name}"}
+        for width, name in cover_variants(cover)
+    ]
+
+
+@lru_cache
+def _variant_format(name):
+    # Cached, so that a bad configuration is only warned about once
+    try:
+        return VARIANT_FORMATS[name.lower()]
+    except (KeyError, AttributeError):
+        warning(f"Cannot make variants in format {name}, making WebP ones instead")
+        return VARIANT_FORMATS["webp"]
+
+
+def make_variants(path):
+    """Generate resized, re-encoded copies of the cover at path.
+
+    One variant is made for every configured width narrower than the cover, plus
+    one at the cover's own width if it is narrower than the widest, so that the
+    variants together cover every size the original does. Needs Pillow; without
+    it, no variants are made and the original is served instead.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return []
+
+    cfg = config.get("thumbnails", {})
+    widths = sorted(cfg.get("widths", []))
+    fmt, ext = _variant_format(cfg.get("format", "webp"))
+    options = {"quality": cfg.get("quality", 80)}
+    if fmt == "JPEG":
+        options |= {"progressive": True, "optimize": True}
+
+    d = get_variants_dir(path.stem)
+    if d.exists():
+        # Covers are stored by content, so existing variants are up to date
+        return []
+    try:
+        with Image.open(path) as im:
+            im = im.convert("RGB")
+            targets = [w for w in widths if w < im.width]
+            if len(widths) != 0 and im.width < widths[-1]:
+                targets.append(im.width)
+            tmp = d.with_name("." + d.name)
+            makedirs(tmp, exist_ok=True)
+            made = []
+            for width in targets:
+                height = max(1, round(im.height * width / im.width))
+                resized = im.resize((width, height), Image.LANCZOS)
+                resized.save(tmp / f"{width}{ext}", fmt, **options)
+                made.append(width)
+            replace(tmp, d)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        warning(f"Could not make variants of {path}: {e}")
+        return []
+    return made
+
+
+def make_all_variants(db):
+    """Generate variants for every cover that does not have them yet."""
+    with db.session() as session:
+        covers = list(session.execute(select(Cover)).scalars())
+    n = 0
+    for cover in covers:
+        if len(make_variants(cover_path(cover))) != 0:
+            n += 1
+    info(f"Made variants of {n} covers")
+    return n
+
+
+def content_uuid(digest):
+    """Name a cover by its content: the first 128 bits of its SHA-256."""
+    return UUID(bytes=digest[:16])
+
+
+class CoverSpool:
+    """Where a file in an upload is written to as it streams in.
+
+    The file is hashed as it arrives, and its first SNIFF_SIZE bytes are kept for
+    telling its type. Up to SPOOL_MEMORY_SIZE bytes it is kept in memory, beyond
+    that it goes to a temporary file in the covers directory, so that storing it is
+    a rename. Files larger than max_size are refused. See UploadRequest in
+    server.py.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.head = b""
+        self.path = None
+        self._hash = sha256()
+        self._file = BytesIO()
+
+    def __getattr__(self, name):
+        # read, seek and the like, for werkzeug
+        return getattr(self._file, name)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.close()
+            raise RequestEntityTooLarge(f"Covers may be at most {self.max_size} bytes")
+        if len(self.head) < SNIFF_SIZE:
+            self.head += data[: SNIFF_SIZE - len(self.head)]
+        self._hash.update(data)
+        if self.path is None and self.size > SPOOL_MEMORY_SIZE:
+            self._roll_over()
+        return self._file.write(data)
+
+    def _roll_over(self):
+        d = get_covers_dir()
+        makedirs(d, exist_ok=True)
+        fd, tmp = mkstemp(dir=d, prefix=".upload-")
+        f = open(fd, "w+b")
+        f.write(self._file.getvalue())
+        self._file = f
+        self.path = Path(tmp)
+
+    def store(self, ext):
+        if self.path is None:
+            self._roll_over()
+        self._file.flush()
+        uuid = content_uuid(self._hash.digest())
+        path = get_covers_dir() / (str(uuid) + ext)
+        created = not path.exists()
+        replace(self.path, path)
+        self.path = None
+        COVER_BYTES_WRITTEN.inc(amount=self.size)
+        return uuid, path, created
+
+    def close(self):
+        self._file.close()
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
+            self.path = None
+
+
+def store_cover(cover_file, ext):
+    """Copy cover_file into the cover store, hashing it while it streams in.
+
+    Covers are stored under a UUID derived from their content, so identical images
+    share one file. Returns the UUID, the path, and whether the file is new.
+    """
+    stream = getattr(cover_file, "stream", None)
+    if isinstance(stream, CoverSpool):
+        # Already hashed and written out while it was uploaded
+        return stream.store(ext)
+
+    d = get_covers_dir()
+    makedirs(d, exist_ok=True)
+    fd, tmp = mkstemp(dir=d, prefix=".upload-")
+    try:
+        h = sha256()
+        with open(fd, "wb") as f:
+            while chunk := cover_file.read(CHUNK_SIZE):
+                h.update(chunk)
+                f.write(chunk)
+            size = f.tell()
+        uuid = content_uuid(h.digest())
+        path = d / (str(uuid) + ext)
+        created = not path.exists()
+        # Replacing an existing file with identical bytes is harmless, and unlike
+        # unlinking it leaves no window in which the file is missing. It also
+        # refreshes the file's mtime, which keeps the garbage collector off it.
+        replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    COVER_BYTES_WRITTEN.inc(amount=size)
+    return uuid, path, created
+
+
+def _recently_written(path, now):
+    try:
+        return now - path.stat().st_mtime < GRACE_PERIOD
+    except FileNotFoundError:
+        return False
+
+
+def _remove_cover_file(path):
+    # Uploads store a cover by writing its file, and so refresh its mtime, before
+    # they look for its row. The file is moved aside before its mtime is looked at,
+    # so that an upload of the same bytes either came before the move, and shows in
+    # the mtime, or comes after it and is left alone. Returns whether it was removed.
+    aside = path.with_name(".gc-" + path.name)
+    try:
+        replace(path, aside)
+    except FileNotFoundError:
+        return False
+    if _recently_written(aside, time()):
+        # Stored again since its row was deleted; put it back, unless it has been
+        # stored yet again in the meantime
+        try:
+            link(aside, path)
+        except FileExistsError:
+            pass
+        aside.unlink()
+        return False
+    aside.unlink()
+    return True
+
+
+def _collect_covers(db, batch_size, pause):
+    # Covers are only collected once they, and their files, have gone unused for
+    # the grace period: an upload refreshes both when it stores the same bytes
+    # again, see _record_cover in controllers.py.
+    unreferenced = ~exists().where(Album.cover_id == Cover.id)
+    n = 0
+    last_id = 0
+    while True:
+        now = time()
+        old = unreferenced & (Cover.added < datetime.now() - GRACE)
+        removable = []
+        with db.session() as session:
+            q = (
+                select(Cover.id, Cover.uuid, Cover.extension)
+                .where((Cover.id > last_id) & old)
+                .order_by(Cover.id)
+                .limit(batch_size)
+            )
+            candidates = list(session.execute(q))
+            if len(candidates) == 0:
+                break
+            last_id = candidates[-1].id
+            ids = [
+                c.id
+                for c in candidates
+                if not _recently_written(cover_path(c), now)
+            ]
+            # Check again when deleting, in case an upload has claimed a cover since.
+            # The delete takes the write lock, so none can until this commits.
+            stmt = (
+                delete(Cover)
+                .where(Cover.id.in_(ids) & old)
+                .returning(Cover.uuid, Cover.extension)
+            )
+            deleted = list(session.execute(stmt))
+            for uuid, ext in deleted:
+                shared = session.execute(
+                    select(Cover.id).where(Cover.uuid == uuid).limit(1)
+                ).scalar()
+                if shared is None:
+                    removable.append((uuid, ext))
+            session.commit()
+        for uuid, ext in removable:
+            if _remove_cover_file(get_covers_dir() / (str(uuid) + ext)):
+                rmtree(get_variants_dir(uuid), ignore_errors=True)
+        n += len(deleted)
+        sleep(pause)
+    return n
+
+
+def _collect_files(db, batch_size, pause):
+    d = get_covers_dir()
+    if not d.exists():
+        return 0
+    n = 0
+    now = time()
+    batch = []
+
+    def collect(batch):
+        uuids = [uuid for uuid, _ in batch]
+        with db.session() as session:
+            q = select(Cover.uuid, Cover.extension).where(Cover.uuid.in_(uuids))
+            known = set(str(uuid) + ext for uuid, ext in session.execute(q))
+        removed = 0
+        for uuid, entry in batch:
+            if entry.is_dir():
+                # Variants, which belong to any cover with the right UUID
+                if not any(name.startswith(str(uuid)) for name in known):
+                    rmtree(d / entry.name, ignore_errors=True)
+                    removed += 1
+            elif entry.name not in known:
+                d.joinpath(entry.name).unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    with scandir(d) as it:
+        for entry in it:
+            if now - entry.stat().st_mtime < GRACE_PERIOD:
+                continue
+            if entry.name.startswith("."):
+                # An upload or set of variants that never finished
+                if entry.is_dir():
+                    rmtree(d / entry.name, ignore_errors=True)
+                else:
+                    d.joinpath(entry.name).unlink(missing_ok=True)
+                n += 1
+                continue
+            try:
+                uuid = UUID(entry.name.split(".", 1)[0])
+            except ValueError:
+                continue
+            batch.append((uuid, entry))
+            if len(batch) == batch_size:
+                n += collect(batch)
+                batch = []
+                sleep(pause)
+    if len(batch) != 0:
+        n += collect(batch)
+    return n
+
+
+def collect_garbage(db, batch_size=100, pause=0.1):
+    """Remove covers that no album refers to, and files that no cover refers to.
+
+    Works in small batches with a pause in between, each in its own short
+    transaction, so that a running server is never locked out of the database for
+    long.
+    """
+    n_covers = _collect_covers(db, batch_size, pause)
+    info(f"Removed {n_covers} unused covers")
+    n_files = _collect_files(db, batch_size, pause)
+    info(f"Removed {n_files} orphaned files")
+    return n_covers, n_files
@@ -1,38 +1,88 @@
 from logging import error
-from os import makedirs
+from os import getpid, makedirs, register_at_fork
 from sys import exit
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
 
 from .config import config
+from .migrations import migrate
 from .models import Base
 from .utils import get_data_dir
 
 
 class Database:
-    def __init__(self, echo=False):
+    def __init__(self, echo=False, pool=None):
         # db_path needs to be absolute so we known the right number of slashes to use on the next line
         # see https://docs.sqlalchemy.org/en/13/core/engines.html#sqlite
         db_path = (get_data_dir() / "fiio_shuffle.sqlite3").resolve()
+        pool = pool or {}
         try:
             makedirs(db_path.parent, exist_ok=True)
         except IOError as e:
             error(f"Could not create DB directory {db_path.parent}: {e}")
             exit()
         try:
-            self.engine = create_engine(f"sqlite:///{db_path}", echo=echo)
-            Base.metadata.create_all(self.engine)
+            self.engine = create_engine(f"sqlite:///{db_path}", echo=echo, **pool)
+            event.listen(self.engine, "connect", self._set_pragmas)
+            event.listen(self.engine, "connect", self._create_temporary_tables)
+            migrate(self.engine)
         except Exception as e:
             error(f"Could not initialise ORM models: {e}")
             exit()
+        self._sessionmaker = sessionmaker(self.engine)
+        self.pid = getpid()
+
+    def _set_pragmas(self, dbapi_connection, connection_record):
+        # With a write-ahead log readers do not block the writer or each other, and
+        # it is safe to only sync at checkpoints.
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.close()
+
+    def _create_temporary_tables(self, dbapi_connection, connection_record):
+        # Temporary tables only exist on the connection that created them, so every
+        # pooled connection needs its own copy.
+        cursor = dbapi_connection.cursor()
+        for table in Base.metadata.sorted_tables:
+            if "TEMPORARY" not in table._prefixes:
+                continue
+            ddl = CreateTable(table, if_not_exists=True)
+            cursor.execute(str(ddl.compile(dialect=self.engine.dialect)))
+        cursor.close()
 
     def session(self):
-        return Session(self.engine)
+        return self._sessionmaker()
+
+    def after_fork(self):
+        # Connections inherited from the parent must not be used by the child, but
+        # closing them would also close them for the parent.
+        self.engine.dispose(close=False)
+        self.pid = getpid()
+
+
+_db = None
 
 
 def get_db():
-    return Database(echo=config.get("debug", False))
+    global _db
+    if _db is None:
+        _db = Database(
+            echo=config.get("debug", False), pool=config.get("database", {})
+        )
+    elif _db.pid != getpid():
+        _db.after_fork()
+    return _db
+
+
+def _after_fork_in_child():
+    if _db is not None:
+        _db.after_fork()
+
+
+register_at_fork(after_in_child=_after_fork_in_child)
 
 
 def with_db(f):
@@ -0,0 +1,52 @@
+# A counter of changes to the library, shared by every process of the server.
+#
+# Anything the server caches in memory that depends on which albums and playlists
+# there are is tagged with the generation it was built in, and rebuilt once the
+# generation has moved on. The counter lives in a small file in the data directory
+# mapped into memory, so that under uwsgi a change made by one worker is seen by
+# the others, and checking it costs no more than reading an integer.
+
+from fcntl import LOCK_EX, LOCK_UN, lockf
+from mmap import mmap
+from struct import Struct
+from threading import Lock
+import os
+
+from .utils import get_data_dir
+
+COUNTER = Struct("=Q")
+
+
+class Generation:
+    def __init__(self):
+        self._fd = None
+        self._map = None
+        self._lock = Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._map is None:
+                path = get_data_dir() / "generation"
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                if os.fstat(fd).st_size < COUNTER.size:
+                    os.ftruncate(fd, COUNTER.size)
+                self._fd = fd
+                self._map = mmap(fd, COUNTER.size)
+        return self._map
+
+    def current(self):
+        return COUNTER.unpack_from(self._map or self._open())[0]
+
+    def bump(self):
+        """Start a new generation. Call this after committing a change."""
+        m = self._map or self._open()
+        # The thread lock keeps out other threads, lockf other processes
+        with self._lock:
+            lockf(self._fd, LOCK_EX)
+            try:
+                COUNTER.pack_into(m, 0, COUNTER.unpack_from(m)[0] + 1)
+            finally:
+                lockf(self._fd, LOCK_UN)
+
+
+generation = Generation()
@@ -0,0 +1,169 @@
+from hashlib import file_digest, sha1
+from json import JSONDecodeError, dump, dumps, load
+from logging import warning
+from os import makedirs, replace
+from pathlib import Path
+from uuid import uuid4
+
+from .utils import get_cache_dir, get_data_dir
+
+MANIFEST_VERSION = 1
+
+
+def _digest(path):
+    with path.open("rb") as f:
+        return file_digest(f, "sha1").hexdigest()
+
+
+def _album_key(key):
+    return dumps(list(key))
+
+
+class Manifest:
+    """What the client has already submitted to a server.
+
+    For every playlist it records the size, mtime and digest of the file as it was
+    when it was last submitted successfully, and for every album the cover that was
+    found for it and the cover's mtime. Playlists that have not changed since can
+    then be skipped, and albums whose cover is unchanged need not be searched for
+    again.
+
+    There is one manifest per server, since a playlist that is up to date on one
+    server need not be on another. Runs on different roots against the same server
+    share it, so each only forgets the playlists of its own root.
+    """
+
+    def __init__(self, url):
+        name = sha1(url.encode()).hexdigest()
+        self.path = get_cache_dir() / f"manifest-{name}.json"
+        self.playlists = {}
+        self.albums = {}
+
+    def load(self):
+        try:
+            with self.path.open() as f:
+                data = load(f)
+        except FileNotFoundError:
+            return self
+        except (IOError, JSONDecodeError) as e:
+            warning(f"Could not read manifest {self.path}: {e}; starting afresh.")
+            return self
+        if data.get("version") != MANIFEST_VERSION:
+            return self
+        self.playlists = data.get("playlists", {})
+        self.albums = data.get("albums", {})
+        return self
+
+    def save(self):
+        makedirs(self.path.parent, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w") as f:
+            dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "playlists": self.playlists,
+                    "albums": self.albums,
+                },
+                f,
+            )
+        replace(tmp, self.path)
+
+    def playlist_unchanged(self, path):
+        """Whether the playlist at path is as it was when last submitted.
+
+        Compares size and mtime first. If only the mtime differs, the contents are
+        hashed, and if they are the same the new mtime is recorded.
+        """
+        entry = self.playlists.get(str(path))
+        if entry is None:
+            return False
+        st = path.stat()
+        if entry["size"] != st.st_size:
+            return False
+        if entry["mtime_ns"] == st.st_mtime_ns:
+            return True
+        if entry["digest"] != _digest(path):
+            return False
+        entry["mtime_ns"] = st.st_mtime_ns
+        return True
+
+    def snapshot(self, path):
+        """Describe the playlist at path as it is now, for record_playlist."""
+        st = path.stat()
+        return {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "digest": _digest(path),
+        }
+
+    def record_playlist(self, path, snapshot):
+        self.playlists[str(path)] = snapshot
+
+    def forget_playlists(self, root_dir, keep=()):
+        """Forget the playlists in root_dir, except those at the paths in keep."""
+        keep = set(str(p) for p in keep)
+        for p in list(self.playlists):
+            if Path(p).parent == root_dir and p not in keep:
+                del self.playlists[p]
+
+    def forget_missing_playlists(self, root_dir):
+        self.forget_playlists(root_dir, keep=root_dir.glob("*.dbpl"))
+
+    def cover(self, key):
+        """The cover found for the album key on an earlier run, if it is unchanged,
+        as a (path, mtime) pair."""
+        entry = self.albums.get(_album_key(key))
+        if entry is None:
+            return None
+        path, mtime = entry
+        path = Path(path)
+        try:
+            if int(path.stat().st_mtime) != mtime:
+                return None
+        except OSError:
+            return None
+        return path, mtime
+
+    def record_cover(self, key, path, mtime):
+        self.albums[_album_key(key)] = [str(path), mtime]
+
+    def forget_cover(self, key):
+        self.albums.pop(_album_key(key), None)
+
+    def forget_covers(self):
+        self.albums.clear()
+
+
+class PlaylistIds:
+    """The UUIDs of playlists, keyed by their path.
+
+    These used to be stored in the playlists' own meta, which meant rewriting the
+    user's playlist files. They live in the data directory rather than the cache,
+    as losing them would make every playlist look new to the server.
+    """
+
+    def __init__(self):
+        self.path = get_data_dir() / "playlist_ids.json"
+        self.ids = {}
+
+    def load(self):
+        try:
+            with self.path.open() as f:
+                self.ids = load(f)
+        except FileNotFoundError:
+            pass
+        except (IOError, JSONDecodeError) as e:
+            warning(f"Could not read playlist ids from {self.path}: {e}")
+        return self
+
+    def save(self):
+        makedirs(self.path.parent, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w") as f:
+            dump(self.ids, f, indent=4)
+        replace(tmp, self.path)
+
+    def get(self, path, default=None):
+        """The UUID of the playlist at path, assigning it default, or a new UUID if
+        that is None, if it has none yet."""
+        return self.ids.setdefault(str(path), default or str(uuid4()))
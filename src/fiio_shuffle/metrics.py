@@ -0,0 +1,180 @@
+# Metrics for /metrics, in the Prometheus text format.
+#
+# Recording a sample takes a lock and a few additions; the text is only rendered
+# when /metrics is scraped. Metrics live in the memory of the process, so with
+# several uwsgi workers each reports its own.
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache
+from re import compile
+from threading import Lock
+from time import perf_counter
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label values: a count per bucket, the last being +Inf, and the sum
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(labels, (None, 0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[i] += 1
+            self._values[labels] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(labels, list(c), t) for labels, (c, t) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for le, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                label_str = _labels(self.labels, labels, [("le", le)])
+                lines.append(f"{self.name}_bucket{label_str} {cumulative}")
+            label_str = _labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    "fiio_shuffle_request_duration_seconds",
+    "Time taken to handle requests, by route",
+    labels=("method", "route", "status"),
+)
+SQL_DURATION = Histogram(
+    "fiio_shuffle_sql_duration_seconds",
+    "Time taken to execute SQL statements, by statement with literals elided",
+    labels=("statement",),
+)
+STAGE_DURATION = Histogram(
+    "fiio_shuffle_stage_duration_seconds",
+    "Time taken by the stages of handling an upload",
+    labels=("stage",),
+)
+ALBUMS_OFFERED = Counter("fiio_shuffle_albums_offered_total", "Albums offered")
+ALBUMS_ACCEPTED = Counter(
+    "fiio_shuffle_albums_accepted_total", "Offered albums whose covers were requested"
+)
+COVERS_UPLOADED = Counter("fiio_shuffle_covers_uploaded_total", "Covers uploaded")
+COVER_BYTES_WRITTEN = Counter(
+    "fiio_shuffle_cover_bytes_written_total", "Bytes of covers written to disk"
+)
+
+METRICS = [
+    REQUEST_DURATION,
+    SQL_DURATION,
+    STAGE_DURATION,
+    ALBUMS_OFFERED,
+    ALBUMS_ACCEPTED,
+    COVERS_UPLOADED,
+    COVER_BYTES_WRITTEN,
+]
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# Lists of placeholders, as in IN (?, ?, ?), and of rows of them, as in inserts of
+# many rows, vary in length with the parameters
+_placeholder_list = compile(r"\?(\s*,\s*\?)+")
+_row_list = compile(r"\(\?, \.\.\.\)(, \(\?, \.\.\.\))+")
+_whitespace = compile(r"\s+")
+
+
+# The same statements are executed over and over, so their shapes are remembered
+# rather than worked out afresh every time
+@lru_cache(maxsize=1024)
+def statement_shape(statement):
+    shape = _whitespace.sub(" ", statement).strip()
+    shape = _placeholder_list.sub("?, ...", shape)
+    return _row_list.sub("(?, ...), ...", shape)
+
+
+def instrument_engine(engine):
+    """Time every statement executed by engine."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info["query_start"].pop()
+        SQL_DURATION.observe(elapsed, statement_shape(statement))
+
+
+def instrument_app(app):
+    """Time every request handled by app."""
+    from flask import g, request
+
+    @app.before_request
+    def before():
+        g.request_start = perf_counter()
+
+    @app.after_request
+    def after(response):
+        start = g.pop("request_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUEST_DURATION.observe(
+                perf_counter() - start, request.method, route, response.status_code
+            )
+        return response
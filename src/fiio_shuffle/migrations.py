@@ -0,0 +1,59 @@
+from logging import info
+
+from sqlalchemy import inspect, text
+
+from .models import Base
+
+# Schema migrations, in order. The schema version of a database is the number of
+# migrations that have been applied to it, and is kept in SQLite's user_version.
+# New tables are created by create_all, so migrations only need to change tables
+# that already exist. Each runs in a transaction with the version bump.
+MIGRATIONS = [
+    # 1: indexes for looking up playlist members, albums by cover and covers by
+    # content. Fresh databases get these from the models.
+    [
+        "CREATE INDEX IF NOT EXISTS ix_albums_in_playlists_playlist_uuid"
+        " ON albums_in_playlists (playlist_uuid, album_id)",
+        "CREATE INDEX IF NOT EXISTS ix_albums_cover_id ON albums (cover_id)",
+        "CREATE INDEX IF NOT EXISTS ix_covers_uuid ON covers (uuid)",
+    ],
+    # 2: which members of a playlist its digest counts. The digests kept so far
+    # cannot say, so they become unknown, and clients submit the playlists again.
+    [
+        "ALTER TABLE albums_in_playlists ADD COLUMN digest_timestamp INTEGER",
+        "UPDATE playlist_digests SET digest = ''",
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn):
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def _set_schema_version(conn, version):
+    # PRAGMA does not take bound parameters
+    conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def migrate(engine):
+    """Bring the database up to date with the models, creating it if need be."""
+    with engine.begin() as conn:
+        fresh = len(inspect(conn).get_table_names()) == 0
+        Base.metadata.create_all(conn)
+        if fresh:
+            _set_schema_version(conn, SCHEMA_VERSION)
+            return
+        version = get_schema_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version {version} is newer than this version of"
+            f" FiiO-shuffle supports ({SCHEMA_VERSION})"
+        )
+    for version in range(version, SCHEMA_VERSION):
+        info(f"Migrating database to schema version {version + 1}")
+        with engine.begin() as conn:
+            for statement in MIGRATIONS[version]:
+                conn.execute(text(statement))
+            _set_schema_version(conn, version + 1)
@@ -5,6 +5,7 @@ from uuid import UUID
 from sqlalchemy import (
     Column,
     ForeignKey,
+    Index,
     Integer,
     Table,
     UniqueConstraint,
@@ -23,7 +24,11 @@ AlbumInPlaylist = Table(
     Base.metadata,
     Column("album_id", ForeignKey("albums.id")),
     Column("playlist_uuid", ForeignKey("playlists.uuid")),
+    # The timestamp the album counts towards the playlist's digest with, or NULL if
+    # it does not count yet; see _count_in_digests in controllers.py
+    Column("digest_timestamp", Integer, nullable=True),
     UniqueConstraint("album_id", "playlist_uuid"),
+    Index("ix_albums_in_playlists_playlist_uuid", "playlist_uuid", "album_id"),
 )
 
 
@@ -39,7 +44,7 @@ class Album(Base):
         "Playlist", back_populates="albums", secondary=AlbumInPlaylist
     )
 
-    cover_id: Mapped[Optional[int]] = Column(ForeignKey("covers.id"))
+    cover_id: Mapped[Optional[int]] = Column(ForeignKey("covers.id"), index=True)
     cover: Mapped[Optional["Cover"]] = relationship("Cover")
 
     __table_args__ = (UniqueConstraint("artist", "title", "year"),)
@@ -50,7 +55,7 @@ class Cover(Base):
 
     id: Mapped[int] = Column(type_=Integer, primary_key=True)
     added: Mapped[datetime]
-    uuid: Mapped[UUID]
+    uuid: Mapped[UUID] = Column(Uuid, index=True)
     extension: Mapped[str]
 
 
@@ -78,3 +83,16 @@ class Offer(Base):
 
     playlist_uuid: Mapped[[int]] = Column(ForeignKey("playlists.uuid"))
     playlist: Mapped[Optional["Playlist"]] = relationship("Playlist")
+
+
+class PlaylistDigest(Base):
+    """What the server knows of each playlist, summarised as in sync.py. Lets a
+    client tell which of its playlists need to be offered again without offering
+    them."""
+
+    __tablename__ = "playlist_digests"
+
+    playlist_uuid: Mapped[UUID] = Column(
+        Uuid, ForeignKey("playlists.uuid"), primary_key=True
+    )
+    digest: Mapped[str]
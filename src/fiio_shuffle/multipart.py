@@ -0,0 +1,66 @@
+from uuid import uuid4
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartBody:
+    """A multipart/form-data request body that reads its files while it is sent.
+
+    requests builds multipart bodies in memory, which for a batch of covers can be
+    hundreds of megabytes. Pass an instance as ``data`` together with
+    ``headers={"Content-Type": body.content_type}``. Because it has a length,
+    requests sends a Content-Length instead of using chunked encoding.
+
+    Each part is a ``(name, filename, content)`` triple, where ``content`` is either
+    ``bytes`` or a ``pathlib.Path``.
+    """
+
+    def __init__(self, parts):
+        self.boundary = uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self._parts = []
+        for name, filename, content in parts:
+            head = (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{_quote(name)}"; '
+                f'filename="{_quote(filename)}"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode()
+            if isinstance(content, bytes):
+                size = len(content)
+            else:
+                size = content.stat().st_size
+            self._parts.append((head, content, size))
+        self._tail = f"--{self.boundary}--\r\n".encode()
+
+    def __len__(self):
+        return sum(len(head) + size + 2 for head, _, size in self._parts) + len(
+            self._tail
+        )
+
+    def __iter__(self):
+        for head, content, size in self._parts:
+            yield head
+            if isinstance(content, bytes):
+                yield content
+            else:
+                yield from _read_exactly(content, size)
+            yield b"\r\n"
+        yield self._tail
+
+
+def _quote(s):
+    return s.replace("\\", "\\\\").replace('"', "%22")
+
+
+def _read_exactly(path, size):
+    # The Content-Length has already been promised, so a file that changed size
+    # since it was measured cannot be sent.
+    with path.open("rb") as f:
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise IOError(f"{path} shrank while it was being uploaded")
+            remaining -= len(chunk)
+            yield chunk
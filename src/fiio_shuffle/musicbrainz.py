@@ -0,0 +1,196 @@
+from concurrent.futures import ThreadPoolExecutor
+from json import JSONDecodeError, dump, load
+from logging import info, warning
+from os import makedirs, replace
+from threading import Condition, Lock
+from time import monotonic, time
+from urllib.parse import urlsplit
+import xml.etree.ElementTree as ET
+
+from requests import Session
+from requests.exceptions import RequestException
+
+from .utils import get_cache_dir
+
+NS = {"m": "http://musicbrainz.org/ns/mmd-2.0#"}
+USER_AGENT = "FiiO-shuffle (https://github.com/rsekman/FiiO-shuffle)"
+CHUNK_SIZE = 8192
+
+
+class TokenBucket:
+    """Allow on average rate acquisitions per second, in bursts of at most burst."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = monotonic()
+        self._cond = Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate
+                )
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                self._cond.wait((1 - self._tokens) / self.rate)
+
+
+class CoverFetcher:
+    """Fetches covers from MusicBrainz and the Cover Art Archive in the background.
+
+    Requests to each host are rate limited by a token bucket, as MusicBrainz only
+    allows one request per second. Release group ids, and lookups that found no
+    cover, are remembered on disk so that later runs need not ask again; failures
+    are forgotten after a while in case a cover has been added since.
+    """
+
+    def __init__(self, cfg):
+        self.mb_url = cfg.get("url", "https://musicbrainz.org").rstrip("/")
+        self.caa_url = cfg.get(
+            "coverartarchive_url", "https://coverartarchive.org"
+        ).rstrip("/")
+        self.timeout = cfg.get("timeout", 10)
+        self.failure_ttl = cfg.get("failure_ttl", 7 * 24 * 60 * 60)
+        self._rates = cfg.get("rate_limits", {})
+        self._default_rate = cfg.get("default_rate", 5)
+        self._buckets = {}
+        self._lock = Lock()
+        self._session = Session()
+        self._session.headers["User-Agent"] = USER_AGENT
+        self._pool = ThreadPoolExecutor(cfg.get("threads", 4))
+        self.cache_path = get_cache_dir() / "musicbrainz.json"
+        self._release_groups = {}
+        self._failures = {}
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with self.cache_path.open() as f:
+                data = load(f)
+        except FileNotFoundError:
+            return
+        except (IOError, JSONDecodeError) as e:
+            warning(f"Could not read {self.cache_path}: {e}; starting afresh.")
+            return
+        self._release_groups = data.get("release_groups", {})
+        now = time()
+        self._failures = {k: t for k, t in data.get("failures", {}).items() if t > now}
+
+    def _save_cache(self):
+        makedirs(self.cache_path.parent, exist_ok=True)
+        tmp = self.cache_path.with_suffix(".tmp")
+        with self._lock:
+            data = {
+                "release_groups": dict(self._release_groups),
+                "failures": dict(self._failures),
+            }
+        with tmp.open("w") as f:
+            dump(data, f)
+        replace(tmp, self.cache_path)
+
+    def close(self):
+        self._pool.shutdown()
+        self._session.close()
+        self._save_cache()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get(self, url, **kwargs):
+        host = urlsplit(url).hostname
+        with self._lock:
+            if host not in self._buckets:
+                rate = self._rates.get(host, self._default_rate)
+                self._buckets[host] = TokenBucket(rate)
+            bucket = self._buckets[host]
+        bucket.acquire()
+        resp = self._session.get(url, timeout=self.timeout, **kwargs)
+        resp.raise_for_status()
+        return resp
+
+    def _fail(self, key, log_prefix, message):
+        warning(f"{log_prefix}: {message}")
+        with self._lock:
+            self._failures[key] = time() + self.failure_ttl
+        return None
+
+    def _release_group(self, key, artist, title):
+        with self._lock:
+            release_group_id = self._release_groups.get(key)
+        if release_group_id is not None:
+            return release_group_id
+        query = f'artist:"{artist}" AND release:"{title}"'
+        resp = self._get(f"{self.mb_url}/ws/2/release-group/", params={"query": query})
+        root = ET.fromstring(resp.text)
+        release_group = root.find(".//m:release-group", NS)
+        if release_group is None:
+            return None
+        release_group_id = release_group.get("id")
+        if release_group_id is None:
+            raise ValueError("Release group without an id")
+        with self._lock:
+            self._release_groups[key] = release_group_id
+        return release_group_id
+
+    def fetch(self, artist, title, dest):
+        """Download the cover of the album to dest. Returns dest, or None if no
+        cover could be found."""
+        key = f"{artist}\x1f{title}"
+        log_prefix = f"{artist} - {title}"
+        with self._lock:
+            if key in self._failures:
+                info(f"{log_prefix}: No cover on MusicBrainz last time, skipping")
+                return None
+
+        info(f"{log_prefix}: Downloading cover from MusicBrainz")
+        try:
+            release_group_id = self._release_group(key, artist, title)
+        except (RequestException, ET.ParseError, ValueError) as e:
+            warning(
+                f"{log_prefix}: Could not get release group id from MusicBrainz: {e}"
+            )
+            return None
+        if release_group_id is None:
+            return self._fail(key, log_prefix, "Release group not found on MusicBrainz")
+
+        try:
+            resp = self._get(f"{self.caa_url}/release-group/{release_group_id}/")
+            uri = resp.json()["images"][0]["image"]
+        except RequestException as e:
+            if e.response is not None and e.response.status_code == 404:
+                return self._fail(key, log_prefix, "No cover on Cover Art Archive")
+            warning(f"{log_prefix}: Could not get cover from Cover Art Archive: {e}")
+            return None
+        except (ValueError, KeyError, IndexError) as e:
+            return self._fail(
+                key, log_prefix, f"Could not get cover from Cover Art Archive: {e}"
+            )
+
+        tmp = dest.with_suffix(".part")
+        try:
+            resp = self._get(uri, stream=True)
+            makedirs(dest.parent, exist_ok=True)
+            with tmp.open("wb") as f:
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+            replace(tmp, dest)
+        except (RequestException, IOError) as e:
+            tmp.unlink(missing_ok=True)
+            warning(
+                f"{log_prefix}: Could not download cover from Cover Art Archive ({uri}): {e}"
+            )
+            return None
+        return dest
+
+    def submit(self, artist, title, dest):
+        """Like fetch, but in the background. Returns a Future."""
+        return self._pool.submit(self.fetch, artist, title, dest)
@@ -0,0 +1,143 @@
+# Shrinking covers before they are uploaded.
+#
+# Covers found next to the music are often far larger than the page ever shows
+# them, e.g. lossless scans or PNGs thousands of pixels wide. If enabled, covers
+# the server asks for are scaled down to fit max_size and re-encoded, on a pool of
+# processes since encoding is CPU bound. The results are kept in the cache
+# directory, keyed by the source's path and mtime and by the settings, so that a
+# later run, or another server, need not encode them again. Needs Pillow.
+
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+from importlib.util import find_spec
+from logging import info, warning
+from os import makedirs, replace
+from pathlib import Path
+from tempfile import mkstemp
+
+from .utils import get_cache_dir
+
+FORMATS = {"webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg")}
+# Marks a cover that was not worth re-encoding, e.g. because it is already small
+KEEP_SUFFIX = ".keep"
+
+
+def _normalise(src, dest, max_size, fmt, quality):
+    # Runs in a worker process. Returns whether dest was written; if not, the
+    # source should be uploaded as it is.
+    from PIL import Image
+
+    pil_format, _ = FORMATS[fmt]
+    keep = dest.with_suffix(KEEP_SUFFIX)
+    makedirs(dest.parent, exist_ok=True)
+    try:
+        with Image.open(src) as im:
+            if max(im.size) <= max_size and im.format == pil_format:
+                keep.touch()
+                return False
+            im.thumbnail((max_size, max_size), Image.LANCZOS)
+            if im.mode not in ("RGB", "RGBA") or pil_format == "JPEG":
+                im = im.convert("RGB")
+            fd, tmp = mkstemp(dir=dest.parent, prefix=".")
+            tmp = Path(tmp)
+            try:
+                with open(fd, "wb") as f:
+                    im.save(f, pil_format, quality=quality)
+            except BaseException:
+                tmp.unlink()
+                raise
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # Nor is it worth trying again until the source changes
+        warning(f"Could not normalise {src}: {e}")
+        keep.touch()
+        return False
+    if tmp.stat().st_size >= src.stat().st_size:
+        tmp.unlink()
+        keep.touch()
+        return False
+    replace(tmp, dest)
+    return True
+
+
+class CoverNormaliser:
+    """Scales down and re-encodes covers before they are uploaded, see above.
+
+    Does nothing unless enabled in cfg and Pillow is installed. Keeps count of the
+    bytes of the covers it was given and of those it handed back.
+    """
+
+    def __init__(self, cfg):
+        self.enabled = cfg.get("enabled", False)
+        self.max_size = cfg.get("max_size", 1500)
+        self.format = cfg.get("format", "webp")
+        self.quality = cfg.get("quality", 85)
+        self.processes = cfg.get("processes")
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.encoded = 0
+        self._pool = None
+        if self.enabled and find_spec("PIL") is None:
+            warning("Normalising covers needs Pillow, uploading them as they are")
+            self.enabled = False
+
+    def _cached(self, src):
+        settings = f"{self.max_size}:{self.format}:{self.quality}"
+        key = f"{src}\0{src.stat().st_mtime_ns}\0{settings}"
+        name = sha1(key.encode()).hexdigest()
+        return get_cache_dir() / "normalised" / (name + FORMATS[self.format][1])
+
+    def normalise(self, paths):
+        """The covers to upload instead of those at paths, in the same order."""
+        if not self.enabled:
+            return paths
+        out = list(paths)
+        todo = []
+        for i, src in enumerate(paths):
+            try:
+                dest = self._cached(src)
+            except OSError:
+                continue
+            if dest.exists():
+                out[i] = dest
+            elif not dest.with_suffix(KEEP_SUFFIX).exists():
+                todo.append((i, src, dest))
+        if len(todo) > 0:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.processes)
+            futures = [
+                self._pool.submit(
+                    _normalise, src, dest, self.max_size, self.format, self.quality
+                )
+                for _, src, dest in todo
+            ]
+            for (i, _, dest), future in zip(todo, futures):
+                if future.result():
+                    out[i] = dest
+                    self.encoded += 1
+        for src, dest in zip(paths, out):
+            try:
+                self.bytes_in += src.stat().st_size
+                self.bytes_out += dest.stat().st_size
+            except OSError:
+                pass
+        return out
+
+    def log_savings(self):
+        if not self.enabled or self.bytes_in == 0:
+            return
+        saved = self.bytes_in - self.bytes_out
+        info(
+            f"Normalised covers: uploaded {self.bytes_out / 2**20:.1f} MiB instead of"
+            f" {self.bytes_in / 2**20:.1f} MiB, saving {saved / 2**20:.1f} MiB"
+            f" ({saved / self.bytes_in:.0%}); encoded {self.encoded} this run"
+        )
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,115 @@
+from collections import namedtuple
+from struct import Struct
+
+# A track as read by PlaylistReader. Unlike dbpl.Track it only carries what the
+# client needs, so that it is cheap to keep and to send between processes.
+Track = namedtuple("Track", ["uri", "meta"])
+
+_u8 = Struct("<B")
+_u16 = Struct("<H")
+_i16 = Struct("<h")
+_u32 = Struct("<I")
+
+MAX_FIELD_LENGTH = 20000
+
+
+class PlaylistReader:
+    """Read a DeaDBeeF playlist (.dbpl) one track at a time.
+
+    The format is the one read by dbpl.Playlist, but tracks are yielded as they are
+    parsed instead of all being kept in memory. The playlist's own metadata comes
+    after the tracks, so it is only available in meta once tracks() is exhausted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = None
+
+    def tracks(self):
+        with open(self.path, "rb") as f:
+            if f.read(4) != b"DBPL":
+                raise ValueError(f"{self.path}: invalid magic value")
+            major, minor = f.read(2)
+            if major != 1:
+                raise ValueError(f"{self.path}: invalid major version {major}")
+            if minor < 1:
+                raise ValueError(f"{self.path}: invalid minor version {minor}")
+            (count,) = _u32.unpack(f.read(4))
+            for _ in range(count):
+                yield self._read_track(f, minor)
+            self.meta = self._read_playlist_meta(f)
+
+    def _read_track(self, f, minor):
+        uri = ""
+        if minor <= 2:
+            uri = _read_str(f, _u16)
+            (decoder_len,) = _u8.unpack(f.read(1))
+            if decoder_len >= 20:
+                raise ValueError(f"{self.path}: invalid decoder length {decoder_len}")
+            f.seek(decoder_len + 2, 1)  # decoder and track number
+        f.seek(12, 1)  # start and end sample, duration
+        if minor <= 2:
+            (filetype_len,) = _u8.unpack(f.read(1))
+            f.seek(filetype_len + 16, 1)  # filetype and replaygain
+        if minor >= 2:
+            f.seek(4, 1)  # flags
+        (meta_count,) = _i16.unpack(f.read(2))
+        meta = {}
+        for _ in range(meta_count):
+            key = _read_str(f, _u16)
+            (value_len,) = _u16.unpack(f.read(2))
+            if value_len >= MAX_FIELD_LENGTH:
+                f.seek(value_len, 1)
+                continue
+            meta[key] = f.read(value_len).decode()
+        uri = meta.get(":URI", uri)
+        return Track(uri=uri, meta=meta)
+
+    def _read_playlist_meta(self, f):
+        meta = {}
+        (meta_count,) = _u16.unpack(f.read(2))
+        for _ in range(meta_count):
+            key = _read_str(f, _i16)
+            (value_len,) = _i16.unpack(f.read(2))
+            if value_len < 0 or value_len >= MAX_FIELD_LENGTH:
+                f.seek(value_len, 1)
+                continue
+            meta[key] = f.read(value_len).decode()
+        return meta
+
+
+def _read_str(f, length_format):
+    (length,) = length_format.unpack(f.read(length_format.size))
+    if length < 0 or length >= MAX_FIELD_LENGTH:
+        raise ValueError(f"invalid field length {length}")
+    return f.read(length).decode()
+
+
+def write_playlist(path, tracks, meta):
+    """Write a playlist that PlaylistReader and DeaDBeeF can read. tracks is an
+    iterable of (uri, meta) pairs, and meta is the playlist's own metadata."""
+    tracks = list(tracks)
+    with open(path, "wb") as f:
+        f.write(b"DBPL")
+        f.write(bytes([1, 2]))
+        f.write(_u32.pack(len(tracks)))
+        for uri, track_meta in tracks:
+            _write_str(f, _u16, uri)
+            f.write(_u8.pack(0))  # decoder
+            f.write(bytes(2 + 12))  # track number, start and end sample, duration
+            f.write(_u8.pack(0))  # filetype
+            f.write(bytes(16 + 4))  # replaygain, flags
+            f.write(_i16.pack(len(track_meta)))
+            for key, value in track_meta.items():
+                _write_str(f, _u16, key)
+                _write_str(f, _u16, value)
+        f.write(_u16.pack(len(meta)))
+        for key, value in meta.items():
+            _write_str(f, _i16, key)
+            _write_str(f, _i16, value)
+
+
+def _write_str(f, length_format, s):
+    b = s.encode()
+    f.write(length_format.pack(len(b)))
+    f.write(b)
@@ -1,30 +1,141 @@
 from functools import wraps
+from io import BytesIO
 from json import loads
+from mimetypes import guess_type
+from pathlib import Path
+from threading import Lock
 
-from flask import Flask, render_template, request, send_from_directory
-import warnings
-with warnings.catch_warnings(action="ignore"):
-    from flask_assets import Bundle, Environment
+from flask import (
+    Flask,
+    Request,
+    Response,
+    abort,
+    g,
+    render_template,
+    request,
+    send_from_directory,
+    url_for,
+)
+from markupsafe import Markup
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from .config import config
 from .controllers import (
+    compare_digests,
     get_all_playlists,
     get_random_album,
+    get_random_albums,
     process_offers,
     process_playlists,
     upload_cover,
+    upload_covers,
+    withdraw_albums,
 )
+from .covers import CoverSpool, get_covers_dir, get_variants_dir, variant_urls
+from .db import get_db
+from .generation import generation
+from . import metrics
 from .utils import JSONResponse, JSONResponseError, get_data_dir
+from . import wire
+
+# Optional endpoints and encodings that clients may use if the server advertises
+# them
+CAPABILITIES = ["upload_batch", "sync", "withdraw"] + wire.capabilities()
 
 data_dir = get_data_dir()
 static_dir = data_dir / ".webstatic"
 
+
+class _Metadata(BytesIO):
+    # The metadata part of an upload, which is kept in memory
+    def write(self, data):
+        if self.tell() + len(data) > config["max_request_size"]:
+            raise RequestEntityTooLarge(
+                "Upload metadata is too large, or not the first part of the upload"
+            )
+        return super().write(data)
+
+
+class _Discard(BytesIO):
+    # Where the covers of uploads without the authentication key go
+    def write(self, data):
+        return len(data)
+
+
+def _has_key(metadata):
+    try:
+        return loads(metadata)["auth_key"] == config["auth_key"]
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+class UploadRequest(Request):
+    # Files in uploads are hashed and written to the covers directory as they
+    # stream in, rather than being buffered and then copied. The metadata comes
+    # first, and the covers are only written out if it has the authentication key;
+    # otherwise they are dropped, and needs_auth turns the request down.
+    _metadata = None
+
+    @property
+    def max_content_length(self):
+        # Other bodies are read whole, see request_data, so they are limited as a
+        # whole. Uploads are limited part by part as they stream in.
+        if self.mimetype == "multipart/form-data":
+            return None
+        return config["max_request_size"]
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        if self._metadata is None:
+            self._metadata = _Metadata()
+            return self._metadata
+        if not _has_key(self._metadata.getvalue()):
+            return _Discard()
+        return CoverSpool(config["max_cover_size"])
+
+
 server = Flask(__name__)
-assets = Environment(server)
-assets.url = "assets"
-assets.directory = str(static_dir)
-css = Bundle("style.sass", filters="sass", output="style.css")
-assets.register("css", css)
+server.request_class = UploadRequest
+server.config["USE_X_SENDFILE"] = config.get("sendfile") == "x-sendfile"
+
+# Set up the engine and schema now, so that under uwsgi this happens once in the
+# master rather than on the first request of every worker.
+get_db()
+
+if config.get("metrics", True):
+    metrics.instrument_app(server)
+    metrics.instrument_engine(get_db().engine)
+
+
+_stylesheet_url = None
+
+
+def _build_stylesheet():
+    # Packages compile style.sass when they are built, see setup.py. Without that,
+    # as in a source checkout, flask_assets compiles it when it is first needed.
+    import warnings
+
+    with warnings.catch_warnings(action="ignore"):
+        from flask_assets import Bundle, Environment
+
+    assets = Environment(server)
+    assets.url = "assets"
+    assets.directory = str(static_dir)
+    css = Bundle("style.sass", filters="sass", output="style.css")
+    assets.register("css", css)
+    return "/" + css.urls()[0]
+
+
+@server.context_processor
+def stylesheet():
+    global _stylesheet_url
+    if _stylesheet_url is None:
+        if (Path(server.static_folder) / "style.css").exists():
+            _stylesheet_url = url_for("static", filename="style.css")
+        else:
+            _stylesheet_url = _build_stylesheet()
+    return {"stylesheet_url": _stylesheet_url}
 
 
 @server.route("/assets/<path:path>")
@@ -32,42 +143,126 @@ def send_static(path):
     return send_from_directory(str(get_data_dir() / ".webstatic"), path)
 
 
+# The index page is rendered once per generation of the library, with a slot for
+# the album, which is all that changes from one view to the next
+ALBUM_SLOT = "<!-- album -->"
+_index_page = None
+# Held while the page is rendered, so that threads that find it out of date render
+# it once between them
+_index_lock = Lock()
+
+
+def _index_parts():
+    global _index_page
+    current = generation.current()
+    page = _index_page
+    if page is None or page[0] != current:
+        with _index_lock:
+            page = _index_page
+            if page is None or page[0] != current:
+                html = render_template(
+                    "index.html",
+                    playlists=get_all_playlists(),
+                    album_html=Markup(ALBUM_SLOT),
+                )
+                head, tail = html.split(ALBUM_SLOT)
+                page = _index_page = (current, head, tail)
+    return page[1:]
+
+
 @server.route("/")
 def index():
-    album = get_random_album([])
-    playlists = get_all_playlists()
-    return render_template("index.html", album=album, playlists=playlists)
+    head, tail = _index_parts()
+    album = get_random_album([], shuffle=config.get("shuffle", "deck"))
+    variants = variant_urls(album.cover) if album and album.cover else []
+    return head + render_template("album.html", album=album, variants=variants) + tail
+
+
+# Most albums /album returns at once, for the page to preload
+MAX_ALBUM_COUNT = 20
 
 
 @server.route("/album", methods=["POST"])
 def random_album():
     pls = request.json.get("playlists", [])
+    shuffle = request.json.get("shuffle", config.get("shuffle", "deck"))
+    if shuffle not in ("deck", "random"):
+        return JSONResponseError(f"Unknown shuffle mode {shuffle}")
+    count = request.json.get("count")
+    if count is not None:
+        # JSON's true and false are ints to Python
+        valid = isinstance(count, int) and not isinstance(count, bool)
+        if not valid or not 0 < count <= MAX_ALBUM_COUNT:
+            return JSONResponseError(
+                f"count must be an integer between 1 and {MAX_ALBUM_COUNT}"
+            )
+        try:
+            albums = get_random_albums(pls, count, shuffle=shuffle)
+            if len(albums) == 0:
+                return JSONResponseError("No albums found")
+            return JSONResponse({"albums": [_album_json(a) for a in albums]}, True)
+        except Exception as e:
+            return JSONResponseError(f"Error: {e}")
+
     try:
-        album = get_random_album(pls)
+        album = get_random_album(pls, shuffle=shuffle)
+        if album is None:
+            return JSONResponseError("No albums found")
+        return JSONResponse(_album_json(album))
     except Exception as e:
         return JSONResponseError(f"Error: {e}")
-    if album is None:
-        return JSONResponseError("No albums found")
 
-    return JSONResponse({
+
+def _album_json(album):
+    return {
         "artist": album.artist,
         "title": album.title,
         "year": album.year,
-        "cover": str(album.cover.uuid) + album.cover.extension
-    })
+        "cover": str(album.cover.uuid) + album.cover.extension,
+        "variants": variant_urls(album.cover),
+    }
+
+
+def request_data():
+    # The decoded body of a request from the client, which may be compressed or
+    # encoded with msgpack; see wire.py
+    if "data" not in g:
+        g.data = wire.decode(
+            request.get_data(),
+            request.mimetype,
+            request.headers.get("Content-Encoding"),
+            config["max_request_size"],
+        )
+    return g.data
+
+
+def request_metadata():
+    # The metadata part of an upload, parsed once
+    if "metadata" not in g:
+        g.metadata = loads(request.files["metadata"].read())
+    return g.metadata
 
 
 def needs_auth(f):
     @wraps(f)
-    def g(*args, **kwargs):
-        if request.is_json:
-            _json = request.json
+    def wrapper(*args, **kwargs):
+        if request.mimetype != "multipart/form-data":
+            try:
+                _json = request_data()
+            except ValueError as e:
+                return JSONResponseError(f"Invalid request: {e}")
         else:
+            # The covers were written out or dropped as they came, going by the part
+            # that came first, so that has to have been the metadata
+            if next(iter(request.files), None) != "metadata":
+                resp = JSONResponseError(
+                    "Invalid request: the metadata must be the first part of an upload"
+                )
+                resp.status_code = 400
+                return resp
             try:
-                _json = loads(request.files["metadata"].read())
-                # Seek to the beginning so that the file object is transparent to the end user
-                request.files["metadata"].seek(0)
-            except (AttributeError, KeyError) as e:
+                _json = request_metadata()
+            except (AttributeError, KeyError, ValueError) as e:
                 return JSONResponseError(f"Invalid request: {e}")
 
         try:
@@ -79,26 +274,38 @@ def needs_auth(f):
 
         return f(*args, **kwargs)
 
-    return g
+    return wrapper
 
 
 @server.route("/offer", methods=["POST"])
 @needs_auth
 def offer():
-    return process_offers(request.json)
+    return process_offers(request_data())
 
 
 @server.route("/playlists", methods=["POST"])
 @needs_auth
 def playlists():
-    return process_playlists(request.json)
+    return process_playlists(request_data())
+
+
+@server.route("/sync", methods=["POST"])
+@needs_auth
+def sync():
+    return compare_digests(request_data())
+
+
+@server.route("/withdraw", methods=["POST"])
+@needs_auth
+def withdraw():
+    return withdraw_albums(request_data())
 
 
 @server.route("/upload", methods=["POST"])
 @needs_auth
 def upload():
     try:
-        metadata = loads(request.files["metadata"].read())
+        metadata = request_metadata()
         cover_file = request.files["cover"]
         return upload_cover(cover_file, metadata)
     except KeyError:
@@ -107,7 +314,68 @@ def upload():
         )
 
 
+@server.route("/upload/batch", methods=["POST"])
+@needs_auth
+def upload_batch():
+    try:
+        metadata = request_metadata()
+    except KeyError:
+        return JSONResponseError(
+            "Invalid request: no metadata provided",
+        )
+    return upload_covers(request.files.getlist("cover"), metadata)
+
+
+@server.route("/metrics")
+def send_metrics():
+    if not config.get("metrics", True):
+        abort(404)
+    # Only for those that have the authentication key, as Prometheus sends it
+    if request.headers.get("Authorization") != f"Bearer {config['auth_key']}":
+        abort(401)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@server.route("/capabilities")
+def capabilities():
+    return JSONResponse({"capabilities": CAPABILITIES})
+
+
+# Covers never change once written, since they are named by their content
+COVER_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def _send_cover_file(path, etag):
+    if config.get("sendfile") == "x-accel-redirect":
+        # Let nginx send the file from an internal location mapped to the covers
+        # directory, so that the worker is free as soon as the headers are out.
+        if not path.is_file():
+            abort(404)
+        prefix = config.get("x_accel_redirect_prefix", "/_covers/")
+        response = Response(mimetype=guess_type(path.name)[0])
+        response.headers["X-Accel-Redirect"] = prefix + str(
+            path.relative_to(get_covers_dir())
+        )
+        response.set_etag(etag)
+        response.make_conditional(request)
+    else:
+        # Under USE_X_SENDFILE, Flask hands the file over with an X-Sendfile header
+        response = send_from_directory(
+            str(path.parent), path.name, etag=etag, max_age=COVER_MAX_AGE
+        )
+    response.cache_control.public = True
+    response.cache_control.max_age = COVER_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
 @server.route("/covers/<uuid:cover_id>.<string:extension>")
 def send_cover(cover_id, extension):
-    d = get_data_dir() / "covers"
-    return send_from_directory(str(d), str(cover_id) + "." + extension)
+    d = get_covers_dir()
+    return _send_cover_file(d / f"{cover_id}.{extension}", str(cover_id))
+
+
+@server.route("/covers/<uuid:cover_id>/<int:width>.<string:extension>")
+def send_cover_variant(cover_id, width, extension):
+    d = get_variants_dir(cover_id)
+    return _send_cover_file(d / f"{width}.{extension}", f"{cover_id}-{width}")
@@ -0,0 +1,283 @@
+# Snapshots of a server's catalogue, for moving it to new hardware or seeding a
+# test instance without running the client against the whole library again.
+#
+# A snapshot is a tar archive of a copy of the database, made with SQLite's online
+# backup so that the server can keep running, and of the covers and their variants.
+# Importing copies the covers into place, skipping those that are already there,
+# which since covers are named by their content means those with the same name and
+# size. The database is then merged into the server's in one transaction, matching
+# albums, covers and playlists by what they are rather than by id. Both steps can
+# be repeated, so an import that was interrupted can just be run again.
+
+from hashlib import sha256
+from io import BytesIO
+from json import dumps, loads
+from logging import info, warning
+from os import makedirs, replace
+from pathlib import Path
+from re import compile
+from tempfile import mkstemp
+from time import time
+from uuid import UUID
+import sqlite3
+import sys
+import tarfile
+
+from sqlalchemy import create_engine, delete, select, update
+
+from .covers import CHUNK_SIZE, content_uuid, get_covers_dir, get_variants_dir
+from .generation import generation
+from .migrations import SCHEMA_VERSION, migrate
+from .models import Album, AlbumInPlaylist, Cover, PlaylistDigest
+from .sync import UNKNOWN_DIGEST
+from .utils import get_data_dir
+
+SNAPSHOT_VERSION = 1
+HEADER_NAME = "snapshot.json"
+DATABASE_NAME = "fiio_shuffle.sqlite3"
+
+# Covers are covers/<uuid><extension>, their variants covers/<uuid>/<name>
+_cover_name = compile(r"covers/([0-9a-f-]{36})(\.[A-Za-z0-9]+)")
+_variant_name = compile(r"covers/([0-9a-f-]{36})/([0-9]+\.[A-Za-z0-9]+)")
+
+# Merge the attached snapshot into the main database. The WHERE true clauses tell
+# the ON of an upsert from that of a join, see process_offers in controllers.py.
+MERGE = [
+    # A playlist the server already had now holds the albums of both, which
+    # neither digest describes unless they are the same; an unknown digest (see
+    # sync.py) makes the client offer it again. This looks at the playlists the
+    # server had, so it comes before they are merged.
+    "INSERT INTO playlist_digests (playlist_uuid, digest)"
+    " SELECT s.uuid, CASE"
+    " WHEN sd.digest IS NULL THEN ''"
+    " WHEN p.uuid IS NULL OR d.digest = sd.digest THEN sd.digest"
+    " ELSE '' END"
+    " FROM snapshot.playlists s"
+    " LEFT JOIN snapshot.playlist_digests sd ON sd.playlist_uuid = s.uuid"
+    " LEFT JOIN playlists p ON p.uuid = s.uuid"
+    " LEFT JOIN playlist_digests d ON d.playlist_uuid = s.uuid"
+    " WHERE true"
+    " ON CONFLICT (playlist_uuid) DO UPDATE SET digest = excluded.digest",
+    "INSERT INTO playlists (uuid, title)"
+    " SELECT uuid, title FROM snapshot.playlists WHERE true"
+    " ON CONFLICT DO NOTHING",
+    "INSERT INTO covers (added, uuid, extension)"
+    " SELECT s.added, s.uuid, s.extension FROM snapshot.covers s"
+    " WHERE NOT EXISTS"
+    " (SELECT 1 FROM covers c WHERE c.uuid = s.uuid AND c.extension = s.extension)",
+    # Albums that are already known keep their cover unless the snapshot's is newer
+    "INSERT INTO albums (added, artist, title, year, cover_id)"
+    " SELECT a.added, a.artist, a.title, a.year,"
+    " (SELECT c.id FROM covers c WHERE c.uuid = s.uuid AND c.extension = s.extension"
+    " ORDER BY c.id LIMIT 1)"
+    " FROM snapshot.albums a LEFT JOIN snapshot.covers s ON s.id = a.cover_id"
+    " WHERE true"
+    " ON CONFLICT (artist, title, year) DO UPDATE SET cover_id = excluded.cover_id"
+    " WHERE excluded.cover_id IS NOT NULL AND (albums.cover_id IS NULL"
+    " OR (SELECT added FROM covers WHERE id = excluded.cover_id)"
+    " > (SELECT added FROM covers WHERE id = albums.cover_id))",
+    "INSERT INTO albums_in_playlists (album_id, playlist_uuid, digest_timestamp)"
+    " SELECT a.id, m.playlist_uuid, m.digest_timestamp"
+    " FROM snapshot.albums_in_playlists m"
+    " JOIN snapshot.albums s ON s.id = m.album_id"
+    " JOIN albums a ON a.artist = s.artist AND a.title = s.title AND a.year = s.year"
+    " WHERE true"
+    " ON CONFLICT DO NOTHING",
+]
+
+
+def _backup(db, dest):
+    # A consistent copy of the database, while the server keeps using it
+    target = sqlite3.connect(dest)
+    raw = db.engine.raw_connection()
+    try:
+        raw.driver_connection.backup(target)
+    finally:
+        raw.close()
+        target.close()
+
+
+def _add_file(tar, path, name):
+    try:
+        tar.add(path, arcname=name, recursive=False)
+    except FileNotFoundError:
+        # Removed by the garbage collector since the backup
+        warning(f"{path} is gone, leaving it out")
+        return False
+    return True
+
+
+def export_snapshot(db, archive):
+    """Write a snapshot of the catalogue to the file archive, or to standard output
+    if it is "-"."""
+    start = time()
+    data_dir = get_data_dir()
+    _, tmp = mkstemp(dir=data_dir, prefix=".export-", suffix=".sqlite3")
+    tmp = Path(tmp)
+    try:
+        _backup(db, tmp)
+        engine = create_engine(f"sqlite:///{tmp}")
+        with engine.connect() as conn:
+            q = select(Cover.uuid, Cover.extension)
+            covers = [(uuid, ext) for uuid, ext in conn.execute(q)]
+        engine.dispose()
+
+        if archive == "-":
+            tar = tarfile.open(fileobj=sys.stdout.buffer, mode="w|")
+        else:
+            tar = tarfile.open(archive, mode="w")
+        with tar:
+            header = {"version": SNAPSHOT_VERSION, "schema_version": SCHEMA_VERSION}
+            header = dumps(header).encode()
+            tarinfo = tarfile.TarInfo(HEADER_NAME)
+            tarinfo.size = len(header)
+            tarinfo.mtime = int(start)
+            tar.addfile(tarinfo, BytesIO(header))
+            tar.add(tmp, arcname=DATABASE_NAME)
+
+            n = 0
+            with_variants = set()
+            for uuid, ext in sorted(set(covers)):
+                name = f"{uuid}{ext}"
+                if not _add_file(tar, get_covers_dir() / name, f"covers/{name}"):
+                    continue
+                n += 1
+                # Covers with the same content share their variants
+                if uuid in with_variants:
+                    continue
+                with_variants.add(uuid)
+                variants = get_variants_dir(uuid)
+                if variants.is_dir():
+                    for variant in sorted(variants.iterdir()):
+                        _add_file(tar, variant, f"covers/{uuid}/{variant.name}")
+    finally:
+        tmp.unlink(missing_ok=True)
+    info(f"Exported the database and {n} covers in {time() - start:.1f} s")
+
+
+def _copy_member(tar, member, dest, uuid=None):
+    # Copy a file out of the archive to dest, through a temporary file next to it
+    # so that dest is never seen half written. If uuid is given, the contents must
+    # hash to it, as covers are named by their content.
+    makedirs(dest.parent, exist_ok=True)
+    fd, tmp = mkstemp(dir=get_covers_dir(), prefix=".import-")
+    try:
+        h = sha256()
+        src = tar.extractfile(member)
+        with open(fd, "wb") as f:
+            while chunk := src.read(CHUNK_SIZE):
+                h.update(chunk)
+                f.write(chunk)
+        if uuid is not None and str(content_uuid(h.digest())) != uuid:
+            warning(f"{member.name} does not match its name, leaving it out")
+            Path(tmp).unlink()
+            return False
+        replace(tmp, dest)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return True
+
+
+def _drop_covers(conn, uuids):
+    # Leave the covers with the given UUIDs out of the snapshot. Their albums are
+    # kept without a cover, and no longer count towards the digests of their
+    # playlists, which become unknown, so that clients upload the covers again.
+    covers = select(Cover.id).where(Cover.uuid.in_(uuids))
+    albums = select(Album.id).where(Album.cover_id.in_(covers))
+    playlists = select(AlbumInPlaylist.c.playlist_uuid).where(
+        AlbumInPlaylist.c.album_id.in_(albums)
+    )
+    conn.execute(
+        update(PlaylistDigest)
+        .where(PlaylistDigest.playlist_uuid.in_(playlists))
+        .values(digest=UNKNOWN_DIGEST)
+    )
+    conn.execute(
+        update(AlbumInPlaylist)
+        .where(AlbumInPlaylist.c.album_id.in_(albums))
+        .values(digest_timestamp=None)
+    )
+    conn.execute(update(Album).where(Album.id.in_(albums)).values(cover_id=None))
+    conn.execute(delete(Cover).where(Cover.id.in_(covers)))
+
+
+def _merge(db, path, rejected=()):
+    # Bring the snapshot's schema up to date first, so that the tables match, and
+    # take out the covers whose files were rejected
+    engine = create_engine(f"sqlite:///{path}")
+    try:
+        migrate(engine)
+        if len(rejected) > 0:
+            with engine.begin() as conn:
+                _drop_covers(conn, [UUID(uuid) for uuid in rejected])
+    finally:
+        engine.dispose()
+    with db.engine.connect() as conn:
+        # Attaching is not allowed within a transaction, so it comes first
+        conn.exec_driver_sql("ATTACH DATABASE ? AS snapshot", (str(path),))
+        try:
+            for statement in MERGE:
+                conn.exec_driver_sql(statement)
+            conn.commit()
+        finally:
+            conn.rollback()
+            conn.exec_driver_sql("DETACH DATABASE snapshot")
+    generation.bump()
+
+
+def import_snapshot(db, archive):
+    """Import a snapshot written by export_snapshot from the file archive, or from
+    standard input if it is "-"."""
+    start = time()
+    makedirs(get_covers_dir(), exist_ok=True)
+    staged = get_data_dir() / ".import.sqlite3"
+    if archive == "-":
+        tar = tarfile.open(fileobj=sys.stdin.buffer, mode="r|*")
+    else:
+        tar = tarfile.open(archive, mode="r:*")
+    copied = skipped = corrupt = 0
+    # UUIDs of covers whose files do not match them, and which the server does not
+    # have already
+    rejected = set()
+    have_database = False
+    with tar:
+        for member in tar:
+            if member.name == HEADER_NAME:
+                header = loads(tar.extractfile(member).read())
+                if header.get("version") != SNAPSHOT_VERSION:
+                    raise ValueError(
+                        f"Unsupported snapshot version {header.get('version')}"
+                    )
+                continue
+            if member.name == DATABASE_NAME and member.isfile():
+                # Staged rather than merged straight away, so that no album refers
+                # to a cover whose file has not been copied yet
+                _copy_member(tar, member, staged)
+                have_database = True
+                continue
+            cover = _cover_name.fullmatch(member.name)
+            variant = _variant_name.fullmatch(member.name)
+            if not member.isfile() or (cover is None and variant is None):
+                warning(f"Unexpected {member.name} in snapshot, skipping")
+                continue
+            dest = get_covers_dir() / member.name.removeprefix("covers/")
+            if dest.exists() and dest.stat().st_size == member.size:
+                skipped += 1
+                continue
+            uuid = cover.group(1) if cover is not None else None
+            if _copy_member(tar, member, dest, uuid):
+                copied += 1
+            else:
+                corrupt += 1
+                if not dest.exists():
+                    rejected.add(uuid)
+    info(
+        f"Copied {copied} cover files, skipped {skipped} already present"
+        + (f" and {corrupt} corrupt ones" if corrupt else "")
+    )
+    if not have_database:
+        raise ValueError(f"{archive} contains no database")
+    _merge(db, staged, rejected)
+    staged.unlink()
+    info(f"Imported {archive} in {time() - start:.1f} s")
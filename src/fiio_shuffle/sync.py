@@ -0,0 +1,41 @@
+from hashlib import sha256
+
+# Playlist digests are the sum, modulo 2**256, of the SHA-256 of every entry in the
+# playlist. Unlike a hash over the sorted entries this does not depend on their
+# order, so the server can keep it up to date one entry at a time as offers,
+# uploads and withdrawals come in.
+MODULUS = 2**256
+EMPTY_DIGEST = format(0, "064x")
+# The digest of a playlist whose albums the server cannot vouch for, as after a
+# snapshot has been merged into it. It matches no client's digest, and stays
+# unknown until the playlist is submitted again.
+UNKNOWN_DIGEST = ""
+
+
+def entry_hash(artist, title, year, timestamp):
+    entry = "\x1f".join([artist, title, str(int(year)), str(int(timestamp))])
+    return int.from_bytes(sha256(entry.encode()).digest())
+
+
+def add_entries(digest, entries):
+    """Add (artist, title, year, timestamp) entries to a hex digest."""
+    if digest == UNKNOWN_DIGEST:
+        return digest
+    total = int(digest, 16)
+    for entry in entries:
+        total = (total + entry_hash(*entry)) % MODULUS
+    return format(total, "064x")
+
+
+def remove_entries(digest, entries):
+    """Remove (artist, title, year, timestamp) entries from a hex digest."""
+    if digest == UNKNOWN_DIGEST:
+        return digest
+    total = int(digest, 16)
+    for entry in entries:
+        total = (total - entry_hash(*entry)) % MODULUS
+    return format(total, "064x")
+
+
+def playlist_digest(entries):
+    return add_entries(EMPTY_DIGEST, entries)
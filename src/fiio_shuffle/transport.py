@@ -0,0 +1,47 @@
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Transport:
+    """HTTP connection to the server.
+
+    Keeps connections alive between requests, retries failed requests with
+    exponential backoff and puts a timeout on every request. GETs are retried on
+    any error and on the statuses of an overloaded server. POSTs change what the
+    server has, and one that timed out or failed may have been carried out, so
+    they are only retried if no connection could be made.
+    """
+
+    def __init__(self, url, cfg):
+        self.url = url.rstrip("/")
+        self.timeout = (cfg.get("connect_timeout", 5), cfg.get("read_timeout", 60))
+        retry = Retry(
+            total=cfg.get("retries", 3),
+            backoff_factor=cfg.get("backoff", 0.5),
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Connection errors are retried whatever the method
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=cfg.get("pool_size", 4))
+        self.session = Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(self.url + path, **kwargs)
+
+    def post(self, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(self.url + path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
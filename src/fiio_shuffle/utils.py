@@ -2,8 +2,6 @@ from json import dumps
 from os import environ
 from pathlib import Path
 
-from flask import Response
-
 
 def get_data_dir():
     try:
@@ -27,6 +25,8 @@ def get_config_dir():
 
 
 def JSONResponse(j, success=True):
+    from flask import Response
+
     out = {"success": success}
     out |= j
     return Response(dumps(out), mimetype="application/json")
@@ -0,0 +1,377 @@
+# Keeps a server up to date with a directory of playlists as they change, for
+# `fiio_shuffle client --watch`.
+#
+# Changes are noticed with inotify rather than by rescanning. Bursts of events, as
+# when a player rewrites a playlist in several steps, are collected until things
+# have been quiet for a moment, and then only the playlists that changed are parsed
+# again. Albums that were added to them are offered, and those that were removed
+# are withdrawn, so the server need not be sent the whole playlist again.
+
+from ctypes import CDLL, get_errno
+from itertools import batched
+from os import close, fsdecode, fsencode, read, strerror
+from pathlib import Path
+from select import POLLIN, poll
+from struct import Struct
+from time import monotonic
+import errno
+import logging
+
+from .client import (
+    COVER_NAMES,
+    album_entry,
+    differing,
+    list_dir,
+    offer_and_upload,
+    offer_playlists,
+    read_playlists,
+    submit,
+    withdraw,
+)
+from .config import config
+from .sync import playlist_digest
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+# Files are written in place or moved into place, and removed or moved away
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ONLYDIR
+
+EVENT = Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    """A minimal binding of Linux's inotify, through libc."""
+
+    def __init__(self):
+        self._libc = CDLL(None, use_errno=True)
+        try:
+            self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        except AttributeError:
+            raise OSError("inotify is not available on this system")
+        if self.fd < 0:
+            e = get_errno()
+            raise OSError(e, strerror(e))
+        self._poll = poll()
+        self._poll.register(self.fd, POLLIN)
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, fsencode(path), mask)
+        if wd < 0:
+            e = get_errno()
+            raise OSError(e, strerror(e), str(path))
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails if the watch is already gone, e.g. with its directory
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Wait at most timeout seconds, or forever if it is None, for events.
+        Returns them as (watch descriptor, mask, cookie, name) tuples."""
+        ms = None if timeout is None else int(timeout * 1000)
+        if len(self._poll.poll(ms)) == 0:
+            return []
+        buf = read(self.fd, READ_SIZE)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT.unpack_from(buf, offset)
+            offset += EVENT.size
+            name = fsdecode(buf[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        close(self.fd)
+
+
+class Watcher:
+    """Watches root_dir for playlists that change, and, if covers is true, the
+    directories of their albums for covers that change.
+
+    It remembers the albums found in every playlist, as the server should have
+    them, so that it can work out what changed.
+    """
+
+    def __init__(self, root_dir, covers=False):
+        self.root_dir = root_dir
+        self.covers = covers
+        cfg = config.get("watch", {})
+        self.debounce = cfg.get("debounce", 2)
+        self.max_delay = cfg.get("max_delay", 30)
+        self.inotify = Inotify()
+        self.root_wd = self.inotify.add_watch(root_dir, WATCH_MASK)
+        # Playlist file -> (ScannedPlaylist, albums found in it)
+        self.playlists = {}
+        # Album directory -> watch descriptor, and back
+        self._wds = {}
+        self._dirs = {}
+        # Album directory -> (playlist file, album key) of the albums in it
+        self._albums_in = {}
+        self._find = None
+
+    def remembering(self, find_albums):
+        """Wrap find_albums, as used by run_client, so that the albums found in
+        every playlist it is given are remembered."""
+        self._find = find_albums
+
+        def find(pl):
+            albums = []
+            for album in find_albums(pl):
+                albums.append(album)
+                yield album
+            self._remember(pl, albums)
+
+        return find
+
+    def _remember(self, pl, albums):
+        self._forget(pl.file)
+        self.playlists[pl.file] = (pl, albums)
+        if not self.covers:
+            return
+        for key, track in pl.albums:
+            directory = Path(track.uri).parent
+            self._albums_in.setdefault(directory, set()).add((pl.file, key))
+            if directory not in self._wds:
+                self._watch_dir(directory)
+
+    def _watch_dir(self, directory):
+        try:
+            wd = self.inotify.add_watch(directory, WATCH_MASK)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logging.warning(
+                    "Out of inotify watches, not watching any more album directories"
+                    " for covers; raise fs.inotify.max_user_watches to watch them all"
+                )
+                self.covers = False
+            elif e.errno != errno.ENOENT:
+                logging.warning(f"Could not watch {directory} for covers: {e}")
+            return
+        self._wds[directory] = wd
+        self._dirs[wd] = directory
+
+    def _forget(self, path):
+        if path not in self.playlists:
+            return
+        pl, _ = self.playlists.pop(path)
+        for key, track in pl.albums:
+            directory = Path(track.uri).parent
+            albums = self._albums_in.get(directory)
+            if albums is None:
+                continue
+            albums.discard((path, key))
+            if len(albums) == 0:
+                del self._albums_in[directory]
+                wd = self._wds.pop(directory, None)
+                if wd is not None:
+                    self._dirs.pop(wd, None)
+                    self.inotify.rm_watch(wd)
+
+    def _baseline(self):
+        # Playlists that the first pass skipped as unchanged are as the server has
+        # them, so what is found in them now is what later changes are compared to
+        unseen = [
+            (f, self.manifest.snapshot(f))
+            for f in sorted(self.root_dir.glob("*.dbpl"))
+            if f not in self.playlists
+        ]
+        if len(unseen) == 0:
+            return
+        logging.info(f"Reading {len(unseen)} unchanged playlists to watch")
+        for pl in read_playlists(unseen, self.ids):
+            self._remember(pl, list(self._find(pl)))
+        self.ids.save()
+
+    def run(self, transport, manifest, ids, capabilities, normaliser=None):
+        """Wait for changes and submit them, until interrupted."""
+        self.transport = transport
+        self.manifest = manifest
+        self.ids = ids
+        self.capabilities = capabilities
+        self.normaliser = normaliser
+        try:
+            self._baseline()
+            logging.info(f"Watching {self.root_dir} for changes")
+            playlists = set()
+            directories = set()
+            first = last = None
+            while True:
+                timeout = None
+                if first is not None:
+                    deadline = min(last + self.debounce, first + self.max_delay)
+                    timeout = max(0, deadline - monotonic())
+                events = self.inotify.read(timeout)
+                if self._collect(events, playlists, directories):
+                    last = monotonic()
+                    if first is None:
+                        first = last
+                if first is None:
+                    continue
+                now = monotonic()
+                if now >= last + self.debounce or now >= first + self.max_delay:
+                    self._update(playlists, directories)
+                    playlists = set()
+                    directories = set()
+                    first = last = None
+        except KeyboardInterrupt:
+            logging.info("Stopped watching")
+        finally:
+            manifest.save()
+            if normaliser is not None:
+                normaliser.log_savings()
+            self.inotify.close()
+
+    def _collect(self, events, playlists, directories):
+        # Sort events into changed playlists and album directories. Returns whether
+        # any of them were of interest.
+        relevant = False
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("Missed some changes, checking every playlist")
+                playlists.update(self.root_dir.glob("*.dbpl"))
+                playlists.update(self.playlists)
+                directories.update(self._wds)
+                relevant = True
+            elif wd == self.root_wd:
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    raise OSError(f"{self.root_dir} is gone")
+                if name.endswith(".dbpl"):
+                    playlists.add(self.root_dir / name)
+                    relevant = True
+            elif wd in self._dirs:
+                if mask & IN_IGNORED:
+                    # The directory is gone, and so are its albums' covers
+                    directories.add(self._dirs.pop(wd))
+                    relevant = True
+                elif name in COVER_NAMES:
+                    directories.add(self._dirs[wd])
+                    relevant = True
+        return relevant
+
+    def _update(self, playlists, directories):
+        # Covers are looked for afresh in the directories that changed
+        if len(directories) > 0:
+            list_dir.cache_clear()
+        changed_covers = {}
+        for directory in directories:
+            if self._wds.get(directory) not in self._dirs:
+                # Its watch went with it
+                self._wds.pop(directory, None)
+            for path, key in self._albums_in.get(directory, ()):
+                self.manifest.forget_cover(key)
+                changed_covers.setdefault(path, set()).add(key)
+
+        for path in sorted(playlists):
+            self._update_playlist(path)
+        for path, keys in changed_covers.items():
+            if path not in playlists and path in self.playlists:
+                self._update_covers(path, keys)
+        self.manifest.save()
+        self.ids.save()
+
+    def _update_playlist(self, path):
+        if not path.exists():
+            if path in self.playlists:
+                logging.info(f"Playlist {path} was removed")
+                self._forget(path)
+            self.manifest.forget_missing_playlists(self.root_dir)
+            return
+        if self.manifest.playlist_unchanged(path):
+            return
+        pls = list(read_playlists([(path, self.manifest.snapshot(path))], self.ids))
+        if len(pls) == 0:
+            return
+        pl = pls[0]
+        old = self.playlists.get(path)
+        albums = list(self._find(pl))
+        self._remember(pl, albums)
+        if old is None:
+            logging.info(f"{pl.title}: new playlist, submitting all of it")
+            submit(
+                self.transport,
+                [pl],
+                lambda _: albums,
+                self.manifest,
+                self.capabilities,
+                self.normaliser,
+            )
+            return
+        self._apply(pl, old[1], albums, albums)
+
+    def _update_covers(self, path, keys):
+        pl, albums = self.playlists[path]
+        changed = pl._replace(albums=[(k, t) for k, t in pl.albums if k in keys])
+        found = list(self._find(changed))
+        old = [(k, a) for k, a in albums if k in keys]
+        current = [(k, a) for k, a in albums if k not in keys] + found
+        self.playlists[path] = (pl, current)
+        self._apply(pl, old, found, current)
+
+    def _apply(self, pl, old, new, current):
+        # Withdraw the albums in old but not in new and offer those in new but not
+        # in old. current is every album in the playlist, for checking the result.
+        old_entries = {album_entry(a): (k, a) for k, a in old}
+        new_entries = {album_entry(a): (k, a) for k, a in new}
+        removed = [v for e, v in old_entries.items() if e not in new_entries]
+        added = [v for e, v in new_entries.items() if e not in old_entries]
+        if len(removed) == 0 and len(added) == 0:
+            self.manifest.record_playlist(pl.file, pl.snapshot)
+            return
+        logging.info(f"{pl.title}: {len(added)} albums added, {len(removed)} removed")
+
+        transport = self.transport
+        capabilities = self.capabilities
+        if len(removed) > 0 and "withdraw" not in capabilities:
+            # The server can only forget albums by being sent the whole playlist
+            offer_playlists(
+                transport,
+                [pl],
+                lambda _: current,
+                self.manifest,
+                capabilities,
+                self.normaliser,
+            )
+            return
+        ok = True
+        for batch in batched(removed, config["batch_size"]):
+            ok = withdraw(transport, list(batch), capabilities) and ok
+        for batch in batched(added, config["batch_size"]):
+            offered = offer_and_upload(
+                transport, list(batch), capabilities, self.normaliser
+            )
+            ok = offered and ok
+        if not ok:
+            # Start afresh with this playlist next time it changes
+            self._forget(pl.file)
+            return
+
+        if "sync" not in capabilities:
+            self.manifest.record_playlist(pl.file, pl.snapshot)
+            return
+        # Check that the server now has what we have, and if not, because it
+        # missed an earlier change, send it the whole playlist
+        digest = playlist_digest(album_entry(a) for _, a in current)
+        if pl.uuid not in differing(transport, [(pl, digest)], capabilities):
+            self.manifest.record_playlist(pl.file, pl.snapshot)
+            return
+        logging.info(f"{pl.title}: differs from the server, resubmitting")
+        offer_playlists(
+            transport,
+            [pl],
+            lambda _: current,
+            self.manifest,
+            capabilities,
+            self.normaliser,
+        )
@@ -0,0 +1,157 @@
+# Encodings for request bodies sent by the client.
+#
+# Plain JSON is always understood. The server also takes bodies compressed with
+# gzip or, if zstandard is installed, zstd, bodies encoded with msgpack if that is
+# installed, and offers in a columnar layout that sends the playlist UUID once and
+# every artist only once. It lists what it understands at /capabilities, and
+# clients only use what is listed there, so old clients and servers keep working.
+
+from gzip import compress as gzip_compress
+from io import BytesIO
+from json import dumps, loads
+import zlib
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+# Bodies below this size are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        return None
+    return msgpack
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def capabilities():
+    """The encodings this side can handle, for /capabilities."""
+    caps = ["gzip", "columnar"]
+    if _zstd() is not None:
+        caps.append("zstd")
+    if _msgpack() is not None:
+        caps.append("msgpack")
+    return caps
+
+
+def to_columnar(albums):
+    """Rearrange a list of offered albums into columns, or return None if they do
+    not all belong to the same playlist."""
+    uuids = set(a["playlist_uuid"] for a in albums)
+    if len(uuids) != 1:
+        return None
+    artists = {}
+    for a in albums:
+        artists.setdefault(a["artist"], len(artists))
+    return {
+        "playlist_uuid": uuids.pop(),
+        "artists": list(artists),
+        "artist": [artists[a["artist"]] for a in albums],
+        "title": [a["title"] for a in albums],
+        "year": [a["year"] for a in albums],
+        "timestamp": [a["timestamp"] for a in albums],
+    }
+
+
+def from_columnar(columns):
+    try:
+        artists = columns["artists"]
+        return [
+            {
+                "artist": artists[artist],
+                "title": title,
+                "year": year,
+                "timestamp": timestamp,
+                "playlist_uuid": columns["playlist_uuid"],
+            }
+            for artist, title, year, timestamp in zip(
+                columns["artist"],
+                columns["title"],
+                columns["year"],
+                columns["timestamp"],
+                strict=True,
+            )
+        ]
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise ValueError(f"Malformed columnar offer: {e}")
+
+
+def encode(payload, server_capabilities):
+    """Encode a request body as compactly as the server allows. Returns the body and
+    the headers to send with it."""
+    headers = {}
+    if "columnar" in server_capabilities and isinstance(
+        payload.get("albums"), list
+    ):
+        columns = to_columnar(payload["albums"])
+        if columns is not None:
+            payload = payload | {"albums": columns, "format": "columnar"}
+
+    msgpack = _msgpack()
+    if msgpack is not None and "msgpack" in server_capabilities:
+        body = msgpack.packb(payload)
+        headers["Content-Type"] = MSGPACK
+    else:
+        body = dumps(payload).encode()
+        headers["Content-Type"] = JSON
+
+    if len(body) < MIN_COMPRESS_SIZE:
+        return body, headers
+    zstd = _zstd()
+    if zstd is not None and "zstd" in server_capabilities:
+        body = zstd.ZstdCompressor().compress(body)
+        headers["Content-Encoding"] = "zstd"
+    elif "gzip" in server_capabilities:
+        body = gzip_compress(body)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+def _decompress(body, encoding, limit):
+    if encoding in (None, "", "identity"):
+        return body
+    if encoding == "gzip":
+        d = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        try:
+            out = d.decompress(body, limit + 1)
+        except zlib.error as e:
+            raise ValueError(f"Malformed gzip body: {e}")
+    elif encoding == "zstd" and _zstd() is not None:
+        try:
+            reader = _zstd().ZstdDecompressor().stream_reader(BytesIO(body))
+            out = reader.read(limit + 1)
+        except _zstd().ZstdError as e:
+            raise ValueError(f"Malformed zstd body: {e}")
+    else:
+        raise ValueError(f"Unsupported Content-Encoding {encoding}")
+    if len(out) > limit:
+        raise ValueError(f"Body is larger than {limit} bytes when decompressed")
+    return out
+
+
+def decode(body, content_type, content_encoding, limit):
+    """Decode a request body encoded by encode(). Raises ValueError if it cannot."""
+    body = _decompress(body, content_encoding, limit)
+    if content_type == MSGPACK:
+        msgpack = _msgpack()
+        if msgpack is None:
+            raise ValueError(f"Unsupported Content-Type {content_type}")
+        try:
+            payload = msgpack.unpackb(body)
+        except Exception as e:
+            raise ValueError(f"Malformed msgpack body: {e}")
+    else:
+        payload = loads(body)
+    if isinstance(payload, dict) and payload.get("format") == "columnar":
+        payload = payload | {"albums": from_columnar(payload.get("albums", {}))}
+    return payload
@@ -0,0 +1,22 @@
+# The benchmarks need pytest-benchmark, which is in the test extra. Without it
+# they are skipped rather than failing for want of the benchmark fixture.
+
+from pathlib import Path
+
+import pytest
+
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
+
+HERE = Path(__file__).parent
+
+
+def pytest_collection_modifyitems(config, items):
+    if pytest_benchmark is not None:
+        return
+    skip = pytest.mark.skip(reason="needs pytest-benchmark")
+    for item in items:
+        if item.path.is_relative_to(HERE):
+            item.add_marker(skip)
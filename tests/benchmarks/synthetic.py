@@ -0,0 +1,82 @@
+# Synthetic libraries for the benchmarks.
+
+from os import makedirs
+from pathlib import Path
+
+from fiio_shuffle.playlist import write_playlist
+
+from images import colour, png
+
+TRACKS_PER_ALBUM = 3
+ALBUMS_PER_PLAYLIST = 1000
+
+
+def album_tracks(music, i, tracks_per_album=TRACKS_PER_ALBUM, cover=True):
+    """Make the directory of the i-th album under music, with a cover of its own
+    if cover is true, and return its tracks as (uri, meta) pairs."""
+    album_dir = music / f"Artist {i % 97}" / f"Album {i}"
+    makedirs(album_dir, exist_ok=True)
+    if cover:
+        (album_dir / "cover.png").write_bytes(png(64, 64, colour(i)))
+    return [
+        (
+            str(album_dir / f"{t + 1:02}.flac"),
+            {
+                "artist": f"Artist {i % 97}",
+                "album": f"Album {i}",
+                "year": str(1960 + i % 60),
+                "title": f"Track {t + 1}",
+            },
+        )
+        for t in range(tracks_per_album)
+    ]
+
+
+def make_library(
+    root,
+    n_albums,
+    tracks_per_album=TRACKS_PER_ALBUM,
+    albums_per_playlist=ALBUMS_PER_PLAYLIST,
+):
+    """Write a synthetic library of n_albums albums to root: a directory per album
+    with a cover of its own, and playlists of at most albums_per_playlist albums.
+    The first playlist holds every album. Returns the playlist files."""
+    root = Path(root)
+    tracks = []
+    for i in range(n_albums):
+        tracks += album_tracks(root / "music", i, tracks_per_album)
+
+    playlists = root / "playlists"
+    makedirs(playlists, exist_ok=True)
+    files = [playlists / "all.dbpl"]
+    write_playlist(files[0], tracks, {"title": "All"})
+    per_playlist = albums_per_playlist * tracks_per_album
+    for n, start in enumerate(range(0, len(tracks), per_playlist)):
+        f = playlists / f"part{n}.dbpl"
+        write_playlist(f, tracks[start : start + per_playlist], {"title": f"Part {n}"})
+        files.append(f)
+    return files
+
+
+def make_playlists(root, n_playlists, tracks_per_playlist):
+    """Write n_playlists playlists of tracks_per_playlist tracks each to root, and
+    return their files. The tracks' files and covers are not made, so this is only
+    good for reading the playlists."""
+    root = Path(root)
+    files = []
+    for n in range(n_playlists):
+        tracks = []
+        for t in range(tracks_per_playlist):
+            i = n * tracks_per_playlist + t
+            album = i // TRACKS_PER_ALBUM
+            meta = {
+                "artist": f"Artist {album % 97}",
+                "album": f"Album {album}",
+                "year": str(1960 + album % 60),
+                "title": f"Track {i % TRACKS_PER_ALBUM + 1}",
+            }
+            tracks.append((str(root / "music" / f"Album {album}" / f"{i}.flac"), meta))
+        f = root / f"playlist{n}.dbpl"
+        write_playlist(f, tracks, {"title": f"Playlist {n}"})
+        files.append(f)
+    return files
@@ -0,0 +1,141 @@
+# Picking albums from the in-memory index, on libraries of up to a million albums,
+# against the ORDER BY random() query that it replaced. Every album has a cover,
+# and is in the playlist of everything and in one of PLAYLISTS others.
+
+from datetime import datetime
+from random import Random
+from uuid import UUID
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import joinedload
+import pytest
+
+from fiio_shuffle.album_index import AlbumIndex
+from fiio_shuffle.db import get_db
+from fiio_shuffle.generation import generation
+from fiio_shuffle.models import Album, AlbumInPlaylist, Cover, Playlist
+
+SIZES = [10_000, 100_000, 1_000_000]
+PLAYLISTS = 20
+CHUNK = 100_000
+
+
+@pytest.fixture(scope="module", params=SIZES)
+def library(request, fresh_dirs, tmp_path_factory):
+    n_albums = request.param
+    rng = Random(n_albums)
+    playlists = [UUID(int=i + 1) for i in range(PLAYLISTS + 1)]
+    everything = playlists[0]
+    added = datetime(2000, 1, 1)
+    with fresh_dirs(tmp_path_factory.mktemp("index")):
+        with get_db().engine.begin() as conn:
+            conn.execute(
+                insert(Playlist),
+                [
+                    {"uuid": u, "title": f"Playlist {i}"}
+                    for i, u in enumerate(playlists)
+                ],
+            )
+            for start in range(1, n_albums + 1, CHUNK):
+                ids = range(start, min(start + CHUNK, n_albums + 1))
+                covers = [
+                    {"id": i, "added": added, "uuid": UUID(int=i), "extension": ".jpg"}
+                    for i in ids
+                ]
+                conn.execute(insert(Cover), covers)
+                albums = [
+                    {
+                        "id": i,
+                        "added": added,
+                        "artist": f"Artist {i % 997}",
+                        "title": f"Album {i}",
+                        "year": 1960 + i % 60,
+                        "cover_id": i,
+                    }
+                    for i in ids
+                ]
+                conn.execute(insert(Album), albums)
+                rows = []
+                for album_id in ids:
+                    rows.append({"playlist_uuid": everything, "album_id": album_id})
+                    uuid = rng.choice(playlists[1:])
+                    rows.append({"playlist_uuid": uuid, "album_id": album_id})
+                conn.execute(insert(AlbumInPlaylist), rows)
+        with get_db().session() as session:
+            yield playlists, session
+
+
+def _order_by_random(playlists, session):
+    # How albums were picked before there was an index
+    q = select(Album).options(joinedload(Album.cover)).join(Album.playlists)
+    if len(playlists) != 0:
+        q = q.filter(Playlist.uuid.in_(playlists))
+    q = q.group_by(Album.id).order_by(func.random()).limit(1)
+    return session.execute(q).scalar()
+
+
+def _pick(index, playlists, session):
+    # How albums are picked now, loading the album as get_random_album does
+    album_id = index.pick(playlists, session)
+    return session.get(Album, album_id, options=[joinedload(Album.cover)])
+
+
+# Which playlists to pick from: any, one, or several
+FILTERS = {"all": slice(0, 0), "playlist": slice(1, 2), "union": slice(1, 4)}
+
+
+@pytest.mark.parametrize("playlists", FILTERS)
+def test_order_by_random(benchmark, library, playlists):
+    uuids, session = library
+    chosen = uuids[FILTERS[playlists]]
+    album = benchmark.pedantic(
+        _order_by_random, args=(chosen, session), rounds=5, warmup_rounds=1
+    )
+    assert album.cover is not None
+
+
+@pytest.mark.parametrize("playlists", FILTERS)
+def test_pick_album(benchmark, library, playlists):
+    uuids, session = library
+    chosen = uuids[FILTERS[playlists]]
+    index = AlbumIndex()
+    index.pick(chosen, session)
+    album = benchmark(_pick, index, chosen, session)
+    assert album.cover is not None
+
+
+def test_build(benchmark, library):
+    _, session = library
+    index = AlbumIndex()
+    benchmark.pedantic(
+        index.album_ids, args=([], session), setup=generation.bump, rounds=3
+    )
+
+
+def test_pick(benchmark, library):
+    _, session = library
+    index = AlbumIndex()
+    index.pick([], session)
+    benchmark(index.pick, [], session)
+
+
+def test_pick_from_playlist(benchmark, library):
+    playlists, session = library
+    index = AlbumIndex()
+    index.pick(playlists[1:2], session)
+    benchmark(index.pick, playlists[1:2], session)
+
+
+def test_pick_from_union(benchmark, library):
+    # The union of several playlists is built on first use and kept
+    playlists, session = library
+    index = AlbumIndex()
+    index.pick(playlists[1:4], session)
+    benchmark(index.pick, playlists[1:4], session)
+
+
+def test_deal(benchmark, library):
+    _, session = library
+    index = AlbumIndex()
+    index.deal([], session)
+    benchmark(index.deal, [], session)
@@ -0,0 +1,159 @@
+# The hot paths of the client and the server, on synthetic libraries of several
+# sizes. Compare runs with pytest-benchmark's --benchmark-autosave and
+# --benchmark-compare.
+
+from contextlib import contextmanager
+from io import BytesIO
+from itertools import count
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from fiio_shuffle.client import (
+    _find_albums_in_playlist,
+    _get_capabilities,
+    _read_playlist,
+    _submit_playlists,
+    list_dir,
+    offer_and_upload,
+    read_playlists,
+)
+from fiio_shuffle.config import config
+from fiio_shuffle.controllers import get_random_album, process_offers, upload_cover
+from fiio_shuffle.generation import generation
+from fiio_shuffle.manifest import Manifest, PlaylistIds
+from fiio_shuffle.musicbrainz import CoverFetcher
+
+from images import colour, png
+from synthetic import make_library
+from transport import ClientTransport
+
+SIZES = [100, 1000, 10000]
+
+
+@pytest.fixture(scope="module", params=SIZES)
+def library(request, tmp_path_factory):
+    n_albums = request.param
+    return n_albums, make_library(tmp_path_factory.mktemp("library"), n_albums)
+
+
+class Client:
+    # The scanned library and a connection to a server, as run_client has them
+    def __init__(self, files):
+        from fiio_shuffle.server import server
+
+        self.client = server.test_client()
+        self.transport = ClientTransport(self.client)
+        self.capabilities = _get_capabilities(self.transport)
+        manifest = Manifest("http://benchmark")
+        pairs = [(f, manifest.snapshot(f)) for f in files]
+        self.pls = list(read_playlists(pairs, PlaylistIds()))
+        with CoverFetcher(config.get("musicbrainz", {})) as fetcher:
+            self.albums = list(
+                _find_albums_in_playlist(self.pls[0], Manifest("x"), fetcher)
+            )
+        self.batches = [
+            self.albums[i : i + config["batch_size"]]
+            for i in range(0, len(self.albums), config["batch_size"])
+        ]
+
+    def offer_all(self):
+        submissions = [{"title": pl.title, "uuid": pl.uuid} for pl in self.pls]
+        _submit_playlists(self.transport, submissions, self.capabilities)
+        for batch in self.batches:
+            offer_and_upload(self.transport, batch, self.capabilities)
+
+
+@contextmanager
+def _server(fresh_dirs, path):
+    # Point the server at fresh directories, without compiling the stylesheet
+    from fiio_shuffle import server as server_module
+
+    with fresh_dirs(path), pytest.MonkeyPatch.context() as mp:
+        mp.setattr(server_module, "_stylesheet_url", "/assets/style.css")
+        mp.setattr(server_module, "_index_page", None)
+        yield
+
+
+@pytest.fixture(scope="module")
+def populated(library, fresh_dirs, tmp_path_factory):
+    """A server that has been offered every album in library, and a client of it."""
+    _, files = library
+    with _server(fresh_dirs, tmp_path_factory.mktemp("server")):
+        client = Client(files)
+        client.offer_all()
+        yield client
+
+
+@pytest.fixture
+def empty(library, fresh_dirs, tmp_path):
+    _, files = library
+    with _server(fresh_dirs, tmp_path):
+        yield Client(files)
+
+
+def test_read_playlist(benchmark, library):
+    _, files = library
+    benchmark(_read_playlist, files[0])
+
+
+def test_find_albums_in_playlist(benchmark, populated):
+    pl = populated.pls[0]
+
+    def find_albums():
+        list_dir.cache_clear()
+        return list(_find_albums_in_playlist(pl, Manifest("x"), fetcher))
+
+    with CoverFetcher(config.get("musicbrainz", {})) as fetcher:
+        benchmark(find_albums)
+
+
+def test_offer_and_upload_first(benchmark, empty):
+    # Populates the database and uploads every cover, so it can only run once
+    benchmark.pedantic(empty.offer_all, rounds=1, iterations=1)
+
+
+def test_offer_and_upload(benchmark, populated):
+    # Nothing is left to upload
+    benchmark(populated.offer_all)
+
+
+def test_process_offers(benchmark, populated):
+    offer = {
+        "albums": [
+            {k: v for k, v in a._asdict().items() if k != "cover_uri"}
+            for _, a in populated.batches[0]
+        ]
+    }
+    benchmark(process_offers, offer)
+
+
+def test_upload_cover(benchmark, library, populated):
+    n_albums, _ = library
+    albums = populated.albums
+    covers = count(n_albums)
+
+    def upload():
+        i = next(covers)
+        cover = FileStorage(BytesIO(png(64, 64, colour(i))), filename="cover.png")
+        _, a = albums[i % len(albums)]
+        data = {"artist": a.artist, "title": a.title, "year": a.year}
+        upload_cover(cover, {"data": data})
+
+    benchmark(upload)
+
+
+def test_get_random_album_cold(benchmark, populated):
+    benchmark.pedantic(get_random_album, args=([],), setup=generation.bump, rounds=5)
+
+
+def test_get_random_album(benchmark, populated):
+    benchmark(get_random_album, [])
+
+
+def test_index(benchmark, populated):
+    def index():
+        resp = populated.client.get("/")
+        assert resp.status_code == 200
+
+    benchmark(index)
@@ -0,0 +1,45 @@
+# Reading a library of 50 playlists of 200k tracks in all, as the client does at
+# the start of a run. Besides the time, the peak memory of the parent process and
+# of the workers that parse the playlists is saved with the results.
+
+from math import ceil
+from resource import RUSAGE_CHILDREN, getrusage
+import tracemalloc
+
+import pytest
+
+from fiio_shuffle.client import read_playlists
+from fiio_shuffle.manifest import Manifest, PlaylistIds
+
+from synthetic import TRACKS_PER_ALBUM, make_playlists
+
+PLAYLISTS = 50
+TRACKS = 200_000
+
+
+@pytest.fixture(scope="module")
+def playlists(tmp_path_factory):
+    files = make_playlists(
+        tmp_path_factory.mktemp("playlists"), PLAYLISTS, TRACKS // PLAYLISTS
+    )
+    manifest = Manifest("http://benchmark")
+    return [(f, manifest.snapshot(f)) for f in files]
+
+
+def _read(pairs):
+    return list(read_playlists(pairs, PlaylistIds()))
+
+
+def test_read_playlists(benchmark, playlists):
+    pls = benchmark.pedantic(_read, args=(playlists,), rounds=3)
+    assert len(pls) == PLAYLISTS
+    per_playlist = ceil(TRACKS / PLAYLISTS / TRACKS_PER_ALBUM)
+    assert all(len(pl.albums) == per_playlist for pl in pls)
+
+    tracemalloc.start()
+    _read(playlists)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    benchmark.extra_info["parent_peak_bytes"] = peak
+    # The largest resident set of any worker so far, in KiB
+    benchmark.extra_info["worker_max_rss_kib"] = getrusage(RUSAGE_CHILDREN).ru_maxrss
@@ -0,0 +1,43 @@
+# Finding the covers of albums on disk, on synthetic trees of several sizes. Every
+# track is looked up, as if each were the first of its album, so that the albums'
+# directories are asked about many times over; half the albums have no cover, so
+# that their lookups go through every candidate name and the download cache too.
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from fiio_shuffle.client import _find_local_cover, list_dir
+from fiio_shuffle.config import config
+from fiio_shuffle.playlist import Track
+
+from synthetic import album_tracks
+
+SIZES = [1000, 10000]
+TRACKS_PER_ALBUM = 10
+
+
+@pytest.fixture(scope="module", params=SIZES)
+def tree(request, tmp_path_factory):
+    n_albums = request.param
+    music = tmp_path_factory.mktemp("tree")
+    tracks = []
+    for i in range(n_albums):
+        pairs = album_tracks(music, i, TRACKS_PER_ALBUM, cover=i % 2 == 0)
+        for uri, meta in pairs:
+            Path(uri).touch()
+            tracks.append(Track(uri=uri, meta=meta))
+    return n_albums, tracks
+
+
+def _find_covers(tracks):
+    list_dir.cache_clear()
+    with ThreadPoolExecutor(config["cover_threads"]) as pool:
+        return list(pool.map(_find_local_cover, tracks))
+
+
+def test_find_local_covers(benchmark, tree):
+    n_albums, tracks = tree
+    found = benchmark.pedantic(_find_covers, args=(tracks,), rounds=3)
+    assert sum(1 for c in found if c is not None) == n_albums // 2 * TRACKS_PER_ALBUM
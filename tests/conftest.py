@@ -0,0 +1,93 @@
+# Every test that needs them gets data and cache directories of its own under
+# tmp_path, so that tests never see each other's databases and nothing outside
+# tmp_path is touched. The configuration is only read once per process, so it lives
+# in a scratch directory shared by the whole session, set up before any test module
+# is imported.
+
+from contextlib import contextmanager
+from json import dump
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+import os
+
+import pytest
+
+AUTH_KEY = "test-key"
+
+_scratch = Path(mkdtemp(prefix="fiio-shuffle-tests-"))
+os.environ["HOME"] = str(_scratch / "home")
+os.environ["XDG_DATA_HOME"] = str(_scratch / "data")
+os.environ["XDG_CONFIG_HOME"] = str(_scratch / "config")
+(_scratch / "config" / "FiiO-shuffle").mkdir(parents=True)
+with (_scratch / "config" / "FiiO-shuffle" / "config.json").open("w") as f:
+    dump({"auth_key": AUTH_KEY}, f)
+
+
+def pytest_unconfigure(config):
+    rmtree(_scratch, ignore_errors=True)
+
+
+def _reset():
+    # Forget the state that the server keeps for the process, which belongs to the
+    # data directory it was set up in
+    from fiio_shuffle import db
+    from fiio_shuffle.album_index import album_index
+    from fiio_shuffle.generation import generation
+
+    if db._db is not None:
+        db._db.engine.dispose()
+        db._db = None
+    if generation._map is not None:
+        generation._map.close()
+        os.close(generation._fd)
+        generation._map = generation._fd = None
+    album_index.__init__()
+
+
+@pytest.fixture
+def auth_key():
+    return AUTH_KEY
+
+
+@contextmanager
+def _fresh_dirs(path):
+    from fiio_shuffle.utils import get_data_dir
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("HOME", str(path / "home"))
+        mp.setenv("XDG_DATA_HOME", str(path / "data"))
+        _reset()
+        try:
+            yield get_data_dir()
+        finally:
+            _reset()
+
+
+@pytest.fixture(scope="session")
+def fresh_dirs():
+    """Context manager that points the data and cache directories at a directory,
+    for fixtures of a wider scope than data_dir."""
+    return _fresh_dirs
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """Fresh data and cache directories, and so a fresh database."""
+    with _fresh_dirs(tmp_path) as d:
+        yield d
+
+
+@pytest.fixture
+def server(data_dir, monkeypatch):
+    from fiio_shuffle import server as server_module
+
+    # Source checkouts have no compiled stylesheet, and tests need not compile it
+    monkeypatch.setattr(server_module, "_stylesheet_url", "/assets/style.css")
+    monkeypatch.setattr(server_module, "_index_page", None)
+    return server_module.server
+
+
+@pytest.fixture
+def client(server):
+    return server.test_client()
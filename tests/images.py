@@ -0,0 +1,24 @@
+# Images for tests, written by hand so that the tests need not depend on Pillow
+
+from struct import pack
+import zlib
+
+
+def png(width, height, rgb):
+    """A minimal PNG of a single colour."""
+
+    def chunk(kind, data):
+        body = kind + data
+        return pack(">I", len(data)) + body + pack(">I", zlib.crc32(body))
+
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+
+def colour(i):
+    return (i >> 16 & 0xFF, i >> 8 & 0xFF, i & 0xFF)
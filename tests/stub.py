@@ -0,0 +1,71 @@
+# An HTTP server on localhost for tests of code that talks to other servers.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+
+
+class StubServer(ThreadingHTTPServer):
+    """Answers requests from a table of routes, in a thread of its own.
+
+    routes maps paths to a response, or to a list of responses that are given in
+    turn, the last one for good. A response is a (status, body, delay) triple.
+    Every request is recorded as a (method, path, time) triple.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, routes=None, port=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.routes = routes or {}
+        self.requests = []
+        self._thread = None
+
+    def paths(self):
+        return [path for _, path, _ in self.requests]
+
+    def _respond(self, method, path):
+        self.requests.append((method, path, monotonic()))
+        response = self.routes.get(path, (404, "", 0))
+        if isinstance(response, list):
+            response = response.pop(0) if len(response) > 1 else response[0]
+        return response
+
+    def __enter__(self):
+        self._thread = Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05})
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._respond()
+
+    def _respond(self):
+        path = urlsplit(self.path).path
+        status, body, delay = self.server._respond(self.command, path)
+        sleep(delay)
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            # The client gave up waiting
+            pass
+
+    def log_message(self, *args):
+        pass
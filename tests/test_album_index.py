@@ -0,0 +1,154 @@
+from array import array
+from collections import Counter
+from datetime import datetime
+from random import seed
+from uuid import UUID, uuid4
+
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.sqlite import insert
+import pytest
+
+from fiio_shuffle.album_index import MAX_DECKS, MAX_UNIONS, AlbumIndex, Deck
+from fiio_shuffle.db import get_db
+from fiio_shuffle.generation import generation
+from fiio_shuffle.models import Album, AlbumInPlaylist, Cover
+
+
+def _add(members):
+    # members maps playlist UUIDs to album ids, of albums with covers that are made
+    # as needed. The index does not read the playlists, so those need not exist.
+    rows = [
+        {"playlist_uuid": uuid, "album_id": album_id}
+        for uuid, album_ids in members.items()
+        for album_id in album_ids
+    ]
+    ids = {row["album_id"] for row in rows}
+    added = datetime(2000, 1, 1)
+    covers = [
+        {"id": i, "added": added, "uuid": UUID(int=i), "extension": ".jpg"} for i in ids
+    ]
+    albums = [
+        {
+            "id": i,
+            "added": added,
+            "artist": "Artist",
+            "title": f"Album {i}",
+            "year": 2000,
+            "cover_id": i,
+        }
+        for i in ids
+    ]
+    with get_db().engine.begin() as conn:
+        conn.execute(insert(Cover).on_conflict_do_nothing(), covers)
+        conn.execute(insert(Album).on_conflict_do_nothing(), albums)
+        conn.execute(insert(AlbumInPlaylist), rows)
+    generation.bump()
+
+
+@pytest.fixture
+def session(data_dir):
+    with get_db().session() as session:
+        yield session
+
+
+def test_unions_are_bounded(session):
+    playlists = [uuid4() for _ in range(12)]
+    _add({uuid: range(i * 10, i * 10 + 10) for i, uuid in enumerate(playlists)})
+    index = AlbumIndex()
+    pairs = [(a, b) for a in playlists for b in playlists if a != b]
+    assert len(pairs) > MAX_UNIONS
+    for a, b in pairs:
+        assert len(index.album_ids([a, b], session)) == 20
+    assert len(index._unions) == MAX_UNIONS
+
+
+def _deal(index, playlists, session, n):
+    return [index.deal(playlists, session) for _ in range(n)]
+
+
+def test_deal_does_not_repeat(session):
+    _add({uuid4(): range(20)})
+    index = AlbumIndex()
+    for _ in range(3):
+        assert sorted(_deal(index, [], session, 20)) == list(range(20))
+
+
+def test_deal_follows_changes(session):
+    playlist = uuid4()
+    _add({playlist: range(10)})
+    index = AlbumIndex()
+    dealt = _deal(index, [playlist], session, 5)
+    # Albums added part way through are dealt in the same round, and those
+    # removed are not dealt any more
+    _add({playlist: range(10, 20)})
+    with get_db().engine.begin() as conn:
+        conn.execute(delete(AlbumInPlaylist).where(AlbumInPlaylist.c.album_id == 19))
+    generation.bump()
+    dealt += _deal(index, [playlist], session, 14)
+    assert sorted(dealt) == list(range(19))
+
+
+@pytest.mark.parametrize("dealt", [0, 5])
+def test_removed_and_added_again(dealt):
+    # Whether or not the album was dealt before it was removed, it comes up once in
+    # the round
+    deck = Deck(array("q", range(10)))
+    first = [deck.deal() for _ in range(dealt)]
+    deck.update(array("q", [i for i in range(10) if i not in first + [9]]))
+    deck.update(array("q", [i for i in range(10) if i not in first]))
+    deck.update(array("q", range(10)))
+    assert sorted(first + [deck.deal() for _ in range(10 - dealt)]) == list(range(10))
+
+
+def test_albums_without_covers_are_not_dealt(session):
+    playlist = uuid4()
+    _add({playlist: range(4)})
+    with get_db().engine.begin() as conn:
+        conn.execute(update(Album).where(Album.id < 2).values(cover_id=None))
+    generation.bump()
+    index = AlbumIndex()
+    assert sorted(_deal(index, [playlist], session, 2)) == [2, 3]
+    assert sorted(_deal(index, [], session, 2)) == [2, 3]
+
+
+def test_deal_is_fair(session):
+    # Every album is as likely to be dealt first, and an album added part way
+    # through as likely to come at any of the places left in the round
+    seed(0)
+    first = Counter()
+    places = Counter()
+    for _ in range(4000):
+        deck = Deck(array("q", range(4)))
+        first[deck.deal()] += 1
+        deck.update(array("q", range(5)))
+        places[[deck.deal() for _ in range(4)].index(4)] += 1
+    assert sorted(first) == list(range(4))
+    assert all(900 < n < 1100 for n in first.values())
+    assert sorted(places) == list(range(4))
+    assert all(900 < n < 1100 for n in places.values())
+
+
+def test_decks_are_bounded(session):
+    playlists = [uuid4() for _ in range(MAX_DECKS + 10)]
+    _add({uuid: [i] for i, uuid in enumerate(playlists)})
+    index = AlbumIndex()
+    for i, uuid in enumerate(playlists):
+        assert index.deal([uuid], session) == i
+    assert len(index._decks) == MAX_DECKS
+
+
+def test_decks_of_playlists_that_are_gone(session):
+    gone, kept = uuid4(), uuid4()
+    _add({gone: range(10), kept: range(10, 20)})
+    index = AlbumIndex()
+    index.deal([gone], session)
+    index.deal([kept], session)
+    with get_db().engine.begin() as conn:
+        stmt = delete(AlbumInPlaylist).where(AlbumInPlaylist.c.playlist_uuid == gone)
+        conn.execute(stmt)
+    generation.bump()
+    assert index.deal([gone], session) is None
+    assert index._decks.keys() == [frozenset([kept])]
+    # Nor does the server keep decks for playlists that never existed
+    assert index.deal([uuid4()], session) is None
+    assert len(index._decks) == 1
@@ -0,0 +1,87 @@
+from io import BytesIO
+from json import dumps
+import logging
+
+import pytest
+
+from fiio_shuffle import covers
+from fiio_shuffle.config import config
+from fiio_shuffle.covers import get_variants_dir, make_variants
+
+from images import png
+
+pytest.importorskip("PIL")
+
+WIDE = png(400, 400, (0, 128, 0))
+
+
+def _post_cover(client, auth_key, image):
+    metadata = {
+        "auth_key": auth_key,
+        "data": {"artist": "Artist", "title": "Album", "year": 2000},
+    }
+    return client.post(
+        "/upload",
+        data={
+            "metadata": (BytesIO(dumps(metadata).encode()), "metadata.json"),
+            "cover": (BytesIO(image), "cover.png"),
+        },
+    )
+
+
+@pytest.fixture
+def thumbnails(monkeypatch):
+    """Set the thumbnails configuration of a test."""
+    covers._variant_format.cache_clear()
+
+    def configure(**cfg):
+        monkeypatch.setitem(config._get(), "thumbnails", {"widths": [100, 200]} | cfg)
+
+    yield configure
+    covers._variant_format.cache_clear()
+
+
+def _variants():
+    d = covers.get_covers_dir()
+    return sorted(
+        (p.name, sorted(v.name for v in p.iterdir())) for p in d.iterdir() if p.is_dir()
+    )
+
+
+def test_variants_are_made_after_the_response(client, auth_key, thumbnails):
+    thumbnails(format="webp")
+    resp = _post_cover(client, auth_key, WIDE)
+    assert resp.get_json()["success"]
+    assert _variants() == []
+    resp.close()
+    ((_, names),) = _variants()
+    assert names == ["100.webp", "200.webp"]
+
+
+@pytest.mark.parametrize(
+    "fmt,names",
+    [
+        ("JPEG", ["100.jpg", "200.jpg"]),
+        ("jpg", ["100.jpg", "200.jpg"]),
+        ("png", ["100.png", "200.png"]),
+    ],
+)
+def test_variant_formats(data_dir, tmp_path, thumbnails, fmt, names):
+    thumbnails(format=fmt)
+    path = tmp_path / "cover.png"
+    path.write_bytes(WIDE)
+    assert make_variants(path) == [100, 200]
+    assert sorted(p.name for p in get_variants_dir("cover").iterdir()) == names
+
+
+def test_unknown_variant_format(data_dir, tmp_path, thumbnails, caplog):
+    thumbnails(format="bmp")
+    path = tmp_path / "cover.png"
+    path.write_bytes(WIDE)
+    with caplog.at_level(logging.WARNING):
+        assert make_variants(path) == [100, 200]
+    assert "bmp" in caplog.text
+    assert sorted(p.name for p in get_variants_dir("cover").iterdir()) == [
+        "100.webp",
+        "200.webp",
+    ]
@@ -0,0 +1,143 @@
+from datetime import datetime
+from threading import Barrier, Thread
+from uuid import uuid4
+import os
+
+from sqlalchemy import event, func, insert, select
+
+from fiio_shuffle import db as db_module
+from fiio_shuffle.db import get_db
+from fiio_shuffle.models import AlbumInPlaylist, Offer
+
+
+def _offer(playlist_uuid, i):
+    return {
+        "artist": f"Artist {playlist_uuid}",
+        "title": f"Album {i}",
+        "year": 2000,
+        "timestamp": 1000 + i,
+        "playlist_uuid": playlist_uuid,
+    }
+
+
+def test_offers_table_is_per_connection(data_dir):
+    engine = get_db().engine
+    count = select(func.count()).select_from(Offer)
+    with engine.connect() as a, engine.connect() as b:
+        offer = _offer(uuid4(), 1) | {"timestamp": datetime.now()}
+        a.execute(insert(Offer), [offer])
+        assert a.execute(count).scalar() == 1
+        assert b.execute(count).scalar() == 0
+
+
+def test_parallel_offers(server, auth_key):
+    n_workers = 8
+    n_albums = 50
+    playlists = [str(uuid4()) for _ in range(n_workers)]
+    client = server.test_client()
+    resp = client.post(
+        "/playlists",
+        json={
+            "auth_key": auth_key,
+            "playlists": [{"uuid": u, "title": u} for u in playlists],
+        },
+    )
+    assert resp.json["success"]
+
+    barrier = Barrier(n_workers)
+    results = {}
+
+    def offer(playlist_uuid):
+        albums = [_offer(playlist_uuid, i) for i in range(n_albums)]
+        client = server.test_client()
+        barrier.wait()
+        resp = client.post("/offer", json={"auth_key": auth_key, "albums": albums})
+        results[playlist_uuid] = (albums, resp.json)
+
+    threads = [Thread(target=offer, args=(u,)) for u in playlists]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for albums, json in results.values():
+        # Every album is new, so all of them, and only them, are accepted
+        assert json["success"]
+        assert json["albums"] == albums
+    with get_db().session() as session:
+        q = select(AlbumInPlaylist.c.playlist_uuid, func.count()).group_by(
+            AlbumInPlaylist.c.playlist_uuid
+        )
+        members = {str(u): n for u, n in session.execute(q)}
+    assert members == {u: n_albums for u in playlists}
+
+
+def test_fork_gets_fresh_pool(data_dir):
+    db = get_db()
+    with db.engine.connect() as conn:
+        conn.execute(select(1))
+    assert db.engine.pool.checkedin() == 1
+
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            # The pool was replaced as the child started, before anything used it
+            fresh = db_module._db.pid == os.getpid() and db.engine.pool.checkedin() == 0
+            with get_db().engine.connect() as conn:
+                conn.execute(select(1))
+            code = 0 if fresh else 2
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+    # The child did not close the connection it inherited from the parent
+    assert db.engine.pool.checkedin() == 1
+    with db.engine.connect() as conn:
+        assert conn.execute(select(1)).scalar() == 1
+
+
+def test_requests_share_the_engine(client, auth_key, monkeypatch):
+    db = get_db()
+    engines = []
+    create_engine = db_module.create_engine
+
+    def record(*args, **kwargs):
+        engines.append(create_engine(*args, **kwargs))
+        return engines[-1]
+
+    monkeypatch.setattr(db_module, "create_engine", record)
+    statements = []
+    connections = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def connect(dbapi_connection, connection_record):
+        connections.append(dbapi_connection)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(db.engine, "connect", connect)
+    try:
+        playlist = str(uuid4())
+        pls = [{"uuid": playlist, "title": "Playlist"}]
+        client.post("/playlists", json={"auth_key": auth_key, "playlists": pls})
+        for i in range(50):
+            albums = [_offer(playlist, i)]
+            resp = client.post("/offer", json={"auth_key": auth_key, "albums": albums})
+            assert resp.json["success"]
+            pls = [{"uuid": playlist, "digest": ""}]
+            resp = client.post("/sync", json={"auth_key": auth_key, "playlists": pls})
+            assert resp.json["success"]
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        event.remove(db.engine, "connect", connect)
+
+    assert engines == []
+    assert db_module._db is db
+    assert len(statements) > 100
+    ddl = ("CREATE", "ALTER", "DROP", "PRAGMA")
+    assert [s for s in statements if s.lstrip().upper().startswith(ddl)] == []
+    # Nor were connections opened, and their temporary tables created, per request
+    assert len(connections) <= 1
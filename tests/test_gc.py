@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+from io import BytesIO
+from time import time
+import os
+
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session
+from werkzeug.datastructures import FileStorage
+import pytest
+
+from fiio_shuffle import covers
+from fiio_shuffle.controllers import upload_cover
+from fiio_shuffle.covers import (
+    GRACE_PERIOD,
+    collect_garbage,
+    cover_path,
+    get_variants_dir,
+    store_cover,
+)
+from fiio_shuffle.db import get_db
+from fiio_shuffle.models import Album, Cover
+
+from images import png
+
+RED = png(8, 8, (255, 0, 0))
+BLUE = png(8, 8, (0, 0, 255))
+
+
+def _upload(data, image):
+    cover = FileStorage(BytesIO(image), filename="cover.png")
+    return upload_cover(cover, {"data": data}).json
+
+
+def _covers():
+    with get_db().session() as session:
+        return list(session.execute(select(Cover)).scalars())
+
+
+def _album_cover(title):
+    with get_db().session() as session:
+        album = session.execute(select(Album).where(Album.title == title)).scalar()
+        return album.cover_id and cover_path(album.cover)
+
+
+def _age(cover):
+    # As if the cover was last stored longer ago than the grace period
+    past = time() - 2 * GRACE_PERIOD
+    os.utime(cover_path(cover), (past, past))
+    with get_db().engine.begin() as conn:
+        added = datetime.now() - 2 * timedelta(seconds=GRACE_PERIOD)
+        conn.execute(update(Cover).where(Cover.id == cover.id).values(added=added))
+
+
+@pytest.fixture
+def unused(data_dir):
+    """An old cover that no album uses any more: the red one, replaced by blue."""
+    album = {"artist": "Artist", "title": "Album", "year": 2000}
+    assert _upload(album, RED)["success"]
+    (red,) = _covers()
+    assert _upload(album, BLUE)["success"]
+    _age(red)
+    return red
+
+
+@pytest.fixture
+def stale_check(monkeypatch):
+    """Make the collector's first look at a file's mtime come just before an
+    upload stores the same bytes again."""
+    real = covers._recently_written
+    calls = []
+
+    def check(path, now):
+        calls.append(path)
+        if len(calls) > 1:
+            return real(path, now)
+        # The collector looked just before an upload stored the file again
+        store_cover(FileStorage(BytesIO(RED), filename="cover.png"), ".png")
+        return False
+
+    monkeypatch.setattr(covers, "_recently_written", check)
+    return calls
+
+
+def test_collects_unused_covers(unused):
+    assert collect_garbage(get_db(), pause=0) == (1, 0)
+    assert len(_covers()) == 1
+    assert not cover_path(unused).exists()
+    assert not get_variants_dir(unused.uuid).exists()
+
+
+def test_keeps_recently_stored_covers(unused):
+    os.utime(cover_path(unused))
+    assert collect_garbage(get_db(), pause=0) == (0, 0)
+    assert len(_covers()) == 2
+    assert cover_path(unused).exists()
+
+
+def test_upload_after_check(unused, stale_check):
+    # The collector deletes the row, but leaves the file that was stored again
+    assert collect_garbage(get_db(), pause=0) == (1, 0)
+    assert len(stale_check) > 0
+    assert cover_path(unused).exists()
+
+    # The upload that stored it then finds no row, and makes one
+    album = {"artist": "Other", "title": "Other", "year": 2000}
+    assert _upload(album, RED)["success"]
+    path = _album_cover("Other")
+    assert path == cover_path(unused)
+    assert path.exists()
+
+
+def test_collection_before_commit(unused, stale_check):
+    # An upload finds the row of the unused cover, and the collector deletes it
+    # before the upload commits
+    def collect(session):
+        assert collect_garbage(get_db(), pause=0) == (1, 0)
+
+    event.listen(Session, "before_commit", collect, once=True)
+    album = {"artist": "Other", "title": "Other", "year": 2000}
+    assert _upload(album, RED)["success"]
+    assert len(stale_check) > 0
+    path = _album_cover("Other")
+    assert path == cover_path(unused)
+    assert path.exists()
+    assert len(_covers()) == 2
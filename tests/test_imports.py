@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Importing the package, and parsing the command line, is all that every task
+# does before it starts; none of these is needed for that
+HEAVY = ["flask", "sqlalchemy", "requests", "PIL", "magic"]
+
+
+@pytest.mark.parametrize("module", ["fiio_shuffle", "fiio_shuffle.args"])
+def test_import_is_light(module):
+    # In a fresh interpreter, since this one has imported everything already
+    code = f"import sys, {module}; print(' '.join(sorted(sys.modules)))"
+    env = os.environ | {"PYTHONPATH": os.pathsep.join(sys.path)}
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = set(out.stdout.split())
+    assert [m for m in HEAVY if m in imported] == []
@@ -0,0 +1,74 @@
+from os import stat, utime
+
+import pytest
+
+from fiio_shuffle.client import _find_playlists, _load_manifest
+from fiio_shuffle.manifest import Manifest
+
+URL = "http://server"
+
+
+@pytest.fixture
+def root(data_dir, tmp_path):
+    """A root directory with two playlists, both submitted to URL."""
+    root = tmp_path / "root"
+    root.mkdir()
+    manifest = Manifest(URL)
+    for name in ["a.dbpl", "b.dbpl"]:
+        (root / name).write_bytes(b"playlist " + name.encode())
+        manifest.record_playlist(root / name, manifest.snapshot(root / name))
+    manifest.record_cover(("Artist", "Album", 2000), root / "cover.jpg", 0)
+    manifest.save()
+    return root
+
+
+def _changed(root, full=False):
+    manifest = _load_manifest(URL, root, full)
+    return sorted(f.name for f, _ in _find_playlists(root, manifest)), manifest
+
+
+def test_unchanged_playlists_are_skipped(root):
+    assert _changed(root)[0] == []
+
+
+def test_touched_playlist_is_skipped(root):
+    # Only the mtime changed, so the contents are hashed, and the new mtime kept
+    utime(root / "a.dbpl", ns=(0, 0))
+    changed, manifest = _changed(root)
+    assert changed == []
+    assert manifest.playlists[str(root / "a.dbpl")]["mtime_ns"] == 0
+
+
+def test_changed_playlists_are_read_again(root):
+    (root / "a.dbpl").write_bytes(b"a longer playlist")
+    # Same size, other contents, other mtime
+    mtime = stat(root / "b.dbpl").st_mtime_ns
+    (root / "b.dbpl").write_bytes(b"playlist B.dbpl")
+    utime(root / "b.dbpl", ns=(mtime + 10**9, mtime + 10**9))
+    assert _changed(root)[0] == ["a.dbpl", "b.dbpl"]
+
+
+def test_full_ignores_the_manifest(root):
+    changed, manifest = _changed(root, full=True)
+    assert changed == ["a.dbpl", "b.dbpl"]
+    assert manifest.cover(("Artist", "Album", 2000)) is None
+
+
+def test_roots_do_not_forget_each_other(root, tmp_path):
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "c.dbpl").write_bytes(b"playlist c")
+    manifest = _load_manifest(URL, other, full=False)
+    manifest.record_playlist(other / "c.dbpl", manifest.snapshot(other / "c.dbpl"))
+    manifest.save()
+    assert _changed(root)[0] == []
+
+    # Playlists that are gone are forgotten, but only from their own root
+    (root / "b.dbpl").unlink()
+    manifest = _load_manifest(URL, root, full=False)
+    assert sorted(manifest.playlists) == [str(other / "c.dbpl"), str(root / "a.dbpl")]
+    manifest.save()
+
+    # Nor does a full run on one root forget the other
+    _changed(root, full=True)[1].save()
+    assert _find_playlists(other, _load_manifest(URL, other, False)) == []
@@ -0,0 +1,10 @@
+from fiio_shuffle.metrics import statement_shape
+
+
+def test_statement_shape():
+    assert statement_shape("SELECT id\n  FROM albums WHERE id IN (?, ?,?)") == (
+        "SELECT id FROM albums WHERE id IN (?, ...)"
+    )
+    assert statement_shape("INSERT INTO t (a, b) VALUES (?, ?), (?, ?), (?, ?)") == (
+        "INSERT INTO t (a, b) VALUES (?, ...), ..."
+    )
@@ -0,0 +1,91 @@
+from sqlalchemy import create_engine, inspect
+import pytest
+
+from fiio_shuffle.db import get_db
+from fiio_shuffle.migrations import (
+    SCHEMA_VERSION,
+    _set_schema_version,
+    get_schema_version,
+    migrate,
+)
+from fiio_shuffle.models import Base
+
+INDEXES = {
+    "albums_in_playlists": "ix_albums_in_playlists_playlist_uuid",
+    "albums": "ix_albums_cover_id",
+    "covers": "ix_covers_uuid",
+}
+
+# The lookups that the indexes are for, as the server makes them
+LOOKUPS = {
+    "ix_albums_in_playlists_playlist_uuid": (
+        "SELECT album_id FROM albums_in_playlists WHERE playlist_uuid = ?"
+    ),
+    "ix_albums_cover_id": "SELECT id FROM albums WHERE cover_id = ?",
+    "ix_covers_uuid": "SELECT id, extension FROM covers WHERE uuid = ?",
+}
+
+
+def _indexes(conn):
+    inspector = inspect(conn)
+    return {
+        table: {ix["name"] for ix in inspector.get_indexes(table)} for table in INDEXES
+    }
+
+
+@pytest.mark.parametrize("index", LOOKUPS)
+def test_lookups_use_indexes(data_dir, index):
+    with get_db().engine.connect() as conn:
+        plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + LOOKUPS[index], (1,))
+        details = " ".join(row[-1] for row in plan)
+    assert f"INDEX {index}" in details
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fiio_shuffle.sqlite3'}")
+    yield engine
+    engine.dispose()
+
+
+def test_fresh_database_is_up_to_date(engine):
+    migrate(engine)
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == SCHEMA_VERSION
+        for table, index in INDEXES.items():
+            assert index in _indexes(conn)[table]
+
+
+def test_migrate_from_version_0(engine):
+    # A database made before there were migrations, without the indexes, and
+    # without the timestamps that members count towards the digests with
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        for index in INDEXES.values():
+            conn.exec_driver_sql(f"DROP INDEX {index}")
+        conn.exec_driver_sql(
+            "ALTER TABLE albums_in_playlists DROP COLUMN digest_timestamp"
+        )
+        conn.exec_driver_sql("INSERT INTO playlists (uuid, title) VALUES ('p', 'P')")
+        conn.exec_driver_sql(
+            "INSERT INTO playlist_digests (playlist_uuid, digest) VALUES ('p', 'ab')"
+        )
+        _set_schema_version(conn, 0)
+    migrate(engine)
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == SCHEMA_VERSION
+        for table, index in INDEXES.items():
+            assert index in _indexes(conn)[table]
+        columns = inspect(conn).get_columns("albums_in_playlists")
+        assert "digest_timestamp" in {c["name"] for c in columns}
+        # The old digest cannot say which members it counts
+        digests = conn.exec_driver_sql("SELECT digest FROM playlist_digests")
+        assert digests.all() == [("",)]
+
+
+def test_refuses_newer_databases(engine):
+    migrate(engine)
+    with engine.begin() as conn:
+        _set_schema_version(conn, SCHEMA_VERSION + 1)
+    with pytest.raises(RuntimeError):
+        migrate(engine)
@@ -0,0 +1,142 @@
+from time import monotonic, sleep
+
+import pytest
+
+from fiio_shuffle.musicbrainz import CoverFetcher
+
+from stub import StubServer
+
+RELEASE_GROUP = (
+    '<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#"><release-group-list>'
+    '<release-group id="{}"/></release-group-list></metadata>'
+)
+IMAGE = b"\x89PNG\r\n\x1a\ncover"
+
+
+@pytest.fixture
+def stub():
+    """MusicBrainz and the Cover Art Archive, with a cover for every album."""
+    with StubServer() as stub:
+        stub.routes = {
+            "/ws/2/release-group/": (200, RELEASE_GROUP.format("rg"), 0),
+            "/release-group/rg/": (
+                200,
+                f'{{"images": [{{"image": "{stub.url}/i"}}]}}',
+                0,
+            ),
+            "/i": (200, IMAGE, 0),
+        }
+        yield stub
+
+
+@pytest.fixture
+def fetcher(data_dir, stub):
+    """Make fetchers that ask the stub, by default without a rate limit to speak
+    of."""
+    fetchers = []
+
+    def make(**cfg):
+        f = CoverFetcher(
+            {
+                "url": stub.url,
+                "coverartarchive_url": stub.url,
+                "default_rate": 1000,
+                "timeout": 1,
+            }
+            | cfg
+        )
+        fetchers.append(f)
+        return f
+
+    yield make
+    for f in fetchers:
+        f.close()
+
+
+def test_fetch(fetcher, stub, tmp_path):
+    f = fetcher()
+    dest = tmp_path / "cover"
+    assert f.fetch("Artist", "Album", dest) == dest
+    assert dest.read_bytes() == IMAGE
+    assert stub.paths() == ["/ws/2/release-group/", "/release-group/rg/", "/i"]
+    # The release group is remembered
+    stub.requests.clear()
+    assert f.submit("Artist", "Album", tmp_path / "again").result() is not None
+    assert stub.paths() == ["/release-group/rg/", "/i"]
+
+
+def test_requests_are_spaced(fetcher, stub, tmp_path):
+    f = fetcher(rate_limits={"127.0.0.1": 20})
+    futures = [f.submit("Artist", f"Album {i}", tmp_path / str(i)) for i in range(4)]
+    assert all(future.result() is not None for future in futures)
+    times = sorted(t for _, _, t in stub.requests)
+    assert len(times) == 12
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) > 0.04
+    assert times[-1] - times[0] > 11 * 0.05 * 0.9
+
+
+def test_missing_covers_are_remembered(fetcher, stub, tmp_path):
+    del stub.routes["/release-group/rg/"]
+    f = fetcher()
+    assert f.fetch("Artist", "Album", tmp_path / "cover") is None
+    assert f.fetch("Artist", "Album", tmp_path / "cover") is None
+    assert stub.paths() == ["/ws/2/release-group/", "/release-group/rg/"]
+    f.close()
+
+    # By later runs too, until the failure is too old
+    stub.requests.clear()
+    assert fetcher().fetch("Artist", "Album", tmp_path / "cover") is None
+    assert stub.paths() == []
+
+
+def test_missing_covers_are_forgotten(fetcher, stub, tmp_path):
+    del stub.routes["/release-group/rg/"]
+    f = fetcher(failure_ttl=0.5)
+    assert f.fetch("Artist", "Album", tmp_path / "cover") is None
+    f.close()
+    sleep(0.5)
+    stub.requests.clear()
+    assert fetcher().fetch("Artist", "Album", tmp_path / "cover") is None
+    assert stub.paths() == ["/release-group/rg/"]
+
+
+@pytest.mark.parametrize(
+    "route",
+    [
+        ("/ws/2/release-group/", (503, "", 0)),
+        ("/release-group/rg/", (500, "", 0)),
+        ("/i", (502, "", 0)),
+        # A release group without an id
+        ("/ws/2/release-group/", (200, RELEASE_GROUP.replace(' id="{}"', ""), 0)),
+    ],
+)
+def test_errors_are_not_remembered(fetcher, stub, tmp_path, route):
+    path, response = route
+    stub.routes[path] = response
+    f = fetcher()
+    dest = tmp_path / "cover"
+    assert f.submit("Artist", "Album", dest).result() is None
+    assert not dest.exists()
+    assert not dest.with_suffix(".part").exists()
+    stub.requests.clear()
+    assert f.fetch("Artist", "Album", dest) is None
+    assert path in stub.paths()
+
+
+def test_unreachable_server(fetcher, tmp_path):
+    # Nothing listens on the port of a server that was closed
+    closed = StubServer()
+    closed.server_close()
+    f = fetcher(url=closed.url)
+    assert f.fetch("Artist", "Album", tmp_path / "cover") is None
+    assert "Artist\x1fAlbum" not in f._failures
+
+
+def test_timeout(fetcher, stub, tmp_path):
+    stub.routes["/release-group/rg/"] = (200, "{}", 2)
+    f = fetcher(timeout=0.2)
+    start = monotonic()
+    assert f.fetch("Artist", "Album", tmp_path / "cover") is None
+    assert monotonic() - start < 1.5
+    assert "Artist\x1fAlbum" not in f._failures
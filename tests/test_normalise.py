@@ -0,0 +1,104 @@
+from os import utime
+
+import pytest
+
+from fiio_shuffle.client import _cover_filename
+from fiio_shuffle.normalise import KEEP_SUFFIX, CoverNormaliser, _normalise
+
+from images import png
+
+LARGE = png(400, 400, (0, 128, 0))
+
+
+@pytest.fixture
+def normaliser(data_dir):
+    """Make a normaliser with the given settings, caching under data_dir."""
+    pytest.importorskip("PIL")
+    normalisers = []
+
+    def make(**cfg):
+        n = CoverNormaliser({"enabled": True, "max_size": 100} | cfg)
+        normalisers.append(n)
+        return n
+
+    yield make
+    for n in normalisers:
+        n.close()
+
+
+def _webp(path, size):
+    from PIL import Image
+
+    Image.new("RGB", (size, size), (0, 128, 0)).save(path, "WEBP")
+    return path
+
+
+def test_cache_key(normaliser, tmp_path):
+    src = tmp_path / "cover.png"
+    src.write_bytes(LARGE)
+    dest = normaliser()._cached(src)
+    assert dest == normaliser()._cached(src)
+    assert dest.suffix == ".webp"
+    assert normaliser(format="jpeg")._cached(src).suffix == ".jpg"
+    for cfg in ({"max_size": 200}, {"quality": 50}, {"format": "jpeg"}):
+        assert normaliser(**cfg)._cached(src).stem != dest.stem
+    # A source that changes is encoded afresh
+    utime(src, ns=(0, 0))
+    assert normaliser()._cached(src) != dest
+
+
+def test_large_cover_is_shrunk(normaliser, tmp_path):
+    src = tmp_path / "cover.png"
+    src.write_bytes(LARGE)
+    n = normaliser()
+    (dest,) = n.normalise([src])
+    assert dest == n._cached(src)
+    assert n.encoded == 1
+    assert n.bytes_out < n.bytes_in
+
+    from PIL import Image
+
+    with Image.open(dest) as im:
+        assert im.format == "WEBP"
+        assert im.size == (100, 100)
+
+    # Another run finds it in the cache
+    n = normaliser()
+    assert n.normalise([src]) == [dest]
+    assert n.encoded == 0
+
+
+def test_small_cover_is_kept(normaliser, tmp_path):
+    src = _webp(tmp_path / "cover.webp", 50)
+    n = normaliser()
+    dest = n._cached(src)
+    assert not _normalise(src, dest, 100, "webp", 85)
+    assert dest.with_suffix(KEEP_SUFFIX).exists()
+    assert not dest.exists()
+    # The marker spares later runs from opening it again
+    assert n.normalise([src]) == [src]
+    assert n._pool is None
+
+
+def test_unreadable_cover_is_kept(normaliser, tmp_path):
+    src = tmp_path / "cover.png"
+    src.write_bytes(b"not an image")
+    n = normaliser()
+    dest = n._cached(src)
+    assert not _normalise(src, dest, 100, "webp", 85)
+    assert dest.with_suffix(KEEP_SUFFIX).exists()
+    assert n.normalise([src]) == [src]
+    assert n._pool is None
+
+
+def test_cover_filename(tmp_path):
+    named = tmp_path / "Folder.PNG"
+    named.write_bytes(b"not an image")
+    assert _cover_filename(named) == "cover.png"
+    # Covers cached from MusicBrainz have no extension
+    cached = tmp_path / "0123abcd"
+    cached.write_bytes(LARGE)
+    assert _cover_filename(cached) == "cover.png"
+    misnamed = tmp_path / "cover.bin"
+    misnamed.write_bytes(LARGE)
+    assert _cover_filename(misnamed) == "cover.png"
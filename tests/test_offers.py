@@ -0,0 +1,55 @@
+from uuid import uuid4
+
+from sqlalchemy import event
+import pytest
+
+from fiio_shuffle.controllers import process_offers, process_playlists
+from fiio_shuffle.db import get_db
+
+
+@pytest.fixture
+def playlist(data_dir):
+    uuid = str(uuid4())
+    process_playlists({"playlists": [{"uuid": uuid, "title": "Playlist"}]})
+    return uuid
+
+
+def _albums(playlist, n, start=0):
+    return [
+        {
+            "artist": f"Artist {i % 7}",
+            "title": f"Album {i}",
+            "year": 1990 + i % 30,
+            "timestamp": 1000 + i,
+            "playlist_uuid": playlist,
+        }
+        for i in range(start, start + n)
+    ]
+
+
+def _count_statements(f, *args):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = get_db().engine
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        f(*args)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return statements
+
+
+def test_statements_do_not_depend_on_offer_size(playlist):
+    small = _count_statements(process_offers, {"albums": _albums(playlist, 10)})
+    large = _count_statements(
+        process_offers, {"albums": _albums(playlist, 1000, start=10)}
+    )
+    assert len(large) == len(small)
+    # And the same again once the albums are known
+    again = _count_statements(
+        process_offers, {"albums": _albums(playlist, 1000, start=10)}
+    )
+    assert len(again) == len(small)
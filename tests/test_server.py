@@ -0,0 +1,230 @@
+from io import BytesIO
+from json import dumps
+from uuid import uuid4
+import os
+
+from sqlalchemy import select
+from werkzeug.datastructures import FileStorage
+import pytest
+
+from fiio_shuffle.config import config
+from fiio_shuffle.controllers import process_offers, process_playlists, upload_cover
+from fiio_shuffle.covers import (
+    SPOOL_MEMORY_SIZE,
+    CoverSpool,
+    cover_path,
+    get_covers_dir,
+    get_variants_dir,
+)
+from fiio_shuffle.db import get_db
+from fiio_shuffle.models import Cover
+
+from images import colour, png
+
+
+@pytest.fixture
+def library(data_dir):
+    """A playlist of three albums with covers."""
+    uuid = str(uuid4())
+    process_playlists({"playlists": [{"uuid": uuid, "title": "Playlist"}]})
+    albums = [
+        {"artist": "Artist", "title": f"Album {i}", "year": 2000 + i} for i in range(3)
+    ]
+    offers = [a | {"timestamp": 1000, "playlist_uuid": uuid} for a in albums]
+    process_offers({"albums": offers})
+    for i, a in enumerate(albums):
+        cover = FileStorage(BytesIO(png(8, 8, colour(i))), filename="cover.png")
+        upload_cover(cover, {"data": a})
+    return uuid
+
+
+def test_album(client, library):
+    j = client.post("/album", json={}).get_json()
+    assert j["success"]
+    assert j["title"].startswith("Album ")
+
+
+@pytest.mark.parametrize("count", [2, 3])
+def test_albums(client, library, count):
+    j = client.post("/album", json={"count": count}).get_json()
+    assert j["success"]
+    assert len(j["albums"]) == count
+
+
+@pytest.mark.parametrize("count", [None, 3])
+def test_albums_without_covers_are_not_dealt(client, library, count):
+    # Offered, but their covers never uploaded
+    albums = [
+        {"artist": "Other", "title": f"Album {i}", "year": 2000, "timestamp": 1000}
+        for i in range(3)
+    ]
+    uuid = str(uuid4())
+    process_playlists({"playlists": [{"uuid": uuid, "title": "Coverless"}]})
+    process_offers({"albums": [a | {"playlist_uuid": uuid} for a in albums]})
+
+    j = client.post("/album", json={"playlists": [uuid], "count": count}).get_json()
+    assert not j["success"]
+    assert j["message"] == "No albums found"
+    # Nor does the whole library deal them
+    for _ in range(3):
+        j = client.post("/album", json={"count": count}).get_json()
+        assert j["success"]
+        for a in j.get("albums", [j]):
+            assert a["artist"] == "Artist"
+            assert a["cover"] is not None
+    assert b"Other" not in client.get("/").data
+
+
+@pytest.mark.parametrize("count", [True, False, 0, -1, 1.5, "2", 10_000])
+def test_album_count_must_be_an_integer_in_range(client, library, count):
+    j = client.post("/album", json={"count": count}).get_json()
+    assert not j["success"]
+    assert "count" in j["message"]
+
+
+def test_metrics_need_the_key(client, auth_key):
+    assert client.get("/metrics").status_code == 401
+    headers = {"Authorization": "Bearer wrong"}
+    assert client.get("/metrics", headers=headers).status_code == 401
+    headers = {"Authorization": f"Bearer {auth_key}"}
+    resp = client.get("/metrics", headers=headers)
+    assert resp.status_code == 200
+    assert b"fiio_shuffle_request_duration_seconds" in resp.data
+
+
+def _upload(client, metadata, cover):
+    return client.post(
+        "/upload",
+        data={
+            "metadata": (BytesIO(dumps(metadata).encode()), "metadata.json"),
+            "cover": (BytesIO(cover), "cover.png"),
+        },
+    )
+
+
+@pytest.mark.parametrize("key", [None, "wrong"])
+def test_covers_without_the_key_are_not_written(client, monkeypatch, key):
+    written = []
+    roll_over = CoverSpool._roll_over
+
+    def record(spool):
+        written.append(spool)
+        roll_over(spool)
+
+    monkeypatch.setattr(CoverSpool, "_roll_over", record)
+    metadata = {"data": {"artist": "Artist", "title": "Album", "year": 2000}}
+    if key is not None:
+        metadata["auth_key"] = key
+    # Large enough not to be kept in memory
+    cover = png(8, 8, (0, 0, 0)) + bytes(2 * SPOOL_MEMORY_SIZE)
+    j = _upload(client, metadata, cover).get_json()
+    assert not j["success"]
+    assert "authentication" in j["message"]
+    assert written == []
+
+
+@pytest.mark.parametrize("path", ["/upload", "/upload/batch"])
+def test_metadata_must_come_first(client, auth_key, path):
+    metadata = {"auth_key": auth_key, "data": {"artist": "A", "title": "T", "year": 1}}
+    resp = client.post(
+        path,
+        data={
+            "cover": (BytesIO(png(8, 8, (0, 0, 0))), "cover.png"),
+            "metadata": (BytesIO(dumps(metadata).encode()), "metadata.json"),
+        },
+    )
+    assert resp.status_code == 400
+    assert "metadata must be the first part" in resp.get_json()["message"]
+
+
+def test_index_follows_changes_in_other_processes(client, library):
+    assert b"Elsewhere" not in client.get("/").data
+    # As if another uwsgi worker were sent a new playlist
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            uuid = str(uuid4())
+            process_playlists({"playlists": [{"uuid": uuid, "title": "Elsewhere"}]})
+            code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert b"Elsewhere" in client.get("/").data
+
+
+@pytest.fixture
+def cover(library):
+    """A stored cover, with a variant 100 pixels wide."""
+    with get_db().session() as session:
+        cover = session.execute(select(Cover).limit(1)).scalar()
+    variant = get_variants_dir(cover.uuid) / "100.webp"
+    variant.parent.mkdir(exist_ok=True)
+    variant.write_bytes(b"variant")
+    return cover
+
+
+@pytest.fixture
+def sendfile(server, monkeypatch):
+    """Set how covers are sent."""
+
+    def configure(mode):
+        monkeypatch.setitem(config._get(), "sendfile", mode)
+        monkeypatch.setitem(server.config, "USE_X_SENDFILE", mode == "x-sendfile")
+
+    return configure
+
+
+def _cover_urls(cover):
+    return f"/covers/{cover.uuid}{cover.extension}", f"/covers/{cover.uuid}/100.webp"
+
+
+def _assert_cacheable(resp, etag):
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] == f'"{etag}"'
+    assert resp.cache_control.public
+    assert resp.cache_control.immutable
+    assert resp.cache_control.max_age == 365 * 24 * 60 * 60
+
+
+def test_send_cover(client, cover):
+    url, variant_url = _cover_urls(cover)
+    resp = client.get(url)
+    _assert_cacheable(resp, cover.uuid)
+    assert resp.data == cover_path(cover).read_bytes()
+    resp = client.get(url, headers={"If-None-Match": f'"{cover.uuid}"'})
+    assert resp.status_code == 304
+    resp = client.get(variant_url)
+    _assert_cacheable(resp, f"{cover.uuid}-100")
+    assert resp.data == b"variant"
+    assert client.get(f"/covers/{uuid4()}.png").status_code == 404
+
+
+def test_send_cover_with_x_accel_redirect(client, cover, sendfile):
+    sendfile("x-accel-redirect")
+    url, variant_url = _cover_urls(cover)
+    resp = client.get(url)
+    _assert_cacheable(resp, cover.uuid)
+    assert resp.headers["X-Accel-Redirect"] == f"/_covers/{cover.uuid}.png"
+    assert resp.mimetype == "image/png"
+    assert resp.data == b""
+    resp = client.get(url, headers={"If-None-Match": f'"{cover.uuid}"'})
+    assert resp.status_code == 304
+    resp = client.get(variant_url)
+    _assert_cacheable(resp, f"{cover.uuid}-100")
+    assert resp.headers["X-Accel-Redirect"] == f"/_covers/{cover.uuid}/100.webp"
+    assert client.get(f"/covers/{uuid4()}.png").status_code == 404
+    assert client.get(f"/covers/{cover.uuid}/200.webp").status_code == 404
+
+
+def test_send_cover_with_x_sendfile(client, cover, sendfile):
+    sendfile("x-sendfile")
+    url, variant_url = _cover_urls(cover)
+    resp = client.get(url)
+    _assert_cacheable(resp, cover.uuid)
+    assert resp.headers["X-Sendfile"] == str(cover_path(cover))
+    assert resp.data == b""
+    resp = client.get(variant_url)
+    expected = get_covers_dir() / str(cover.uuid) / "100.webp"
+    assert resp.headers["X-Sendfile"] == str(expected)
@@ -0,0 +1,146 @@
+from io import BytesIO
+from uuid import UUID, uuid4
+import tarfile
+
+from sqlalchemy import delete, func, select
+from werkzeug.datastructures import FileStorage
+import pytest
+
+from fiio_shuffle.controllers import process_offers, process_playlists, upload_cover
+from fiio_shuffle.covers import get_covers_dir
+from fiio_shuffle.db import get_db
+from fiio_shuffle.models import Album, AlbumInPlaylist, Cover, PlaylistDigest
+from fiio_shuffle.snapshot import export_snapshot, import_snapshot
+from fiio_shuffle.sync import (
+    EMPTY_DIGEST,
+    UNKNOWN_DIGEST,
+    add_entries,
+    remove_entries,
+)
+
+from images import colour, png
+
+PLAYLIST = str(uuid4())
+
+
+def _catalogue(titles, playlist=PLAYLIST):
+    # A playlist of albums with a cover each, offered and uploaded as by a client
+    process_playlists({"playlists": [{"uuid": playlist, "title": "Playlist"}]})
+    albums = [{"artist": "Artist", "title": t, "year": 2000} for t in titles]
+    offers = [a | {"timestamp": 1000, "playlist_uuid": playlist} for a in albums]
+    process_offers({"albums": offers})
+    for a in offers:
+        image = png(8, 8, colour(int(a["title"].removeprefix("Album "))))
+        upload_cover(FileStorage(BytesIO(image), filename="cover.png"), {"data": a})
+
+
+def _count(table):
+    with get_db().session() as session:
+        return session.execute(select(func.count()).select_from(table)).scalar()
+
+
+def _cover_files():
+    return sorted(p.name for p in get_covers_dir().iterdir() if p.is_file())
+
+
+def _digest(playlist=PLAYLIST):
+    with get_db().session() as session:
+        return session.get(PlaylistDigest, UUID(playlist)).digest
+
+
+@pytest.fixture
+def snapshot(data_dir, tmp_path):
+    """A snapshot of a server with one playlist of three albums, and its digest."""
+    _catalogue(["Album 0", "Album 1", "Album 2"])
+    archive = tmp_path / "snapshot.tar"
+    export_snapshot(get_db(), archive)
+    return archive, _digest()
+
+
+@pytest.fixture
+def other(fresh_dirs, tmp_path, snapshot):
+    """Another server, with nothing on it yet."""
+    with fresh_dirs(tmp_path / "other"):
+        yield
+
+
+def test_import_into_empty_server(snapshot, other):
+    archive, digest = snapshot
+    assert digest != EMPTY_DIGEST
+    import_snapshot(get_db(), archive)
+    assert _count(Album) == 3
+    assert _count(Cover) == 3
+    assert _count(AlbumInPlaylist) == 3
+    assert len(_cover_files()) == 3
+    assert _digest() == digest
+
+
+def test_import_twice(snapshot, other):
+    archive, digest = snapshot
+    import_snapshot(get_db(), archive)
+    files = _cover_files()
+    import_snapshot(get_db(), archive)
+    assert _count(Album) == 3
+    assert _count(Cover) == 3
+    assert _count(AlbumInPlaylist) == 3
+    assert _cover_files() == files
+    assert _digest() == digest
+
+
+def test_tampered_cover(snapshot, other, tmp_path):
+    archive, _ = snapshot
+    tampered = tmp_path / "tampered.tar"
+    with tarfile.open(archive) as src, tarfile.open(tampered, "w") as dest:
+        victim = None
+        for member in src:
+            data = src.extractfile(member).read()
+            if victim is None and member.name.startswith("covers/"):
+                victim = member.name.removeprefix("covers/")
+                data = png(8, 8, (1, 2, 3))
+                member.size = len(data)
+            dest.addfile(member, BytesIO(data))
+    import_snapshot(get_db(), tampered)
+    assert victim not in _cover_files()
+    assert len(_cover_files()) == 2
+    # Nor is the cover itself imported, so no album points at a missing file
+    with get_db().session() as session:
+        covers = session.execute(select(Cover.uuid, Cover.extension)).all()
+        assert sorted(f"{uuid}{ext}" for uuid, ext in covers) == _cover_files()
+        q = select(Album.title).where(Album.cover_id.is_(None))
+        (coverless,) = session.execute(q).scalars()
+    assert _digest() == UNKNOWN_DIGEST
+    # Which the client is asked to upload again when it resubmits the playlist
+    offers = [
+        {"artist": "Artist", "title": f"Album {i}", "year": 2000, "timestamp": 1000}
+        for i in range(3)
+    ]
+    resp = process_offers({"albums": [a | {"playlist_uuid": PLAYLIST} for a in offers]})
+    assert [a["title"] for a in resp.get_json()["albums"]] == [coverless]
+
+
+def test_merge_into_playlist_with_other_albums(snapshot, other):
+    archive, digest = snapshot
+    _catalogue(["Album 3"])
+    assert _digest() not in (digest, EMPTY_DIGEST)
+    import_snapshot(get_db(), archive)
+    assert _count(AlbumInPlaylist) == 4
+    assert _digest() == UNKNOWN_DIGEST
+    # Offers to the playlist leave it unknown, until it is submitted again
+    offer = {"artist": "Artist", "title": "Album 4", "year": 2000, "timestamp": 1}
+    process_offers({"albums": [offer | {"playlist_uuid": PLAYLIST}]})
+    assert _digest() == UNKNOWN_DIGEST
+
+
+def test_merge_into_playlist_without_digest(snapshot, other):
+    archive, _ = snapshot
+    _catalogue(["Album 3"])
+    with get_db().engine.begin() as conn:
+        conn.execute(delete(PlaylistDigest))
+    import_snapshot(get_db(), archive)
+    assert _digest() == UNKNOWN_DIGEST
+
+
+def test_unknown_digest_stays_unknown():
+    entries = [("Artist", "Album", 2000, 1000)]
+    assert add_entries(UNKNOWN_DIGEST, entries) == UNKNOWN_DIGEST
+    assert remove_entries(UNKNOWN_DIGEST, entries) == UNKNOWN_DIGEST
@@ -0,0 +1,194 @@
+from uuid import uuid4
+
+from requests.exceptions import ConnectionError
+import pytest
+
+from fiio_shuffle.client import (
+    AlbumEntry,
+    ScannedPlaylist,
+    _get_capabilities,
+    album_entry,
+    _construct_offer,
+    _upload,
+    differing,
+    offer_and_upload,
+    submit,
+    withdraw,
+)
+from fiio_shuffle.manifest import Manifest
+from fiio_shuffle.sync import (
+    EMPTY_DIGEST,
+    add_entries,
+    playlist_digest,
+    remove_entries,
+)
+
+from images import colour, png
+from transport import ClientTransport
+
+ENTRIES = [("Artist", f"Album {i}", 2000 + i, 1000 + i) for i in range(5)]
+
+
+def test_digest_of_nothing():
+    assert playlist_digest([]) == EMPTY_DIGEST
+
+
+def test_digest_does_not_depend_on_order():
+    assert playlist_digest(ENTRIES) == playlist_digest(reversed(ENTRIES))
+
+
+def test_digest_depends_on_every_field():
+    digest = playlist_digest(ENTRIES)
+    for i in range(4):
+        changed = list(ENTRIES[0])
+        changed[i] = changed[i] + 1 if isinstance(changed[i], int) else changed[i] + "!"
+        assert playlist_digest([tuple(changed)] + ENTRIES[1:]) != digest
+
+
+def test_digest_is_kept_up_to_date_one_entry_at_a_time():
+    digest = add_entries(playlist_digest(ENTRIES[:2]), ENTRIES[2:])
+    assert digest == playlist_digest(ENTRIES)
+    assert remove_entries(digest, ENTRIES[3:]) == playlist_digest(ENTRIES[:3])
+    assert remove_entries(digest, ENTRIES) == EMPTY_DIGEST
+
+
+@pytest.fixture
+def transport(client):
+    return ClientTransport(client)
+
+
+def _playlist(tmp_path, n):
+    # A playlist of n albums, each with a cover of its own
+    tmp_path.mkdir(exist_ok=True)
+    pl = ScannedPlaylist(
+        file=tmp_path / "playlist.dbpl",
+        title="Playlist",
+        uuid=str(uuid4()),
+        albums=[],
+        snapshot={},
+    )
+    albums = []
+    for i in range(n):
+        cover = tmp_path / f"{i}.png"
+        cover.write_bytes(png(8, 8, colour(i)))
+        a = AlbumEntry(
+            artist="Artist",
+            title=f"Album {i}",
+            year=2000 + i,
+            cover_uri=cover,
+            timestamp=1000 + i,
+            playlist_uuid=pl.uuid,
+        )
+        albums.append(((a.artist, a.title, a.year), a))
+    return pl, albums
+
+
+def _sync(transport, pl, digest, auth_key):
+    data = {"auth_key": auth_key, "playlists": [{"uuid": pl.uuid, "digest": digest}]}
+    resp = transport.client.post("/sync", json=data)
+    assert resp.get_json()["success"]
+    return resp.get_json()["playlists"]
+
+
+def test_sync(transport, tmp_path, auth_key):
+    pl, albums = _playlist(tmp_path, 3)
+    digest = playlist_digest(album_entry(a) for _, a in albums)
+    # Playlists the server has never seen differ
+    assert _sync(transport, pl, digest, auth_key) == [pl.uuid]
+
+    capabilities = _get_capabilities(transport)
+    submit(transport, [pl], lambda _: albums, Manifest("x"), capabilities)
+    assert _sync(transport, pl, digest, auth_key) == []
+    other = playlist_digest(album_entry(a) for _, a in albums[1:])
+    assert _sync(transport, pl, other, auth_key) == [pl.uuid]
+
+
+def test_submit_skips_playlists_the_server_has(transport, tmp_path):
+    pl, albums = _playlist(tmp_path, 3)
+    capabilities = _get_capabilities(transport)
+    assert "sync" in capabilities
+    manifest = Manifest("x")
+    submit(transport, [pl], lambda _: albums, manifest, capabilities)
+    assert transport.posts == ["/sync", "/playlists", "/offer", "/upload/batch"]
+    assert str(pl.file) in manifest.playlists
+
+    transport.posts = []
+    manifest = Manifest("x")
+    submit(transport, [pl], lambda _: albums, manifest, capabilities)
+    assert transport.posts == ["/sync"]
+    assert str(pl.file) in manifest.playlists
+
+    # Once the playlist changes, all of it is offered again
+    transport.posts = []
+    submit(transport, [pl], lambda _: albums[1:], manifest, capabilities)
+    assert transport.posts == ["/sync", "/playlists", "/offer"]
+
+
+def test_playlists_are_compared_in_one_request(transport, tmp_path):
+    playlists = [_playlist(tmp_path / str(i), 2) for i in range(3)]
+    albums = {pl.uuid: found for pl, found in playlists}
+    capabilities = _get_capabilities(transport)
+    pls = [pl for pl, _ in playlists]
+    submit(transport, pls[:1], lambda pl: albums[pl.uuid], Manifest("x"), capabilities)
+
+    # Only the playlists the server does not have yet are offered
+    transport.posts = []
+    submit(transport, pls, lambda pl: albums[pl.uuid], Manifest("x"), capabilities)
+    assert transport.posts.count("/sync") == 1
+    assert transport.posts.count("/playlists") == 2
+
+    transport.posts = []
+    submit(transport, pls, lambda pl: albums[pl.uuid], Manifest("x"), capabilities)
+    assert transport.posts == ["/sync"]
+
+
+def test_playlists_differ_if_the_server_cannot_compare(transport, tmp_path):
+    pls = [_playlist(tmp_path / str(i), 2)[0] for i in range(2)]
+    capabilities = _get_capabilities(transport)
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("Server went away")
+
+    transport.post = fail
+    digests = [(pl, EMPTY_DIGEST) for pl in pls]
+    assert differing(transport, digests, capabilities) == {pl.uuid for pl in pls}
+
+
+@pytest.fixture
+def submitted(transport, tmp_path):
+    """A playlist of three albums that the server has as the client does."""
+    pl, albums = _playlist(tmp_path, 3)
+    capabilities = _get_capabilities(transport)
+    submit(transport, [pl], lambda _: albums, Manifest("x"), capabilities)
+    return pl, albums
+
+
+def _digest(albums):
+    return playlist_digest(album_entry(a) for _, a in albums)
+
+
+def test_sending_the_same_albums_again(transport, submitted, auth_key):
+    pl, albums = submitted
+    assert offer_and_upload(transport, albums)
+    assert offer_and_upload(transport, albums)
+    a = _construct_offer(albums[:1])["albums"][0]
+    assert _upload(transport, a, albums[0][1])
+    assert _sync(transport, pl, _digest(albums), auth_key) == []
+
+
+def test_withdrawing_twice(transport, submitted, auth_key):
+    pl, albums = submitted
+    assert withdraw(transport, albums[:1])
+    assert withdraw(transport, albums[:1])
+    assert _sync(transport, pl, _digest(albums[1:]), auth_key) == []
+
+
+def test_new_timestamps_replace_old_ones(transport, submitted, auth_key):
+    pl, albums = submitted
+    key, a = albums[0]
+    albums[0] = (key, a._replace(timestamp=a.timestamp + 1))
+    assert offer_and_upload(transport, albums[:1])
+    assert _sync(transport, pl, _digest(albums), auth_key) == []
+    # Withdrawn as they were counted, whatever the client thinks
+    assert withdraw(transport, [(key, a)])
+    assert _sync(transport, pl, _digest(albums[1:]), auth_key) == []
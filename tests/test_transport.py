@@ -0,0 +1,141 @@
+from threading import Event, Timer
+from time import sleep
+from uuid import uuid4
+
+from requests.exceptions import ConnectionError, Timeout
+import pytest
+
+from fiio_shuffle.client import AlbumEntry, ScannedPlaylist, _scanned, album_entry
+from fiio_shuffle.config import config
+from fiio_shuffle.sync import playlist_digest
+from fiio_shuffle.transport import Transport
+
+from stub import StubServer
+
+CFG = {"backoff": 0, "read_timeout": 0.3}
+OK = (200, "{}", 0)
+
+
+def _fails_once(failure):
+    return [failure, OK]
+
+
+@pytest.mark.parametrize("failure", [(503, "", 0), (429, "", 0), (200, "", 1)])
+def test_get_is_retried(failure):
+    with StubServer({"/capabilities": _fails_once(failure)}) as stub:
+        with Transport(stub.url, CFG) as transport:
+            resp = transport.get("/capabilities")
+    assert resp.status_code == 200
+    assert stub.paths() == ["/capabilities", "/capabilities"]
+
+
+def test_post_is_not_retried_on_errors():
+    with StubServer({"/offer": _fails_once((503, "", 0))}) as stub:
+        with Transport(stub.url, CFG) as transport:
+            resp = transport.post("/offer", json={})
+    assert resp.status_code == 503
+    assert stub.paths() == ["/offer"]
+
+
+def test_post_is_not_retried_on_timeouts():
+    with StubServer({"/offer": _fails_once((200, "", 1))}) as stub:
+        with Transport(stub.url, CFG) as transport:
+            with pytest.raises((ConnectionError, Timeout)):
+                transport.post("/offer", json={})
+    assert stub.paths() == ["/offer"]
+
+
+def test_post_is_retried_until_it_connects():
+    # The server only starts listening after the first attempts were refused
+    closed = StubServer()
+    port = closed.server_address[1]
+    closed.server_close()
+    started = Event()
+    servers = []
+
+    def start():
+        servers.append(StubServer({"/offer": OK}, port=port).__enter__())
+        started.set()
+
+    timer = Timer(0.3, start)
+    timer.start()
+    try:
+        cfg = {"backoff": 0.4, "retries": 5}
+        with Transport(f"http://127.0.0.1:{port}", cfg) as transport:
+            resp = transport.post("/offer", json={})
+        assert started.is_set()
+        assert resp.status_code == 200
+        assert servers[0].paths() == ["/offer"]
+    finally:
+        timer.join()
+        for server in servers:
+            server.__exit__(None, None, None)
+
+
+def _playlists(tmp_path, sizes):
+    out = []
+    for n, size in enumerate(sizes):
+        pl = ScannedPlaylist(
+            file=tmp_path / f"{n}.dbpl",
+            title=f"Playlist {n}",
+            uuid=str(uuid4()),
+            albums=[],
+            snapshot={},
+        )
+        albums = []
+        for i in range(size):
+            a = AlbumEntry("Artist", f"Album {n}.{i}", 2000, None, 1000, pl.uuid)
+            albums.append(((a.artist, a.title, a.year), a))
+        out.append((pl, albums))
+    return out
+
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    monkeypatch.setitem(config._get(), "batch_size", 2)
+    monkeypatch.setitem(config._get(), "pipeline_depth", 1)
+
+
+def test_scanned(tmp_path, small_batches):
+    playlists = _playlists(tmp_path, [3, 0, 2])
+    albums = {pl.uuid: found for pl, found in playlists}
+    scanned = list(_scanned([pl for pl, _ in playlists], lambda pl: albums[pl.uuid]))
+    expected = []
+    for pl, found in playlists:
+        expected += [
+            ("batch", tuple(found[i : i + 2])) for i in range(0, len(found), 2)
+        ]
+        digest = playlist_digest(album_entry(a) for _, a in found)
+        expected.append(("playlist", (pl, digest)))
+    assert scanned == expected
+
+
+def test_scan_errors_reach_the_consumer(tmp_path, small_batches):
+    (pl, found), (broken, _) = _playlists(tmp_path, [3, 1])
+
+    def find_albums(p):
+        if p is broken:
+            raise OSError("Disk on fire")
+        return found
+
+    scanned = _scanned([pl, broken], find_albums)
+    assert next(scanned)[0] == "batch"
+    with pytest.raises(OSError, match="Disk on fire"):
+        list(scanned)
+
+
+def test_scan_does_not_run_ahead(tmp_path, small_batches):
+    ((pl, found),) = _playlists(tmp_path, [100])
+    found_so_far = []
+
+    def find_albums(_):
+        for candidate in found:
+            found_so_far.append(candidate)
+            yield candidate
+
+    scanned = _scanned([pl], find_albums)
+    next(scanned)
+    # The queue holds a batch, and the scanner is blocked with one more
+    sleep(0.3)
+    assert len(found_so_far) <= 3 * 2
+    assert len(list(scanned)) == 50
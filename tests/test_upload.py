@@ -0,0 +1,59 @@
+from uuid import uuid4
+
+from sqlalchemy import select
+import pytest
+
+from fiio_shuffle.client import AlbumEntry, offer_and_upload
+from fiio_shuffle.controllers import process_playlists
+from fiio_shuffle.db import get_db
+from fiio_shuffle.models import Album
+
+from images import colour, png
+from transport import ClientTransport
+
+
+@pytest.fixture
+def transport(client):
+    return ClientTransport(client)
+
+
+@pytest.fixture
+def candidates(data_dir, tmp_path):
+    """Three albums in a playlist, each with a cover of its own."""
+    playlist = str(uuid4())
+    process_playlists({"playlists": [{"uuid": playlist, "title": "Playlist"}]})
+    out = []
+    for i in range(3):
+        cover = tmp_path / f"{i}.png"
+        cover.write_bytes(png(8, 8, colour(i)))
+        a = AlbumEntry("Artist", f"Album {i}", 2000 + i, cover, 1000 + i, playlist)
+        out.append(((a.artist, a.title, a.year), a))
+    return out
+
+
+def _with_covers():
+    with get_db().session() as session:
+        q = select(Album.title).where(Album.cover_id != None)  # noqa: E711
+        return set(session.execute(q).scalars())
+
+
+def test_upload_one_at_a_time(transport, candidates):
+    # Servers without /upload/batch get a request per cover
+    assert offer_and_upload(transport, candidates, frozenset())
+    assert transport.posts == ["/offer", "/upload", "/upload", "/upload"]
+    assert _with_covers() == {"Album 0", "Album 1", "Album 2"}
+
+
+@pytest.mark.parametrize(
+    "capabilities, posts",
+    [
+        (frozenset(), ["/offer", "/upload", "/upload", "/upload"]),
+        (frozenset(["upload_batch"]), ["/offer", "/upload/batch"]),
+    ],
+)
+def test_upload_with_a_bad_cover(transport, candidates, capabilities, posts):
+    # The cover that is not an image fails on its own
+    candidates[1][1].cover_uri.write_text("not an image")
+    assert not offer_and_upload(transport, candidates, capabilities)
+    assert transport.posts == posts
+    assert _with_covers() == {"Album 0", "Album 2"}
@@ -0,0 +1,172 @@
+from uuid import uuid4
+
+import pytest
+
+from fiio_shuffle import watch
+from fiio_shuffle.client import AlbumEntry, ScannedPlaylist
+from fiio_shuffle.manifest import Manifest
+from fiio_shuffle.watch import (
+    IN_CLOSE_WRITE,
+    IN_DELETE_SELF,
+    IN_IGNORED,
+    IN_MOVED_TO,
+    IN_Q_OVERFLOW,
+    Watcher,
+)
+
+
+@pytest.fixture
+def watcher(tmp_path):
+    w = Watcher(tmp_path)
+    w.transport = None
+    w.manifest = Manifest("x")
+    w.capabilities = frozenset(["withdraw", "sync"])
+    w.normaliser = None
+    yield w
+    w.inotify.close()
+
+
+class Calls(list):
+    # What was sent, and what differs is to answer, last first
+    differs = None
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Record what the watcher sends to the server, instead of sending it."""
+    calls = Calls()
+    calls.differs = []
+
+    def record(name, result=True):
+        def f(transport, albums, *args, **kwargs):
+            calls.append((name, albums))
+            return result
+
+        return f
+
+    monkeypatch.setattr(watch, "offer_and_upload", record("offer"))
+    monkeypatch.setattr(watch, "withdraw", record("withdraw"))
+    monkeypatch.setattr(watch, "offer_playlists", record("playlists"))
+
+    def differing(transport, digests, capabilities):
+        return set(pl.uuid for pl, _ in digests) if calls.differs.pop() else set()
+
+    monkeypatch.setattr(watch, "differing", differing)
+    return calls
+
+
+@pytest.fixture
+def album_dir(watcher, tmp_path):
+    # An album directory, watched as if an album in it were in a playlist
+    d = tmp_path / "album"
+    d.mkdir()
+    watcher._watch_dir(d)
+    return d
+
+
+def _playlist(tmp_path):
+    return ScannedPlaylist(
+        file=tmp_path / "playlist.dbpl",
+        title="Playlist",
+        uuid=str(uuid4()),
+        albums=[],
+        snapshot={"size": 1},
+    )
+
+
+def _albums(pl, titles):
+    return [
+        (
+            ("Artist", title, 2000),
+            AlbumEntry("Artist", title, 2000, None, 1000, pl.uuid),
+        )
+        for title in titles
+    ]
+
+
+def _collect(watcher, events):
+    playlists, directories = set(), set()
+    relevant = watcher._collect(events, playlists, directories)
+    return relevant, playlists, directories
+
+
+def test_collect_playlists(watcher, tmp_path):
+    wd = watcher.root_wd
+    events = [
+        (wd, IN_CLOSE_WRITE, 0, "a.dbpl"),
+        (wd, IN_MOVED_TO, 0, "b.dbpl"),
+        (wd, IN_CLOSE_WRITE, 0, "notes.txt"),
+    ]
+    relevant, playlists, directories = _collect(watcher, events)
+    assert relevant
+    assert playlists == {tmp_path / "a.dbpl", tmp_path / "b.dbpl"}
+    assert directories == set()
+    assert _collect(watcher, [(wd, IN_CLOSE_WRITE, 0, "notes.txt")])[0] is False
+
+
+def test_collect_covers(watcher, album_dir):
+    wd = watcher._wds[album_dir]
+    relevant, _, _ = _collect(watcher, [(wd, IN_CLOSE_WRITE, 0, "01.flac")])
+    assert not relevant
+    relevant, _, directories = _collect(watcher, [(wd, IN_MOVED_TO, 0, "cover.jpg")])
+    assert relevant
+    assert directories == {album_dir}
+
+
+def test_collect_directory_gone(watcher, album_dir):
+    wd = watcher._wds[album_dir]
+    relevant, _, directories = _collect(watcher, [(wd, IN_IGNORED, 0, "")])
+    assert relevant
+    assert directories == {album_dir}
+    assert wd not in watcher._dirs
+
+
+def test_collect_overflow(watcher, album_dir, tmp_path):
+    (tmp_path / "a.dbpl").touch()
+    events = [(-1, IN_Q_OVERFLOW, 0, "")]
+    relevant, playlists, directories = _collect(watcher, events)
+    assert relevant
+    assert playlists == {tmp_path / "a.dbpl"}
+    assert directories == {album_dir}
+
+
+def test_collect_root_gone(watcher):
+    with pytest.raises(OSError):
+        _collect(watcher, [(watcher.root_wd, IN_DELETE_SELF, 0, "")])
+
+
+def test_apply_nothing_changed(watcher, calls, tmp_path):
+    pl = _playlist(tmp_path)
+    albums = _albums(pl, ["A", "B"])
+    watcher._apply(pl, albums, albums, albums)
+    assert calls == []
+    assert watcher.manifest.playlists[str(pl.file)] == pl.snapshot
+
+
+def test_apply_changes(watcher, calls, tmp_path):
+    pl = _playlist(tmp_path)
+    old = _albums(pl, ["A", "B"])
+    new = _albums(pl, ["B", "C"])
+    calls.differs.append(False)
+    watcher._apply(pl, old, new, new)
+    assert calls == [("withdraw", old[:1]), ("offer", new[1:])]
+    assert watcher.manifest.playlists[str(pl.file)] == pl.snapshot
+
+
+def test_apply_resubmits_when_the_server_differs(watcher, calls, tmp_path):
+    pl = _playlist(tmp_path)
+    old = _albums(pl, ["A"])
+    new = _albums(pl, ["A", "B"])
+    calls.differs.append(True)
+    watcher._apply(pl, old, new, new)
+    assert calls == [("offer", new[1:]), ("playlists", [pl])]
+
+
+def test_apply_without_withdraw(watcher, calls, tmp_path):
+    # The server can only forget albums by being sent the whole playlist
+    watcher.capabilities = frozenset()
+    pl = _playlist(tmp_path)
+    old = _albums(pl, ["A", "B"])
+    new = _albums(pl, ["B"])
+    watcher._apply(pl, old, new, new)
+    assert calls == [("playlists", [pl])]
@@ -0,0 +1,137 @@
+from gzip import compress as gzip_compress
+from json import dumps
+from uuid import uuid4
+
+import pytest
+
+from fiio_shuffle import wire
+from fiio_shuffle.config import config
+from fiio_shuffle.controllers import process_playlists
+from fiio_shuffle.server import CAPABILITIES
+
+PLAYLIST = str(uuid4())
+ALBUMS = [
+    {
+        "artist": f"Artist {i % 7}",
+        "title": f"Album {i}",
+        "year": 1990 + i % 30,
+        "timestamp": 1000 + i,
+        "playlist_uuid": PLAYLIST,
+    }
+    for i in range(100)
+]
+PAYLOAD = {"auth_key": "key", "albums": ALBUMS}
+
+
+def _needs(*capabilities):
+    if "msgpack" in capabilities:
+        pytest.importorskip("msgpack")
+    if "zstd" in capabilities:
+        pytest.importorskip("zstandard")
+
+
+@pytest.mark.parametrize(
+    "capabilities, content_type, encoding",
+    [
+        ([], wire.JSON, None),
+        (["gzip"], wire.JSON, "gzip"),
+        (["gzip", "columnar"], wire.JSON, "gzip"),
+        (["gzip", "zstd"], wire.JSON, "zstd"),
+        (["msgpack"], wire.MSGPACK, None),
+        (["gzip", "zstd", "msgpack", "columnar"], wire.MSGPACK, "zstd"),
+    ],
+)
+def test_round_trip(capabilities, content_type, encoding):
+    _needs(*capabilities)
+    body, headers = wire.encode(PAYLOAD, capabilities)
+    assert headers["Content-Type"] == content_type
+    assert headers.get("Content-Encoding") == encoding
+    decoded = wire.decode(body, content_type, encoding, len(body) * 100)
+    assert decoded["albums"] == ALBUMS
+    assert (decoded.get("format") == "columnar") == ("columnar" in capabilities)
+
+
+def test_small_bodies_are_not_compressed():
+    body, headers = wire.encode({"auth_key": "key", "albums": ALBUMS[:1]}, ["gzip"])
+    assert "Content-Encoding" not in headers
+    assert body == dumps({"auth_key": "key", "albums": ALBUMS[:1]}).encode()
+
+
+def test_columnar_needs_a_single_playlist():
+    albums = ALBUMS[:2] + [ALBUMS[2] | {"playlist_uuid": str(uuid4())}]
+    assert wire.to_columnar(albums) is None
+    body, headers = wire.encode({"albums": albums}, ["columnar"])
+    assert wire.decode(body, wire.JSON, None, 10**6) == {"albums": albums}
+
+
+def test_columns_share_artists():
+    columns = wire.to_columnar(ALBUMS)
+    assert len(columns["artists"]) == 7
+    assert wire.from_columnar(columns) == ALBUMS
+
+
+def test_malformed_columns():
+    columns = wire.to_columnar(ALBUMS)
+    columns["title"].pop()
+    with pytest.raises(ValueError):
+        wire.from_columnar(columns)
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_decompression_bomb(encoding):
+    _needs(encoding)
+    bomb = bytes(10 * 2**20)
+    if encoding == "gzip":
+        body = gzip_compress(bomb)
+    else:
+        body = wire._zstd().ZstdCompressor().compress(bomb)
+    assert len(body) < 2**20 // 10
+    with pytest.raises(ValueError, match="larger than"):
+        wire.decode(body, wire.JSON, encoding, 2**20)
+
+
+@pytest.mark.parametrize("encoding", ["br", "compress"])
+def test_unsupported_encoding(encoding):
+    with pytest.raises(ValueError, match="Unsupported"):
+        wire.decode(b"{}", wire.JSON, encoding, 10**6)
+
+
+@pytest.fixture
+def playlist(data_dir):
+    process_playlists({"playlists": [{"uuid": PLAYLIST, "title": "Playlist"}]})
+
+
+def _offer(client, body, headers):
+    return client.post("/offer", data=body, headers=headers)
+
+
+def test_server_decodes_what_the_client_encodes(client, auth_key, playlist):
+    body, headers = wire.encode(PAYLOAD | {"auth_key": auth_key}, CAPABILITIES)
+    j = _offer(client, body, headers).get_json()
+    assert j["success"]
+    assert j["albums"] == ALBUMS
+
+
+def test_old_clients_send_plain_json(client, auth_key, playlist):
+    j = client.post("/offer", json=PAYLOAD | {"auth_key": auth_key}).get_json()
+    assert j["success"]
+    assert j["albums"] == ALBUMS
+
+
+def test_server_refuses_bombs(client, auth_key, monkeypatch):
+    monkeypatch.setitem(config._get(), "max_request_size", 2**20)
+    body = dumps({"auth_key": auth_key, "padding": " " * 2**21}).encode()
+    headers = {"Content-Type": wire.JSON, "Content-Encoding": "gzip"}
+    j = _offer(client, gzip_compress(body), headers).get_json()
+    assert not j["success"]
+    assert "larger than" in j["message"]
+
+
+def test_server_refuses_large_bodies(client, auth_key, monkeypatch):
+    # Uncompressed bodies are held to the same limit, before they are read
+    monkeypatch.setitem(config._get(), "max_request_size", 2**20)
+    body = dumps({"auth_key": auth_key, "padding": " " * 2**21}).encode()
+    resp = _offer(client, body, {"Content-Type": wire.JSON})
+    assert resp.status_code == 413
+    resp = client.post("/album", data=body, headers={"Content-Type": wire.JSON})
+    assert resp.status_code == 413
@@ -0,0 +1,46 @@
+# A way for the client to talk to the server through Flask's test client.
+
+from urllib3.filepost import encode_multipart_formdata
+
+
+class _Response:
+    # The parts of requests.Response that the client uses
+    def __init__(self, resp):
+        self._resp = resp
+        self.status_code = resp.status_code
+
+    def raise_for_status(self):
+        from requests.exceptions import HTTPError
+
+        if self.status_code >= 400:
+            raise HTTPError(f"{self.status_code} Error", response=self)
+
+    def json(self):
+        return self._resp.get_json()
+
+
+class ClientTransport:
+    """Stands in for transport.Transport, sending requests to a Flask test
+    client."""
+
+    def __init__(self, client):
+        self.client = client
+        # The paths posted to, in order
+        self.posts = []
+
+    def get(self, path, **kwargs):
+        return _Response(self.client.get(path, headers=kwargs.get("headers")))
+
+    def post(self, path, data=None, headers=None, files=None, **kwargs):
+        self.posts.append(path)
+        if files is not None:
+            # Encoded as requests encodes them
+            fields = [
+                (name, (filename, f.read() if hasattr(f, "read") else f))
+                for name, (filename, f) in files
+            ]
+            data, content_type = encode_multipart_formdata(fields)
+            headers = (headers or {}) | {"Content-Type": content_type}
+        elif data is not None and not isinstance(data, bytes):
+            data = b"".join(data)
+        return _Response(self.client.post(path, data=data, headers=headers))